@@ -55,6 +55,49 @@ class Settings(BaseModel):
     # Analysis and explanation model - using available model
     analysis_model: str = os.getenv("ANALYSIS_MODEL", "gpt-4o-mini")
     batch_size: int = int(os.getenv("BATCH_SIZE", "10"))
+    # Adaptive batching: rows are packed per request against a token budget
+    batch_target_prompt_tokens: int = int(os.getenv("BATCH_TARGET_PROMPT_TOKENS", "6000"))
+    batch_completion_tokens_per_row: int = int(os.getenv("BATCH_COMPLETION_TOKENS_PER_ROW", "80"))
+    batch_max_rows: int = int(os.getenv("BATCH_MAX_ROWS", "40"))
+    # Smallest batch when the tail of a conversion is split across workers
+    batch_min_rows: int = int(os.getenv("BATCH_MIN_ROWS", "10"))
+    batch_target_latency: float = float(os.getenv("BATCH_TARGET_LATENCY", "8.0"))
+    # Prompt caching: include the full NACRE reference in the cached prefix, cache routing key
+    prompt_nacre_reference: bool = os.getenv("PROMPT_NACRE_REFERENCE", "false").lower() in {"1","true","yes"}
+    prompt_cache_key: str = os.getenv("PROMPT_CACHE_KEY", "nacre-classification")
+    # Classification cascade: rows below the threshold move on to the next, more expensive tier
+    cascade_enabled: bool = os.getenv("CASCADE_ENABLED", "true").lower() in {"1","true","yes"}
+    cascade_min_confidence: int = int(os.getenv("CASCADE_MIN_CONFIDENCE", "90"))
+    # Durable job queue: the API enqueues conversions, workers (embedded threads or `python -m app.worker`) run them
+    job_queue_enabled: bool = os.getenv("JOB_QUEUE_ENABLED", "true").lower() in {"1","true","yes"}
+    embedded_worker: bool = os.getenv("EMBEDDED_WORKER", "true").lower() in {"1","true","yes"}
+    embedded_worker_threads: int = int(os.getenv("EMBEDDED_WORKER_THREADS", "2"))
+    job_poll_seconds: float = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+    job_heartbeat_seconds: float = float(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))
+    job_stale_seconds: float = float(os.getenv("JOB_STALE_SECONDS", "60"))
+    job_max_attempts: int = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    # Shared LLM worker pool, fair-queued across concurrent conversions
+    # (with the job queue, LLM_POOL_SIZE caps concurrent LLM calls across all API/worker processes)
+    llm_pool_size: int = int(os.getenv("LLM_POOL_SIZE", "6"))
+    # A shared LLM slot held longer than this is assumed to belong to a crashed process
+    llm_slot_stale_seconds: float = float(os.getenv("LLM_SLOT_STALE_SECONDS", "300"))
+    interactive_max_rows: int = int(os.getenv("INTERACTIVE_MAX_ROWS", "500"))
+    # Conversion event stream (SSE): interval at which the rows log and status are checked for changes
+    events_poll_seconds: float = float(os.getenv("EVENTS_POLL_SECONDS", "0.5"))
+    # Exports are streamed in chunks of about this many bytes
+    export_chunk_bytes: int = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+    # Uploaded ledgers are read in chunks of this many rows for the carbon calculation
+    co2_chunk_rows: int = int(os.getenv("CO2_CHUNK_ROWS", "100000"))
+    # Carbon visualisation charts kept on disk (serialised figures, least recently used evicted first)
+    viz_cache_max_entries: int = int(os.getenv("VIZ_CACHE_MAX_ENTRIES", "200"))
+    # Resume conversions interrupted by a server restart from their checkpoint
+    resume_on_startup: bool = os.getenv("RESUME_ON_STARTUP", "true").lower() in {"1","true","yes"}
+    # Local model tier (TF-IDF + logistic regression trained from training.jsonl)
+    local_model_enabled: bool = os.getenv("LOCAL_MODEL_ENABLED", "true").lower() in {"1","true","yes"}
+    # Confidence is calibrated on a holdout split: 90 means about 90% of such rows are right
+    local_model_min_confidence: int = int(os.getenv("LOCAL_MODEL_MIN_CONFIDENCE", "90"))
+    local_model_holdout: float = float(os.getenv("LOCAL_MODEL_HOLDOUT", "0.2"))
+    local_model_min_examples: int = int(os.getenv("LOCAL_MODEL_MIN_EXAMPLES", "50"))
     # Enhanced AI settings for GPT-5
     enable_advanced_reasoning: bool = os.getenv("ENABLE_ADVANCED_REASONING", "true").lower() in {"1","true","yes"}
     enable_multi_step_analysis: bool = os.getenv("ENABLE_MULTI_STEP_ANALYSIS", "true").lower() in {"1","true","yes"}
@@ -114,3 +157,24 @@ GPT5_PARAMS = {
         "presence_penalty": 0.3,   # Encourager diversité
     },
 }
+
+# Token limits per model (context window, max completion tokens)
+MODEL_TOKEN_LIMITS = {
+    "gpt-4o-mini": {"context": 128000, "max_output": 16384},
+    "gpt-4o": {"context": 128000, "max_output": 16384},
+    "gpt-4.1-mini": {"context": 1047576, "max_output": 32768},
+    "gpt-4.1": {"context": 1047576, "max_output": 32768},
+    "gpt-5-mini": {"context": 400000, "max_output": 128000},
+    "gpt-5": {"context": 400000, "max_output": 128000},
+}
+DEFAULT_MODEL_TOKEN_LIMITS = {"context": 16385, "max_output": 4096}
+
+
+def get_model_limits(model: str) -> dict:
+    """Return the token limits for a model, matching dated variants by prefix."""
+    if model in MODEL_TOKEN_LIMITS:
+        return MODEL_TOKEN_LIMITS[model]
+    for name in sorted(MODEL_TOKEN_LIMITS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_TOKEN_LIMITS[name]
+    return DEFAULT_MODEL_TOKEN_LIMITS
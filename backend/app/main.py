@@ -9,7 +9,10 @@ from .routes.health import router as health_router
 from .routes.sophie import router as sophie_router
 from .routes.co2_analyzer import router as co2_router
 from .routes.carbon_visualization import router as carbon_viz_router
+from .routes.conversion import resume_interrupted_conversions
+from .worker import start_embedded_workers
 from .services.embeddings import build_or_load_index
+from .config import settings
 from .services.sophie import initialize_sophie
 from .utils.logging_config import setup_logging
 
@@ -31,10 +34,23 @@ async def lifespan(app: FastAPI):
         logger.info("Sophie initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize Sophie: {e}")
+    if settings.resume_on_startup:
+        try:
+            resumed = resume_interrupted_conversions()
+            if resumed:
+                logger.info(f"Resumed {len(resumed)} interrupted conversion(s)")
+        except Exception as e:
+            logger.error(f"Failed to resume interrupted conversions: {e}")
+    workers_stop = None
+    if settings.job_queue_enabled and settings.embedded_worker:
+        workers_stop = start_embedded_workers()
+        logger.info(f"Started {settings.embedded_worker_threads} embedded conversion worker(s)")
     
     yield
     
     # Shutdown
+    if workers_stop is not None:
+        workers_stop.set()
     logger.info("Shutting down NACRE Conversion API")
 
 
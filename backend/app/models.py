@@ -13,8 +13,14 @@ class ConversionCreate(BaseModel):
     upload_id: str
     label_column: str
     context_columns: List[str] = []
+    supplier_column: Optional[str] = None  # context column holding the supplier (detected by name if omitted)
+    account_column: Optional[str] = None  # context column holding the accounting account (detected by name if omitted)
     max_rows: Optional[int] = None
     batch_size: Optional[int] = 10  # Increased default batch size for better performance
+    priority: str = "auto"  # auto, interactive, normal, bulk (auto: small files are interactive)
+    amount_column: Optional[str] = None  # amounts (€) for the CO2 columns of the results snapshot
+    entity: Optional[str] = None  # subsidiary / entity, a dimension of the carbon cube
+    period: Optional[str] = None  # reporting period, e.g. "2025-03" (sorted as text in the carbon cube)
 
 
 class Candidate(BaseModel):
@@ -33,6 +39,7 @@ class RowClassification(BaseModel):
     explanation: str | None = None
     evolution_summary: str | None = None
     rationale: List[str] = []
+    seq: Optional[int] = None  # commit order in the rows log, used as a fetch cursor
 
 
 class ConversionStatus(BaseModel):
@@ -47,6 +54,8 @@ class ConversionStatus(BaseModel):
 class ConversionResult(BaseModel):
     conversion_id: str
     rows: List[RowClassification]
+    next_cursor: Optional[int] = None  # pass as ?after= to get only rows committed since
+    has_more: bool = False
 
 
 class RowUpdate(BaseModel):
@@ -54,8 +63,40 @@ class RowUpdate(BaseModel):
     chosen_category: Optional[str] = None
     confidence: Optional[int] = None
 
+
+class RowEdit(RowUpdate):
+    row_index: int
+
+
+class RowsUpdate(BaseModel):
+    edits: List[RowEdit]
+
+
+class BulkCorrection(BaseModel):
+    # Predicate: every given criterion must match (at least one is required)
+    label_pattern: Optional[str] = None  # regular expression, case-insensitive, searched in the label
+    supplier: Optional[str] = None  # supplier name, case-insensitive
+    current_code: Optional[str] = None
+    # Correction
+    chosen_code: str
+    chosen_category: Optional[str] = None  # defaults to the NACRE category of chosen_code
+    confidence: int = Field(100, ge=0, le=100)
+    dry_run: bool = False  # only count the matching rows
+
+
+class BulkCorrectionResult(BaseModel):
+    conversion_id: str
+    matched: int
+    updated: int
+    row_indices: List[int] = []  # first matching rows, for review
+
+
 class ExportCreate(BaseModel):
     conversion_id: str
     columns_to_keep: List[str] = []
     include_classification: bool = True
     classification_prefix: str = "nacre_"  # nacre_code, nacre_category, nacre_confidence
+    format: str = Field("csv", pattern="^(csv|xlsx|parquet)$")
+    include_emissions: bool = False  # nacre_emission_factor (kg CO2/€), plus nacre_co2_kg with amount_column
+    amount_column: Optional[str] = None
+    gzip: bool = False  # Content-Encoding: gzip
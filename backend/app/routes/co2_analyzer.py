@@ -3,15 +3,22 @@ Endpoints pour l'IA - Analyse CO2
 Routes pour le calcul et l'analyse des bilans carbone
 """
 from fastapi import APIRouter, HTTPException, UploadFile, File
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional
 import pandas as pd
 import json
 import logging
+import os
+import shutil
+import tempfile
 import time
 
-from ..services.co2_analyzer import co2_analyzer
-from ..services.csv_io import preview_csv, iterate_csv
+from ..config import settings
+from ..services.co2_analyzer import co2_analyzer, FootprintAggregates
+from ..services.carbon_cube import get_carbon_cube
+from ..services.conversion_footprint import conversion_footprint
+from ..services.csv_io import preview_csv, read_csv_chunks
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/co2", tags=["CO2 Analysis"])
@@ -19,6 +26,17 @@ router = APIRouter(prefix="/co2", tags=["CO2 Analysis"])
 class CarbonCalculationInput(BaseModel):
     data: List[Dict[str, Any]]
     montant_column: str
+    # Page des détails par ligne renvoyés (details_limit=0 : aucun, None : tous)
+    details_offset: int = Field(0, ge=0)
+    details_limit: Optional[int] = Field(1000, ge=0)
+
+class ConversionFootprintInput(BaseModel):
+    # Par défaut : colonne montant de la conversion
+    montant_column: Optional[str] = None
+    details_offset: int = Field(0, ge=0)
+    details_limit: Optional[int] = Field(0, ge=0)
+    # Rapport complet avec analyse IA au lieu du seul calcul
+    report: bool = False
 
 class ColumnMappingInput(BaseModel):
     file_data: List[Dict[str, Any]]
@@ -54,7 +72,9 @@ def calculate_carbon_footprint(input_data: CarbonCalculationInput):
         start_time = time.time()
         results = co2_analyzer.calculate_carbon_footprint(
             data=input_data.data,
-            montant_column=input_data.montant_column
+            montant_column=input_data.montant_column,
+            details_offset=input_data.details_offset,
+            details_limit=input_data.details_limit,
         )
         calculation_time = time.time() - start_time
         
@@ -91,7 +111,9 @@ def analyze_carbon_footprint(input_data: CarbonCalculationInput):
         # Calcul du bilan carbone
         calculation_results = co2_analyzer.calculate_carbon_footprint(
             data=input_data.data,
-            montant_column=input_data.montant_column
+            montant_column=input_data.montant_column,
+            details_offset=input_data.details_offset,
+            details_limit=input_data.details_limit,
         )
         
         # Génération du rapport avec analyse IA
@@ -113,86 +135,165 @@ def analyze_carbon_footprint(input_data: CarbonCalculationInput):
         logger.error(f"Erreur analyse bilan carbone: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur lors de l'analyse: {str(e)}")
 
+def _spool_upload(file: UploadFile) -> str:
+    """Copie le fichier reçu dans un fichier temporaire, par blocs"""
+    fd, path = tempfile.mkstemp(prefix="nacre_co2_", suffix=".csv")
+    with os.fdopen(fd, "wb") as out:
+        shutil.copyfileobj(file.file, out, 1 << 20)
+    return path
+
+
+def _footprint_chunks(path: str, mapping: Dict[str, str], montant_column: str, aggregates: FootprintAggregates):
+    """Calcule le fichier morceau par morceau ; retourne (morceau, calcul, ligne de départ)"""
+    for chunk in read_csv_chunks(path, settings.co2_chunk_rows):
+        if mapping:
+            chunk = chunk.rename(columns=mapping)
+        offset = aggregates.lines
+        yield chunk, aggregates.add(chunk), offset
+
+
 @router.post("/calculate-from-file")
-async def calculate_from_csv_file(
+def calculate_from_csv_file(
     file: UploadFile = File(...),
-    column_mapping: str = None
+    column_mapping: str = None,
+    details: bool = False,
 ):
     """
-    Calcule le bilan carbone directement depuis un fichier CSV
+    Calcule le bilan carbone d'un fichier CSV, lu par morceaux de CO2_CHUNK_ROWS lignes
     
     Args:
         file: Fichier CSV uploadé
         column_mapping: Mapping des colonnes en JSON
+        details: Détails par ligne en NDJSON (une ligne par ligne calculée, puis le résumé)
         
     Returns:
-        Résultats du calcul de bilan carbone
+        Résumé du bilan (totaux par code, catégorie et source), ou flux NDJSON si details
     """
+    # Validation du fichier
+    if not file.filename.lower().endswith('.csv'):
+        raise HTTPException(status_code=400, detail="Le fichier doit être au format CSV")
+    
+    # Parsing du mapping des colonnes
+    mapping = {}
+    if column_mapping:
+        try:
+            mapping = json.loads(column_mapping)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Format de mapping des colonnes invalide")
+    
+    path = _spool_upload(file)
     try:
-        # Validation du fichier
-        if not file.filename.endswith('.csv'):
-            raise HTTPException(status_code=400, detail="Le fichier doit être au format CSV")
-        
-        # Lecture du fichier CSV
-        content = await file.read()
-        
-        # Parsing du mapping des colonnes
-        mapping = {}
-        if column_mapping:
-            try:
-                mapping = json.loads(column_mapping)
-            except json.JSONDecodeError:
-                raise HTTPException(status_code=400, detail="Format de mapping des colonnes invalide")
-        
-        # Traitement du CSV
-        data = []
-        for row_data in iterate_csv(content.decode('utf-8')):
-            # Application du mapping si fourni
-            mapped_row = {}
-            for key, value in row_data.items():
-                # Utiliser le mapping ou garder le nom original
-                mapped_key = mapping.get(key, key)
-                mapped_row[mapped_key] = value
-            data.append(mapped_row)
-        
-        # Déterminer la colonne montant
+        # Déterminer la colonne montant depuis l'en-tête
+        columns, _ = preview_csv(path, limit=0)
+        columns = [mapping.get(c, c) for c in columns]
         montant_column = mapping.get('montant', 'montant')
-        if montant_column not in data[0] if data else {}:
+        if montant_column not in columns:
             # Essayer de détecter automatiquement
             possible_columns = ['montant', 'amount', 'valeur', 'prix', 'total']
-            for col in possible_columns:
-                if col in (data[0] if data else {}):
-                    montant_column = col
-                    break
-            else:
+            montant_column = next((col for col in possible_columns if col in columns), None)
+            if montant_column is None:
                 raise HTTPException(
                     status_code=400, 
                     detail="Colonne montant non trouvée. Spécifiez le mapping des colonnes."
                 )
-        
-        # Calcul du bilan carbone
-        results = co2_analyzer.calculate_carbon_footprint(
-            data=data,
-            montant_column=montant_column
-        )
-        
-        # Ajouter les métadonnées du fichier
-        results["file_metadata"] = {
+        file_metadata = {
             "filename": file.filename,
-            "file_size_bytes": len(content),
+            "file_size_bytes": os.path.getsize(path),
             "column_mapping_used": mapping,
             "detected_montant_column": montant_column
         }
-        
+    except Exception:
+        os.remove(path)
+        raise
+
+    aggregates = FootprintAggregates(co2_analyzer, montant_column)
+    if details:
+        def _ndjson():
+            try:
+                for chunk, frame, offset in _footprint_chunks(path, mapping, montant_column, aggregates):
+                    lines = [json.dumps(d, ensure_ascii=False) for d in co2_analyzer.line_details(chunk, frame, offset)]
+                    if lines:
+                        yield ("\n".join(lines) + "\n").encode("utf-8")
+                results = aggregates.result()
+                results["file_metadata"] = file_metadata
+                yield (json.dumps({"summary": results}, ensure_ascii=False) + "\n").encode("utf-8")
+            except Exception as e:
+                logger.error(f"Erreur calcul depuis fichier: {e}")
+                yield (json.dumps({"error": str(e)}, ensure_ascii=False) + "\n").encode("utf-8")
+            finally:
+                os.remove(path)
+
+        return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
+
+    try:
+        for _ in _footprint_chunks(path, mapping, montant_column, aggregates):
+            pass
+        results = aggregates.result()
+        results["file_metadata"] = file_metadata
         logger.info(f"Calcul depuis fichier terminé - {file.filename}: {results['total_co2_tonnes']:.2f} tonnes CO2")
-        
         return results
-        
-    except HTTPException:
-        raise
     except Exception as e:
         logger.error(f"Erreur calcul depuis fichier: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur lors du traitement du fichier: {str(e)}")
+    finally:
+        os.remove(path)
+
+@router.post("/conversions/{conversion_id}/footprint")
+def calculate_conversion_footprint(conversion_id: str, payload: Optional[ConversionFootprintInput] = None):
+    """
+    Bilan carbone d'une conversion enregistrée, calculé sur le serveur
+    
+    Les codes retenus sont joints par row_index à la colonne montant du fichier
+    d'origine ; le résumé est mis en cache jusqu'à la prochaine modification des lignes.
+    """
+    payload = payload or ConversionFootprintInput()
+    try:
+        results = conversion_footprint(
+            conversion_id,
+            montant_column=payload.montant_column,
+            details_offset=payload.details_offset,
+            details_limit=payload.details_limit,
+            report=payload.report,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if results is None:
+        raise HTTPException(status_code=404, detail="Conversion introuvable")
+    if "error" in results:
+        raise HTTPException(status_code=500, detail=f"Erreur lors du calcul: {results['error']}")
+    return results
+
+def _csv_param(value: Optional[str]) -> List[str]:
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+@router.get("/cube")
+def carbon_rollup(
+    by: str = "entity,period",
+    entity: Optional[str] = None,
+    period: Optional[str] = None,
+    code: Optional[str] = None,
+    category: Optional[str] = None,
+    period_from: Optional[str] = None,
+    period_to: Optional[str] = None,
+):
+    """
+    Consolidation carbone multi-entités et multi-périodes, calculée sur le cube
+    
+    Args:
+        by: Dimensions de regroupement parmi entity, period, code, category (séparées par des virgules)
+        entity, period, code, category: Valeurs retenues (séparées par des virgules) pour le drill-down
+        period_from, period_to: Bornes des périodes (incluses)
+    """
+    filters = {"entity": _csv_param(entity), "period": _csv_param(period), "code": _csv_param(code), "category": _csv_param(category)}
+    try:
+        return get_carbon_cube().rollup(_csv_param(by), filters, period_from, period_to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/cube/rebuild")
+def rebuild_carbon_cube():
+    """Reconstruit le cube carbone depuis toutes les conversions enregistrées"""
+    return {"conversions": get_carbon_cube().rebuild()}
 
 @router.get("/emission-factor/{nacre_code}")
 def get_emission_factor(nacre_code: str):
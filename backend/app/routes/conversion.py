@@ -1,26 +1,51 @@
-﻿from fastapi import APIRouter, HTTPException, Query, BackgroundTasks
+﻿from fastapi import APIRouter, HTTPException, Query, BackgroundTasks, Header, Request
+from fastapi.responses import StreamingResponse
 from typing import List
 import threading
 import os
 import asyncio
+import re
 import time
 
 from ..config import settings
-from ..models import ConversionCreate, ConversionStatus, ConversionResult, RowClassification, RowUpdate
-from ..services.storage import create_conversion, get_upload, get_conversion, update_conversion, append_conversion_row
+from ..models import (
+    ConversionCreate, ConversionStatus, ConversionResult, RowClassification, RowUpdate, RowsUpdate,
+    BulkCorrection, BulkCorrectionResult,
+)
+from ..services.storage import (
+    create_conversion, get_upload, get_conversion, get_conversion_meta, update_conversion,
+    append_conversion_row, append_conversion_rows, committed_row_indices, get_row_checkpoint, list_conversion_ids,
+    get_conversion_rows, get_conversion_rows_after, get_conversion_row, patch_conversion_rows,
+)
 from ..services.csv_io import iterate_csv, count_csv_rows
 from ..services.xlsx_io import iterate_xlsx, count_xlsx_rows
 from ..services.nacre_dict import get_nacre_dict, NacreEntry
 from ..services.openai_classifier import get_classifier
 from ..services.sophie_llm import sophie_add_event
-from ..services.patterns import update_patterns
+from ..services.patterns import account_of, context_roles, row_context, update_patterns, update_patterns_many, supplier_of
 from ..services.embeddings import retrieve_with_embeddings
 from ..services.async_processor import process_conversion_async
 from ..services.parallel_processor import process_conversion_parallel
+from ..services.cascade import ClassificationCascade, get_label_cache
+from ..services.job_queue import get_job_queue
+from ..services.scheduler import resolve_priority, PRIORITY_RANKS
+from ..services import conversion_control
+from ..services.conversion_control import ConversionStopped, STOP_ACTIONS
+from ..services.events import conversion_event_stream, notify_conversion
+from ..services.carbon_cube import get_carbon_cube
+from ..services.carbon_totals import live_totals
+from ..services.columnar import write_snapshot
 
 
 router = APIRouter()
 
+# Statuts d'une conversion interrompue (tâche perdue lors d'un redémarrage)
+RESUMABLE_STATUSES = {"running", "processing"}
+
+# Conversions en cours d'exécution dans ce processus
+_active_conversions: set = set()
+_active_lock = threading.Lock()
+
 
 def _process_batch(conv_id: str, batch_data: List[dict], batch_indices: List[int], clf, stats: dict):
     """Process a batch of rows using batch classification"""
@@ -28,6 +53,8 @@ def _process_batch(conv_id: str, batch_data: List[dict], batch_indices: List[int
         # Use batch classification for better performance
         results = clf.classify_batch(batch_data, top_k=3)
         
+        records = []
+        learned = []
         for i, (result, row_index) in enumerate(zip(results, batch_indices)):
             item = batch_data[i]
             
@@ -46,16 +73,20 @@ def _process_batch(conv_id: str, batch_data: List[dict], batch_indices: List[int
                 rationale=result.get("rationale", []),
             )
             
-            append_conversion_row(conv_id, rc.model_dump())
-            
-            try:
-                update_patterns(item["context"], rc.chosen_code, rc.confidence)
-            except Exception:
-                pass
+            records.append(rc.model_dump())
+            learned.append((item["context"], rc.chosen_code, rc.confidence))
+        
+        # Une écriture du journal (et un delta des totaux CO2) par batch
+        append_conversion_rows(conv_id, records)
+        try:
+            update_patterns_many(learned)
+        except Exception:
+            pass
                 
     except Exception as e:
         # Fallback to individual processing if batch fails
         stats["errors"] += len(batch_data)
+        records = []
         for i, row_index in enumerate(batch_indices):
             item = batch_data[i]
             
@@ -93,7 +124,8 @@ def _process_batch(conv_id: str, batch_data: List[dict], batch_indices: List[int
                 rationale=result.get("rationale", []),
             )
             
-            append_conversion_row(conv_id, rc.model_dump())
+            records.append(rc.model_dump())
+        append_conversion_rows(conv_id, records)
 
 
 def _run_conversion_async_wrapper(conv_id: str, upload_path: str, payload: ConversionCreate):
@@ -115,6 +147,7 @@ async def _run_conversion_async(conv_id: str, upload_path: str, payload: Convers
         all_items = []
         stats = {"skipped_empty_label": 0, "errors": 0}
         
+        roles = context_roles(payload.context_columns, payload.supplier_column, payload.account_column)
         for i, row in enumerate(iterate_csv(upload_path)):
             if payload.max_rows and i >= payload.max_rows:
                 break
@@ -124,7 +157,7 @@ async def _run_conversion_async(conv_id: str, upload_path: str, payload: Convers
                 stats["skipped_empty_label"] += 1
                 continue
             
-            context = {k: row.get(k) for k in payload.context_columns}
+            context = row_context(row, payload.context_columns, roles)
             
             # Préparer les candidats
             try:
@@ -184,16 +217,26 @@ async def _run_conversion_async(conv_id: str, upload_path: str, payload: Convers
             )
         
         # Traitement asynchrone parallèle
-        results = await process_conversion_async(
-            conv_id=conv_id,
-            all_items=all_items,
-            batch_size=batch_size,
-            max_concurrent=max_concurrent,
-            progress_callback=progress_callback
-        )
+        stopped = None
+        try:
+            results = await process_conversion_async(
+                conv_id=conv_id,
+                all_items=all_items,
+                batch_size=batch_size,
+                max_concurrent=max_concurrent,
+                progress_callback=progress_callback
+            )
+        except ConversionStopped as stop:
+            # Enregistrer les batches terminés avant l'arrêt
+            stopped = stop
+            results = stop.results or []
         
-        # Sauvegarder les résultats
+        # Sauvegarder les résultats en une écriture
+        records = []
+        learned = []
         for i, (item, result) in enumerate(zip(all_items, results)):
+            if result is None:
+                continue
             rc = RowClassification(
                 row_index=item["row_index"],
                 label_raw=item["label_text"],
@@ -209,13 +252,25 @@ async def _run_conversion_async(conv_id: str, upload_path: str, payload: Convers
                 rationale=result.get("rationale", []),
             )
             
-            append_conversion_row(conv_id, rc.model_dump())
-            
-            # Mise à jour des patterns
-            try:
-                update_patterns(item["context"], rc.chosen_code, rc.confidence)
-            except Exception:
-                pass
+            records.append(rc.model_dump())
+            learned.append((item["context"], rc.chosen_code, rc.confidence))
+        append_conversion_rows(conv_id, records)
+        
+        # Mise à jour des patterns
+        try:
+            update_patterns_many(learned)
+        except Exception:
+            pass
+        
+        if stopped is not None:
+            update_conversion(conv_id, {
+                "status": stopped.status,
+                "control": None,
+                "progress": get_row_checkpoint(conv_id)["committed_rows"],
+                "total": total_items,
+                "stats": stats,
+            })
+            return
         
         # Finalisation
         total_time = time.time() - start_time
@@ -258,6 +313,7 @@ def _run_conversion(conv_id: str, upload_path: str, payload: ConversionCreate):
         current_batch = []
         current_batch_indices = []
         
+        roles = context_roles(payload.context_columns, payload.supplier_column, payload.account_column)
         for i, row in enumerate(iterate_csv(upload_path)):
             if payload.max_rows and i >= payload.max_rows:
                 break
@@ -267,7 +323,7 @@ def _run_conversion(conv_id: str, upload_path: str, payload: ConversionCreate):
                 stats["skipped_empty_label"] += 1
                 continue
             
-            context = {k: row.get(k) for k in payload.context_columns}
+            context = row_context(row, payload.context_columns, roles)
             
             # Prepare candidates for this row
             try:
@@ -359,8 +415,8 @@ def start_conversion(payload: ConversionCreate, background: BackgroundTasks):
         update_conversion(conv["id"], {"status": "running", "total_rows": total_rows, "processed_rows": 0})
 
         # Utiliser le nouveau traitement parallèle avec agents multiples
-        print(f"🔄 Starting background task for conversion: {conv['id']}")
-        background.add_task(_run_conversion_parallel, conv["id"], path, payload)
+        print(f"🔄 Dispatching conversion: {conv['id']}")
+        _dispatch(conv["id"], path, payload, background=background, total_rows=total_rows)
 
         now = get_conversion(conv["id"]) or {}
         print(f"✅ Conversion started successfully: {now.get('id')}")
@@ -381,8 +437,102 @@ def start_conversion(payload: ConversionCreate, background: BackgroundTasks):
         raise HTTPException(status_code=500, detail=f"Erreur lors du démarrage: {str(e)}")
 
 
-def _run_conversion_parallel(conv_id: str, upload_path: str, payload: ConversionCreate):
-    """Nouvelle fonction de traitement parallèle avec agents multiples"""
+def _claim_conversion(conv_id: str) -> bool:
+    """Réserve l'exécution d'une conversion dans ce processus (False si déjà en cours)"""
+    with _active_lock:
+        if conv_id in _active_conversions:
+            return False
+        _active_conversions.add(conv_id)
+        return True
+
+
+def _run_claimed(conv_id: str, upload_path: str, payload: ConversionCreate, resume: bool = False):
+    # Demandes locales d'une exécution précédente (faite dans un autre processus)
+    conversion_control.clear_local(conv_id)
+    try:
+        _run_conversion_parallel(conv_id, upload_path, payload, resume=resume)
+    finally:
+        conversion_control.clear(conv_id)
+        with _active_lock:
+            _active_conversions.discard(conv_id)
+
+
+def _is_active(conv_id: str) -> bool:
+    """Conversion en file ou en cours d'exécution (ici ou dans un worker)"""
+    with _active_lock:
+        if conv_id in _active_conversions:
+            return True
+    return settings.job_queue_enabled and get_job_queue().active_for(conv_id) is not None
+
+
+def _dispatch(conv_id: str, upload_path: str, payload: ConversionCreate, resume: bool = False,
+              background: BackgroundTasks = None, total_rows: int = 0):
+    """Confie la conversion à la file de travaux, ou l'exécute dans ce processus si la file est désactivée"""
+    if settings.job_queue_enabled:
+        rank = PRIORITY_RANKS[resolve_priority(payload.priority, total_rows)]
+        get_job_queue().enqueue(
+            conv_id, {"upload_path": upload_path, "payload": payload.model_dump(), "resume": resume}, priority=rank
+        )
+        return
+    _claim_conversion(conv_id)
+    if background is not None:
+        background.add_task(_run_claimed, conv_id, upload_path, payload, resume)
+    else:
+        threading.Thread(target=_run_claimed, args=(conv_id, upload_path, payload, resume), daemon=True).start()
+
+
+def run_conversion_job(job: dict):
+    """Exécute un travail de la file (worker) ; renvoie un message d'erreur ou None"""
+    conv_id = job["conversion_id"]
+    data = job["payload"]
+    if not _claim_conversion(conv_id):
+        return "Conversion déjà en cours dans ce processus"
+    # Une nouvelle tentative (worker disparu) repart du checkpoint
+    resume = bool(data.get("resume")) or int(job.get("attempts") or 1) > 1
+    _run_claimed(conv_id, data["upload_path"], ConversionCreate(**data["payload"]), resume=resume)
+    conv = get_conversion_meta(conv_id) or {}
+    return conv.get("error") if conv.get("status") == "error" else None
+
+
+def _checkpoint(conv_id: str, stats: dict) -> dict:
+    """Point de reprise : lignes enregistrées et état du batching"""
+    return {**get_row_checkpoint(conv_id), "batching": stats.get("batching"), "updated_at": time.time()}
+
+
+def _resume_args(conv: dict):
+    """Chemin du fichier source et paramètres d'origine d'une conversion, None si le fichier a disparu"""
+    up = get_upload(conv.get("upload_id") or "")
+    if not up or not os.path.exists(up.get("path", "")):
+        return None
+    return up["path"], ConversionCreate(**(conv.get("meta") or {}))
+
+
+def resume_interrupted_conversions() -> List[str]:
+    """Relance depuis leur checkpoint les conversions interrompues par un arrêt du serveur"""
+    resumed = []
+    for conv_id in list_conversion_ids():
+        conv = get_conversion_meta(conv_id)
+        if not conv or conv.get("status") not in RESUMABLE_STATUSES:
+            continue
+        args = _resume_args(conv)
+        if args is None:
+            update_conversion(conv_id, {"status": "error", "error": "Fichier source introuvable, reprise impossible"})
+            continue
+        if _is_active(conv_id):
+            continue
+        print(f"♻️ Reprise automatique de la conversion {conv_id}")
+        _dispatch(conv_id, *args, resume=True, total_rows=conv.get("total_rows", 0))
+        resumed.append(conv_id)
+    return resumed
+
+
+def _run_conversion_parallel(conv_id: str, upload_path: str, payload: ConversionCreate, resume: bool = False):
+    """Nouvelle fonction de traitement parallèle avec agents multiples
+
+    Avec `resume`, les lignes déjà enregistrées dans le journal de la conversion
+    sont ignorées : seules les lignes restantes sont classées.
+    """
+    stats = {"skipped_empty_label": 0, "errors": 0}
     try:
         print(f"🚀 Démarrage traitement parallèle pour conversion {conv_id}")
         print(f"📁 Fichier: {upload_path}")
@@ -394,7 +544,6 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
         print(f"📚 Dictionnaire NACRE chargé: {len(nacre.entries)} entrées")
         # Préparer tous les éléments à traiter
         all_items = []
-        stats = {"skipped_empty_label": 0, "errors": 0}
         
         # Itérer sur le fichier selon son type
         if upload_path.lower().endswith(".csv"):
@@ -404,6 +553,7 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
         else:
             raise ValueError("Format de fichier non supporté")
         
+        roles = context_roles(payload.context_columns, payload.supplier_column, payload.account_column)
         for i, row in enumerate(iterator):
             if payload.max_rows and i >= payload.max_rows:
                 break
@@ -413,18 +563,11 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
                 stats["skipped_empty_label"] += 1
                 continue
             
-            context = {k: row.get(k) for k in payload.context_columns}
-            
-            # Ne pas faire d'embeddings ici - sera fait en parallèle pour améliorer les performances
-            # Préparer avec des candidats basiques pour l'instant
-            cands = nacre.candidates_advanced(label, context, top_k=settings.max_candidates)
-            if not cands:
-                cands = [NacreEntry(code="ZZ.99", category="Inclassable", keywords=[], aggregated="")]
+            context = row_context(row, payload.context_columns, roles)
             
             all_items.append({
                 "label_text": label,
                 "context": context,
-                "candidates": cands,
                 "row_data": row,
                 "row_index": i
             })
@@ -434,6 +577,43 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
             update_conversion(conv_id, {"status": "completed", "stats": stats})
             return
         
+        # Reprise : ne jamais renvoyer les lignes déjà classées et enregistrées
+        already_done = 0
+        batcher_state = None
+        if resume:
+            committed = committed_row_indices(conv_id)
+            all_items = [item for item in all_items if item["row_index"] not in committed]
+            already_done = total_items - len(all_items)
+            previous = get_conversion_meta(conv_id) or {}
+            batcher_state = (previous.get("checkpoint") or {}).get("batching")
+            stats["resumed_rows"] = already_done
+            stats["resumes"] = int((previous.get("stats") or {}).get("resumes", 0)) + 1
+            print(f"♻️ Reprise de la conversion {conv_id}: {already_done}/{total_items} lignes déjà classées")
+        
+        # Cascade : cache exact, règles, score flou puis modèle local ; seules les lignes
+        # incertaines partent au LLM (avec leurs candidats NACRE)
+        cascade = ClassificationCascade()
+        resolved, llm_items = cascade.run(all_items)
+        local_rows = []
+        local_results = []
+        for item, result in resolved:
+            rc = RowClassification(
+                row_index=item["row_index"],
+                label_raw=item["label_text"],
+                chosen_code=result["chosen_code"],
+                chosen_category=result["chosen_category"],
+                confidence=result["confidence"],
+                alternatives=result["alternatives"],
+                explanation=result["explanation"],
+            )
+            local_rows.append(rc.model_dump())
+            local_results.append(result)
+        append_conversion_rows(conv_id, local_rows)
+        stats["cascade"] = cascade.snapshot()
+        local_done = already_done + len(local_results)
+        print(f"🪜 Cascade: {len(local_results)}/{len(all_items)} lignes classées sans LLM {stats['cascade']}")
+        conversion_control.raise_if_stopped(conv_id)
+        
         # Déterminer le multiplicateur de vitesse basé sur batch_size
         if payload.batch_size <= 8:  # 1x speed
             speed_multiplier = 1
@@ -442,19 +622,26 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
         else:  # 4x speed
             speed_multiplier = 4
         
-        print(f"🚀 Traitement parallèle: {total_items} éléments, vitesse {speed_multiplier}x")
+        # Niveau de priorité auprès de l'ordonnanceur partagé entre conversions
+        priority = resolve_priority(payload.priority, total_items)
+        stats["priority"] = priority
+        
+        print(f"🚀 Traitement parallèle: {total_items} éléments, vitesse {speed_multiplier}x, priorité {priority}")
         
         update_conversion(conv_id, {
             "status": "processing", 
-            "processed_rows": 0, 
+            "processed_rows": local_done, 
             "total_rows": total_items, 
-            "stats": stats
+            "stats": stats,
+            "checkpoint": _checkpoint(conv_id, stats)
         })
+        notify_conversion(conv_id)
         
         # Callback pour le suivi du progrès
         def progress_callback(items_processed: int, total_items_param: int, elapsed_time: float):
-            # items_processed = nombre d'éléments réellement traités
-            # total_items_param = nombre total d'éléments (devrait être égal à total_items)
+            # items_processed = nombre d'éléments traités par les agents
+            # total_items_param = nombre d'éléments envoyés aux agents (hors passe locale)
+            items_processed += local_done
             
             progress_pct = int((items_processed / total_items) * 100) if total_items > 0 else 0
             rate = items_processed / elapsed_time if elapsed_time > 0 else 0
@@ -474,35 +661,57 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
                         "agents_active": f"{speed_multiplier * 2} agents",
                         "progress_pct": f"{progress_pct}%",
                         "elapsed_time": f"{elapsed_time:.1f}s"
-                    }
+                    },
+                    "checkpoint": _checkpoint(conv_id, stats)
                 }
             )
+            # Réveiller les flux SSE : nouvelles lignes et progression
+            notify_conversion(conv_id)
         
         # Traitement parallèle avec agents multiples
-        results = process_conversion_parallel(
-            conv_id=conv_id,
-            all_items=all_items,
-            speed_multiplier=speed_multiplier,
-            progress_callback=progress_callback
-        )
+        results = local_results
+        if llm_items:
+            llm_start = time.time()
+            llm_results = process_conversion_parallel(
+                conv_id=conv_id,
+                all_items=llm_items,
+                speed_multiplier=speed_multiplier,
+                progress_callback=progress_callback,
+                stats=stats,
+                batcher_state=batcher_state,
+                priority=priority
+            )
+            cascade.record_llm(len(llm_items), time.time() - llm_start)
+            stats["cascade"] = cascade.snapshot()
+            cascade.learn(llm_items, llm_results)
+            results = results + llm_results
         
         # Finalisation
         total_time = time.time() - start_time
         final_stats = {
             **stats,
-            "total_processed": len(results),
+            "total_processed": already_done + len(results),
             "processing_time": f"{total_time:.2f}s",
             "average_rate": f"{len(results)/total_time:.1f} items/sec",
             "agents_used": f"{speed_multiplier * 2} agents",
             "parallel_processing": True
         }
+
+        # Instantané colonnaire pour les analyses (CO2, visualisations), puis cube carbone
+        try:
+            write_snapshot(conv_id)
+            get_carbon_cube().refresh(conv_id)
+        except Exception as snapshot_error:
+            print(f"⚠️ Instantané colonnaire non écrit pour {conv_id}: {snapshot_error}")
         
         update_conversion(conv_id, {
             "status": "completed", 
             "processed_rows": total_items, 
             "total_rows": total_items, 
-            "stats": final_stats
+            "stats": final_stats,
+            "checkpoint": _checkpoint(conv_id, final_stats)
         })
+        notify_conversion(conv_id)
         
         # Notification Sophie
         try:
@@ -517,12 +726,25 @@ def _run_conversion_parallel(conv_id: str, upload_path: str, payload: Conversion
         except Exception:
             pass
             
+    except ConversionStopped as stop:
+        # Annulation ou pause : les lignes enregistrées restent consultables
+        checkpoint = _checkpoint(conv_id, stats)
+        update_conversion(conv_id, {
+            "status": stop.status,
+            "control": None,
+            "processed_rows": checkpoint["committed_rows"],
+            "stats": stats,
+            "checkpoint": checkpoint
+        })
+        notify_conversion(conv_id)
+        print(f"⏹️ Conversion {conv_id} {stop.status} après {checkpoint['committed_rows']} lignes")
     except Exception as e:
         print(f"❌ ERREUR CRITIQUE dans traitement parallèle: {e}")
         import traceback
         traceback.print_exc()
         try:
             update_conversion(conv_id, {"status": "error", "error": str(e)})
+            notify_conversion(conv_id)
         except Exception as update_error:
             print(f"❌ Erreur lors de la mise à jour du statut d'erreur: {update_error}")
         # Don't re-raise in background task, just log the error
@@ -538,6 +760,7 @@ def _run_conversion_any(conv_id: str, upload_path: str, payload: ConversionCreat
             clf = get_classifier()
             stats = {"skipped_empty_label": 0, "errors": 0}
             batch = 0
+            roles = context_roles(payload.context_columns, payload.supplier_column, payload.account_column)
             for i, row in enumerate(iterate_xlsx(upload_path)):
                 if payload.max_rows and i >= payload.max_rows:
                     break
@@ -546,7 +769,7 @@ def _run_conversion_any(conv_id: str, upload_path: str, payload: ConversionCreat
                     stats["skipped_empty_label"] += 1
                     update_conversion(conv_id, {"stats": stats})
                     continue
-                context = {k: row.get(k) for k in payload.context_columns}
+                context = row_context(row, payload.context_columns, roles)
                 try:
                     enriched = retrieve_with_embeddings(
                         " | ".join([label] + [f"{k}:{row.get(k)}" for k in payload.context_columns]),
@@ -685,7 +908,7 @@ def get_status(conversion_id: str):
                 stats={"error": "Conversion file not found - background task may have failed"}
             )
         
-        conv = get_conversion(conversion_id)
+        conv = get_conversion_meta(conversion_id)
         if not conv:
             print(f"❌ Conversion data empty or corrupted: {conversion_id}")
             return ConversionStatus(
@@ -698,13 +921,22 @@ def get_status(conversion_id: str):
             )
         
         print(f"✅ Found conversion: status={conv.get('status')}, processed={conv.get('processed_rows', 0)}/{conv.get('total_rows', 0)}")
+        stats = conv.get("stats", {})
+        if settings.job_queue_enabled:
+            job = get_job_queue().status(conversion_id)
+            if job:
+                stats = {**stats, "job": job}
+        # Bilan CO2 courant, tenu à jour pendant la conversion
+        co2 = live_totals(conversion_id)
+        if co2:
+            stats = {**stats, "co2": co2}
         return ConversionStatus(
             conversion_id=conv.get("id"),
             upload_id=conv.get("upload_id"),
             total_rows=conv.get("total_rows", 0),
             processed_rows=conv.get("processed_rows", 0),
-            status=conv.get("status", "unknown"),
-            stats=conv.get("stats", {}),
+            status=conversion_control.control_status(conv) or conv.get("status", "unknown"),
+            stats=stats,
         )
     except Exception as e:
         print(f"❌ Error getting conversion status: {e}")
@@ -721,47 +953,269 @@ def get_status(conversion_id: str):
         )
 
 
-@router.get("/{conversion_id}/rows", response_model=ConversionResult)
-def get_rows(conversion_id: str, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=50000)):
-    conv = get_conversion(conversion_id)
+@router.post("/{conversion_id}/resume", response_model=ConversionStatus)
+def resume_conversion(conversion_id: str, background: BackgroundTasks):
+    """Reprend une conversion interrompue à partir de son checkpoint"""
+    conv = get_conversion_meta(conversion_id)
     if not conv:
         raise HTTPException(status_code=404, detail="Conversion introuvable")
-    rows = conv.get("rows", [])[skip : skip + limit]
-    return ConversionResult(conversion_id=conversion_id, rows=rows)
+    if conv.get("status") == "completed":
+        raise HTTPException(status_code=409, detail="Conversion déjà terminée")
+    if conv.get("status") == "cancelled":
+        raise HTTPException(status_code=409, detail="Conversion annulée")
+    args = _resume_args(conv)
+    if args is None:
+        raise HTTPException(status_code=404, detail="Fichier source introuvable")
+    if _is_active(conversion_id):
+        raise HTTPException(status_code=409, detail="Conversion déjà en cours")
+    conversion_control.clear(conversion_id)
+    conv = update_conversion(conversion_id, {"status": "processing", "control": None})
+    _dispatch(conversion_id, *args, resume=True, background=background, total_rows=conv.get("total_rows", 0))
+    return ConversionStatus(
+        conversion_id=conv.get("id"),
+        upload_id=conv.get("upload_id"),
+        total_rows=conv.get("total_rows", 0),
+        processed_rows=(conv.get("checkpoint") or {}).get("committed_rows", conv.get("processed_rows", 0)),
+        status=conv.get("status", "unknown"),
+        stats=conv.get("stats", {}),
+    )
 
 
-@router.patch("/{conversion_id}/rows/{row_index}", response_model=RowClassification)
-def patch_row(conversion_id: str, row_index: int, payload: RowUpdate):
-    conv = get_conversion(conversion_id)
+def _stop_conversion(conversion_id: str, action: str) -> ConversionStatus:
+    """Annule ou met en pause une conversion : immédiatement si elle attend en file,
+    sinon à la fin du batch en cours (requêtes en vol interrompues)"""
+    conv = get_conversion_meta(conversion_id)
     if not conv:
         raise HTTPException(status_code=404, detail="Conversion introuvable")
-    rows = conv.get("rows", [])
-    target = None
-    for r in rows:
-        if int(r.get("row_index", -1)) == row_index:
-            target = r
-            break
-    if target is None:
-        raise HTTPException(status_code=404, detail="Ligne introuvable")
+    status = conv.get("status")
+    if status in {"completed", "cancelled", "error", "failed"}:
+        raise HTTPException(status_code=409, detail=f"Conversion déjà terminée ({status})")
+    if status == STOP_ACTIONS[action]:
+        return _status_response(conv)
+    if settings.job_queue_enabled:
+        get_job_queue().cancel_queued(conversion_id)
+    if _is_active(conversion_id):
+        conversion_control.request_stop(conversion_id, action)
+        conv = get_conversion_meta(conversion_id) or conv
+    else:
+        # Rien en cours d'exécution (en file, en pause ou interrompue) : arrêt immédiat
+        checkpoint = _checkpoint(conversion_id, conv.get("stats") or {})
+        conv = update_conversion(conversion_id, {
+            "status": STOP_ACTIONS[action],
+            "control": None,
+            "processed_rows": checkpoint["committed_rows"],
+            "checkpoint": checkpoint,
+        })
+    notify_conversion(conversion_id)
+    print(f"⏹️ {action} demandé pour la conversion {conversion_id}")
+    return _status_response(conv)
+
+
+def _status_response(conv: dict) -> ConversionStatus:
+    return ConversionStatus(
+        conversion_id=conv.get("id"),
+        upload_id=conv.get("upload_id"),
+        total_rows=conv.get("total_rows", 0),
+        processed_rows=conv.get("processed_rows", 0),
+        status=conversion_control.control_status(conv) or conv.get("status", "unknown"),
+        stats=conv.get("stats", {}),
+    )
+
+
+@router.post("/{conversion_id}/cancel", response_model=ConversionStatus)
+def cancel_conversion(conversion_id: str):
+    """Annule une conversion ; les lignes déjà classées restent consultables"""
+    return _stop_conversion(conversion_id, "cancel")
+
 
-    # Apply updates
+@router.post("/{conversion_id}/pause", response_model=ConversionStatus)
+def pause_conversion(conversion_id: str):
+    """Met une conversion en pause ; /resume la reprend depuis son checkpoint"""
+    return _stop_conversion(conversion_id, "pause")
+
+
+@router.get("/{conversion_id}/events")
+async def conversion_events(
+    conversion_id: str,
+    request: Request,
+    after: int = Query(0, ge=0),
+    last_event_id: str = Header(None),
+):
+    """Flux SSE de la conversion : progression et lignes enregistrées au fil de l'eau
+
+    `after` (ou l'en-tête Last-Event-ID d'une reconnexion) saute les lignes déjà reçues.
+    """
+    if not get_conversion_meta(conversion_id):
+        raise HTTPException(status_code=404, detail="Conversion introuvable")
+    if last_event_id and last_event_id.isdigit():
+        after = max(after, int(last_event_id))
+    return StreamingResponse(
+        conversion_event_stream(conversion_id, after, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{conversion_id}/rows", response_model=ConversionResult)
+def get_rows(
+    conversion_id: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=50000),
+    after: int = Query(None, ge=0),
+):
+    """Lignes classées d'une conversion
+
+    Avec `after` (curseur `next_cursor` de la réponse précédente, 0 au départ), seules
+    les lignes enregistrées depuis sont lues : rafraîchir une vue en direct ne coûte
+    que le delta.
+    """
+    if not get_conversion_meta(conversion_id):
+        raise HTTPException(status_code=404, detail="Conversion introuvable")
+    if after is not None:
+        rows, has_more = get_conversion_rows_after(conversion_id, after, limit)
+        next_cursor = int(rows[-1].get("seq", after)) if rows else after
+        return ConversionResult(conversion_id=conversion_id, rows=rows, next_cursor=next_cursor, has_more=has_more)
+    all_rows = get_conversion_rows(conversion_id)
+    rows = all_rows[skip : skip + limit]
+    return ConversionResult(
+        conversion_id=conversion_id,
+        rows=rows,
+        next_cursor=int(rows[-1].get("seq", 0)) if rows else None,
+        has_more=skip + limit < len(all_rows),
+    )
+
+
+def _row_changes(target: dict, payload: RowUpdate) -> dict:
+    """Champs modifiés d'une ligne pour une correction"""
+    changes = {}
     if payload.chosen_code:
-        target["chosen_code"] = payload.chosen_code
+        changes["chosen_code"] = payload.chosen_code
         # If category not supplied, try to infer from alternatives or keep
         if not payload.chosen_category:
             alts = target.get("alternatives", [])
             found = next((a for a in alts if a.get("code") == payload.chosen_code), None)
             if found:
-                target["chosen_category"] = found.get("category", target.get("chosen_category", ""))
+                changes["chosen_category"] = found.get("category", target.get("chosen_category", ""))
     if payload.chosen_category:
-        target["chosen_category"] = payload.chosen_category
+        changes["chosen_category"] = payload.chosen_category
     if payload.confidence is not None:
-        c = max(0, min(100, int(payload.confidence)))
-        target["confidence"] = c
+        changes["confidence"] = max(0, min(100, int(payload.confidence)))
+    return changes
+
+
+@router.patch("/{conversion_id}/rows/{row_index}", response_model=RowClassification)
+def patch_row(conversion_id: str, row_index: int, payload: RowUpdate):
+    if not get_conversion_meta(conversion_id):
+        raise HTTPException(status_code=404, detail="Conversion introuvable")
+    target = get_conversion_row(conversion_id, row_index)
+    if target is None:
+        raise HTTPException(status_code=404, detail="Ligne introuvable")
 
-    # Persist
-    conv["rows"] = rows
-    update_conversion(conversion_id, {"rows": rows})
-    # Return as RowClassification
+    # Persist as a keyed correction (append to the edits log)
+    changes = _row_changes(target, payload)
+    if changes:
+        target = patch_conversion_rows(conversion_id, {row_index: changes})[0]
+        notify_conversion(conversion_id)
     return RowClassification(**target)
 
+
+@router.patch("/{conversion_id}/rows", response_model=ConversionResult)
+def patch_rows(conversion_id: str, payload: RowsUpdate):
+    """Corrige plusieurs lignes en une écriture ; renvoie les lignes modifiées"""
+    if not get_conversion_meta(conversion_id):
+        raise HTTPException(status_code=404, detail="Conversion introuvable")
+    changes = {}
+    missing = []
+    for edit in payload.edits:
+        target = get_conversion_row(conversion_id, edit.row_index)
+        if target is None:
+            missing.append(edit.row_index)
+            continue
+        # Plusieurs corrections d'une même ligne : la dernière l'emporte
+        changes[edit.row_index] = {**changes.get(edit.row_index, {}), **_row_changes(target, edit)}
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Lignes introuvables: {missing[:20]}")
+    rows = patch_conversion_rows(conversion_id, changes)
+    notify_conversion(conversion_id)
+    return ConversionResult(conversion_id=conversion_id, rows=rows)
+
+
+def _source_contexts(conv: dict, indices: set) -> dict:
+    """Colonnes de contexte (fournisseur, compte...) des lignes source demandées"""
+    up = get_upload(conv.get("upload_id") or "")
+    meta = conv.get("meta") or {}
+    columns = meta.get("context_columns") or []
+    roles = context_roles(columns, meta.get("supplier_column"), meta.get("account_column"))
+    if not indices or not columns or not up or not os.path.exists(up.get("path", "")):
+        return {}
+    path = up["path"]
+    iterator = iterate_xlsx(path) if path.lower().endswith(".xlsx") else iterate_csv(path)
+    last = max(indices)
+    contexts = {}
+    for i, row in enumerate(iterator):
+        if i > last:
+            break
+        if i in indices:
+            contexts[i] = row_context(row, columns, roles)
+    return contexts
+
+
+@router.post("/{conversion_id}/rows/bulk-correct", response_model=BulkCorrectionResult)
+def bulk_correct_rows(conversion_id: str, payload: BulkCorrection):
+    """Applique un même code à toutes les lignes qui vérifient un prédicat
+
+    Les corrections sont enregistrées en une seule écriture, puis apprises une fois
+    (règles fournisseur/compte et cache de libellés de la cascade).
+    """
+    conv = get_conversion_meta(conversion_id)
+    if not conv:
+        raise HTTPException(status_code=404, detail="Conversion introuvable")
+    if not (payload.label_pattern or payload.supplier or payload.current_code):
+        raise HTTPException(status_code=400, detail="Au moins un critère est requis (label_pattern, supplier, current_code)")
+    try:
+        pattern = re.compile(payload.label_pattern, re.IGNORECASE) if payload.label_pattern else None
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Expression invalide: {e}")
+    entry = get_nacre_dict().get(payload.chosen_code)
+    code = entry.code if entry else payload.chosen_code.strip().upper()
+    category = payload.chosen_category or (entry.category if entry else None)
+    if not category:
+        raise HTTPException(status_code=400, detail=f"Code NACRE inconnu: {payload.chosen_code}")
+    current = get_nacre_dict().get(payload.current_code) if payload.current_code else None
+    current_code = current.code if current else (payload.current_code or "").strip().upper()
+
+    matched = [
+        r for r in get_conversion_rows(conversion_id)
+        if (pattern is None or pattern.search(r.get("label_raw") or ""))
+        and (not current_code or (r.get("chosen_code") or "").strip().upper() == current_code)
+    ]
+    contexts = _source_contexts(conv, {int(r["row_index"]) for r in matched})
+    if payload.supplier:
+        wanted = supplier_of({"supplier": payload.supplier})
+        matched = [r for r in matched if supplier_of(contexts.get(int(r["row_index"]), {})) == wanted]
+
+    indices = [int(r["row_index"]) for r in matched]
+    updated = 0
+    if matched and not payload.dry_run:
+        correction = {"chosen_code": code, "chosen_category": category, "confidence": payload.confidence}
+        changes = {
+            int(r["row_index"]): correction for r in matched
+            if any(r.get(k) != v for k, v in correction.items())
+        }
+        if changes:
+            updated = len(patch_conversion_rows(conversion_id, changes))
+            # Une seule observation par couple fournisseur/compte : la correction groupée
+            # est une décision, pas autant d'exemples que de lignes (déjà corrigées exclues)
+            observed = {}
+            for idx in changes:
+                context = contexts.get(idx, {})
+                observed.setdefault((supplier_of(context), account_of(context)), context)
+            update_patterns_many([(context, code, payload.confidence) for context in observed.values()])
+            get_label_cache().learn([
+                ({"label_text": r.get("label_raw", ""), "context": contexts.get(int(r["row_index"]), {})}, code, payload.confidence)
+                for r in matched if int(r["row_index"]) in changes
+            ])
+            notify_conversion(conversion_id)
+        print(f"✏️ Correction groupée {conversion_id}: {updated}/{len(indices)} lignes -> {code}")
+    return BulkCorrectionResult(conversion_id=conversion_id, matched=len(indices), updated=updated, row_indices=indices[:100])
+
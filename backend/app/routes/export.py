@@ -1,12 +1,14 @@
-from io import StringIO
-import csv
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 
+from ..config import settings
 from ..models import ExportCreate
-from ..services.storage import get_conversion, get_upload
+from ..services.storage import get_conversion_meta, get_upload
 from ..services.csv_io import iterate_csv
 from ..services.xlsx_io import iterate_xlsx
+from ..services.exports import (
+    EXPORT_FORMATS, export_table, csv_chunks, gzip_chunks, xlsx_chunks, parquet_chunks, parquet_available,
+)
 
 
 router = APIRouter()
@@ -14,7 +16,7 @@ router = APIRouter()
 
 @router.post("", response_class=StreamingResponse)
 def export_csv(payload: ExportCreate):
-    conv = get_conversion(payload.conversion_id)
+    conv = get_conversion_meta(payload.conversion_id)
     if not conv:
         raise HTTPException(status_code=404, detail="Conversion introuvable")
     up = get_upload(conv.get("upload_id"))
@@ -23,16 +25,10 @@ def export_csv(payload: ExportCreate):
     up_path = up.get("path")
     if not up_path:
         raise HTTPException(status_code=400, detail="Chemin upload manquant")
+    if payload.format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="Export Parquet indisponible (pyarrow non installé)")
 
-    # Build a map from row_index -> classification info
-    by_idx = {int(r.get("row_index", i)): r for i, r in enumerate(conv.get("rows", []))}
-
-    # Prepare CSV output in memory
-    buf = StringIO()
-    writer = None
-
-    # Iterate original CSV and write selected columns + classification
-    iterator = None
+    # Original file re-read row by row, joined with the classification rows
     if up_path.lower().endswith('.csv'):
         iterator = iterate_csv(up_path)
     elif up_path.lower().endswith('.xlsx'):
@@ -40,29 +36,17 @@ def export_csv(payload: ExportCreate):
     else:
         raise HTTPException(status_code=400, detail="Format non supporté (CSV/XLSX)")
 
-    for i, row in enumerate(iterator):
-        out = {}
-        for col in payload.columns_to_keep:
-            if col in row:
-                out[col] = row[col]
-        if payload.include_classification:
-            cls = by_idx.get(i)
-            if cls:
-                pref = payload.classification_prefix
-                out[f"{pref}code"] = cls.get("chosen_code", "")
-                out[f"{pref}category"] = cls.get("chosen_category", "")
-                out[f"{pref}confidence"] = cls.get("confidence", "")
-        if writer is None:
-            # Initialize with discovered headers (stable order: input cols then cls)
-            headers = list(out.keys())
-            writer = csv.DictWriter(buf, fieldnames=headers)
-            writer.writeheader()
-        writer.writerow(out)
-
-    filename = f"export_{payload.conversion_id}.csv"
-    buf.seek(0)
-    return StreamingResponse(
-        buf,
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename={filename}"},
-    )
+    table = export_table(iterator, payload)
+    if payload.format == "xlsx":
+        chunks = xlsx_chunks(table)
+    elif payload.format == "parquet":
+        chunks = parquet_chunks(table, payload)
+    else:
+        chunks = csv_chunks(table, max(1024, settings.export_chunk_bytes))
+    media_type, ext = EXPORT_FORMATS[payload.format]
+    filename = f"export_{payload.conversion_id}.{ext}"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    if payload.gzip:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
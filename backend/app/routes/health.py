@@ -11,6 +11,7 @@ from ..services.embeddings import index_status
 from ..services.sophie import initialize_sophie, sophie_status
 from ..services.document_access import invalidate_document_cache
 from ..services.co2_analyzer import co2_analyzer
+from ..services.job_queue import get_job_queue
 
 
 class HealthResponse(BaseModel):
@@ -25,6 +26,7 @@ class HealthResponse(BaseModel):
     learning: dict
     sophie: dict
     co2_analyzer: dict
+    jobs: dict = {}
 
 
 router = APIRouter()
@@ -76,6 +78,14 @@ def health() -> HealthResponse:
     except Exception as e:
         co2_status = {"status": "error", "error": str(e)}
 
+    # Job queue counters (queued, running, done, failed)
+    jobs = {}
+    if settings.job_queue_enabled:
+        try:
+            jobs = get_job_queue().counts()
+        except Exception as e:
+            jobs = {"error": str(e)}
+
     return HealthResponse(
         ok=overall_ok,
         api=api_ok,
@@ -88,6 +98,7 @@ def health() -> HealthResponse:
         learning=index_status(),
         sophie=sophie_status(),
         co2_analyzer=co2_status,
+        jobs=jobs,
     )
 
 
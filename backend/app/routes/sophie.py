@@ -1,5 +1,6 @@
 ﻿from fastapi import APIRouter
 from fastapi import UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Any, Dict, Optional
 
@@ -10,6 +11,7 @@ from ..services.embeddings import index_status
 from ..services.csv_io import preview_csv, iterate_csv, count_csv_rows
 from ..services.patterns import update_patterns
 from ..services.document_access import get_document_access, sophie_get_context
+from ..services.local_classifier import get_local_classifier, retrain_local_classifier
 from ..config import settings
 import threading
 import json
@@ -361,6 +363,9 @@ def _train_worker(path: str, mapping: Dict[str, Optional[str]]):
         print(f"Training worker error: {e}")
         errors += 1
     finally:
+        # Ré-entraîner le modèle local avec les nouveaux exemples
+        if processed > 0 and settings.local_model_enabled:
+            training_state["local_model"] = retrain_local_classifier()
         training_state.update({
             "in_progress": False, 
             "path": None,
@@ -455,6 +460,7 @@ def sophie_train_status():
         "codes_count": training_state.get("codes_count", {}),
         "mapping": training_state.get("mapping", {}),
         "canceled": training_state.get("cancel", False),
+        "local_model": training_state.get("local_model"),
     }
     
     # Add debug information
@@ -558,11 +564,16 @@ async def sophie_train_legacy(file: UploadFile = File(...), mapping_json: Option
                     logger.error(f"Error processing row: {e}")
         
         logger.info(f"Legacy training completed: {processed} rows processed, {errors} errors")
+        # Entraînement hors de la boucle d'événements : il peut durer plusieurs secondes
+        local_model = (
+            await run_in_threadpool(retrain_local_classifier) if processed > 0 and settings.local_model_enabled else None
+        )
         return {
             "rows_processed": processed,
             "errors": errors,
             "codes_count": code_counts,
-            "detected_columns": mapping
+            "detected_columns": mapping,
+            "local_model": local_model
         }
         
     except HTTPException:
@@ -572,6 +583,21 @@ async def sophie_train_legacy(file: UploadFile = File(...), mapping_json: Option
         raise HTTPException(status_code=500, detail=f"Erreur interne: {str(e)}")
 
 
+@router.get("/train/local-model")
+def sophie_local_model_status():
+    """État du modèle local entraîné sur training.jsonl"""
+    return get_local_classifier().status()
+
+
+@router.post("/train/local-model")
+def sophie_local_model_retrain():
+    """Ré-entraîne le modèle local à partir de tous les exemples d'apprentissage"""
+    result = retrain_local_classifier()
+    if not result.get("trained"):
+        raise HTTPException(status_code=400, detail=result.get("reason", "Entraînement impossible"))
+    return result
+
+
 @router.post("/agentic-action")
 def execute_agentic_action(action_input: AgenticActionInput):
     """Execute autonomous agentic actions"""
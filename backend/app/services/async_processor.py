@@ -10,17 +10,25 @@ from concurrent.futures import ThreadPoolExecutor
 import logging
 
 from ..config import settings
+from .batching import TokenBudgetBatcher, estimate_tokens
+from .conversion_control import ConversionStopped, on_stop, raise_if_stopped, stop_requested
 
 logger = logging.getLogger(__name__)
 
 class AsyncNACREProcessor:
     """Processeur asynchrone pour l'analyse NACRE en parallèle"""
     
-    def __init__(self, max_concurrent_requests: int = 5, max_retries: int = 3):
+    def __init__(self, max_concurrent_requests: int = 5, max_retries: int = 3, batcher: Optional[TokenBudgetBatcher] = None,
+                 conv_id: Optional[str] = None):
         self.max_concurrent_requests = max_concurrent_requests
+        self.conv_id = conv_id
         self.max_retries = max_retries
         self.session: Optional[aiohttp.ClientSession] = None
         self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self.batcher = batcher or TokenBudgetBatcher(
+            model=settings.openai_model,
+            system_prompt_tokens=estimate_tokens(self._get_batch_system_prompt()),
+        )
         
     async def __aenter__(self):
         """Initialiser la session HTTP asynchrone"""
@@ -53,6 +61,10 @@ class AsyncNACREProcessor:
     async def _classify_batch_async(self, batch_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Classifier un batch de manière asynchrone"""
         async with self.semaphore:
+            # Arrêt demandé pendant l'attente : ne pas lancer la requête
+            if self.conv_id:
+                raise_if_stopped(self.conv_id)
+            
             # Préparer le prompt pour le batch
             batch_prompt = self._build_batch_prompt(batch_data)
             
@@ -69,18 +81,26 @@ class AsyncNACREProcessor:
                     }
                 ],
                 "temperature": 0.1,
-                "max_tokens": 4000
+                "max_tokens": self.batcher.max_tokens_for(batch_data)
             }
             
             for attempt in range(self.max_retries):
                 try:
+                    started = time.time()
                     async with self.session.post(
                         'https://api.openai.com/v1/chat/completions',
                         json=payload
                     ) as response:
                         if response.status == 200:
                             result = await response.json()
-                            content = result['choices'][0]['message']['content']
+                            choice = result['choices'][0]
+                            self.batcher.observe({
+                                "rows": len(batch_data),
+                                "latency": time.time() - started,
+                                "truncated": choice.get('finish_reason') == 'length',
+                                "completion_tokens": (result.get('usage') or {}).get('completion_tokens'),
+                            })
+                            content = choice['message']['content']
                             return self._parse_batch_response(content, len(batch_data))
                         else:
                             error_text = await response.text()
@@ -206,15 +226,24 @@ Répondez UNIQUEMENT avec le JSON demandé, sans texte supplémentaire."""
         all_batches: List[List[Dict[str, Any]]], 
         progress_callback=None
     ) -> List[List[Dict[str, Any]]]:
-        """Traiter plusieurs batches en parallèle"""
+        """Traiter plusieurs batches en parallèle
+        
+        Lève ConversionStopped si la conversion est annulée ou mise en pause ; ses
+        `results` contiennent les batches terminés (None pour les autres).
+        """
         start_time = time.time()
         
         # Créer les tâches asynchrones
         tasks = [
-            self._classify_batch_async(batch) 
+            asyncio.ensure_future(self._classify_batch_async(batch))
             for batch in all_batches
         ]
         
+        # Un arrêt annule les tâches : les requêtes HTTP en vol sont interrompues
+        if self.conv_id:
+            loop = asyncio.get_running_loop()
+            on_stop(self.conv_id, lambda: loop.call_soon_threadsafe(lambda: [t.cancel() for t in tasks]))
+        
         # Exécuter en parallèle avec suivi du progrès
         results = []
         completed = 0
@@ -229,11 +258,20 @@ Répondez UNIQUEMENT avec le JSON demandé, sans texte supplémentaire."""
                     elapsed = time.time() - start_time
                     progress_callback(completed, len(tasks), elapsed)
                     
+            except (ConversionStopped, asyncio.CancelledError):
+                completed += 1
             except Exception as e:
                 logger.error(f"Batch processing failed: {e}")
                 results.append([])  # Batch vide en cas d'erreur
                 completed += 1
         
+        stopped = stop_requested(self.conv_id, check_storage=False) if self.conv_id else None
+        if stopped:
+            raise ConversionStopped(stopped, [
+                t.result() if t.done() and not t.cancelled() and t.exception() is None else None
+                for t in tasks
+            ])
+        
         # Réorganiser les résultats dans l'ordre original
         # (asyncio.as_completed ne garantit pas l'ordre)
         ordered_results = []
@@ -261,19 +299,33 @@ def create_batches(items: List[Any], batch_size: int) -> List[List[Any]]:
 async def process_conversion_async(
     conv_id: str,
     all_items: List[Dict[str, Any]], 
-    batch_size: int = 8,
+    batch_size: Optional[int] = None,
     max_concurrent: int = 5,
     progress_callback=None
 ) -> List[Dict[str, Any]]:
-    """Point d'entrée principal pour le traitement asynchrone"""
+    """Point d'entrée principal pour le traitement asynchrone
+    
+    Les batches sont constitués selon le budget de tokens ; `batch_size`
+    plafonne seulement le nombre de lignes par requête.
+    """
     
     # Créer les batches
-    batches = create_batches(all_items, batch_size)
-    logger.info(f"Created {len(batches)} batches of size {batch_size}")
+    processor = AsyncNACREProcessor(max_concurrent_requests=max_concurrent, conv_id=conv_id)
+    if batch_size:
+        processor.batcher.max_rows = processor.batcher.row_cap = batch_size
+    batches = processor.batcher.pack(all_items)
+    logger.info(f"Created {len(batches)} token-budgeted batches for {len(all_items)} items")
     
     # Traitement parallèle
-    async with AsyncNACREProcessor(max_concurrent_requests=max_concurrent) as processor:
-        batch_results = await processor.process_batches_parallel(batches, progress_callback)
+    async with processor:
+        try:
+            batch_results = await processor.process_batches_parallel(batches, progress_callback)
+        except ConversionStopped as stop:
+            # Résultats partiels alignés sur all_items (None = ligne non traitée)
+            partial = []
+            for batch, result in zip(batches, stop.results or []):
+                partial.extend(result if result else [None] * len(batch))
+            raise ConversionStopped(stop.action, partial)
     
     # Aplatir les résultats
     all_results = []
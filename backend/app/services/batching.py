@@ -0,0 +1,184 @@
+"""
+Constitution adaptative des batches de classification selon un budget de tokens
+"""
+import math
+import threading
+from typing import Any, Dict, List, Optional
+
+from ..config import settings, get_model_limits
+
+
+# Le français tokenise autour de 3.5 caractères par token
+CHARS_PER_TOKEN = 3.5
+# En-tête "LIGNE n:", libellés de champs et séparateurs par ligne du prompt batch
+ROW_OVERHEAD_TOKENS = 20
+# Marge appliquée à l'estimation des tokens de réponse
+COMPLETION_SAFETY = 1.3
+# Nombre de candidats envoyés par ligne dans le prompt batch
+BATCH_CANDIDATES = 8
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimation rapide du nombre de tokens d'un texte (sans tokenizer)"""
+    return max(1, math.ceil(len(text or "") / CHARS_PER_TOKEN))
+
+
+def estimate_item_prompt_tokens(item: Dict[str, Any], max_candidates: int = BATCH_CANDIDATES) -> int:
+    """Estime le coût en tokens d'une ligne dans le prompt batch"""
+    parts = [str(item.get("label_text", ""))]
+    for k, v in (item.get("context") or {}).items():
+        if v:
+            parts.append(f"{k}: {v}")
+    for c in (item.get("candidates") or [])[:max_candidates]:
+        parts.append(f"  - {c.code}: {c.category}")
+    return estimate_tokens("\n".join(parts)) + ROW_OVERHEAD_TOKENS
+
+
+class TokenBudgetBatcher:
+    """
+    Regroupe les lignes en requêtes selon les tokens estimés du prompt et de la réponse.
+
+    La taille maximale de batch s'adapte aux observations : une réponse tronquée
+    (finish_reason == "length") divise le plafond par deux, une latence au-dessus
+    de la cible le réduit, une latence confortable l'augmente progressivement.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        system_prompt_tokens: int = 0,
+        target_prompt_tokens: Optional[int] = None,
+        completion_tokens_per_row: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        min_rows: Optional[int] = None,
+        target_latency: Optional[float] = None,
+    ):
+        limits = get_model_limits(model)
+        self.model = model
+        self.context_window = limits["context"]
+        self.max_output_tokens = limits["max_output"]
+        self.system_prompt_tokens = system_prompt_tokens
+        self.target_prompt_tokens = target_prompt_tokens or settings.batch_target_prompt_tokens
+        self.completion_tokens_per_row = float(completion_tokens_per_row or settings.batch_completion_tokens_per_row)
+        self.max_rows = max(1, max_rows or settings.batch_max_rows)
+        self.min_rows = max(1, min(self.max_rows, min_rows or settings.batch_min_rows))
+        self.target_latency = target_latency or settings.batch_target_latency
+        # Plafond courant, ajusté au fil des observations
+        self.row_cap = self.max_rows
+        self.lock = threading.Lock()
+        self.observations = 0
+        self.truncations = 0
+        self.total_latency = 0.0
+
+    def _prompt_budget(self) -> int:
+        # La cible porte sur la partie propre aux lignes (le préfixe système est mis en cache),
+        # mais le prompt complet et la réponse doivent tenir dans la fenêtre du modèle
+        room = self.context_window - self.system_prompt_tokens - self.max_output_tokens
+        return max(1, min(self.target_prompt_tokens, room))
+
+    def _completion_rows_limit(self) -> int:
+        per_row = self.completion_tokens_per_row * COMPLETION_SAFETY
+        return max(1, int(self.max_output_tokens // per_row))
+
+    def plan_batch(self, items: List[Dict[str, Any]], start: int = 0, limit: Optional[int] = None) -> int:
+        """Retourne l'indice de fin (exclu) du prochain batch commençant à `start`
+
+        `limit` plafonne en plus le nombre de lignes (ex. pour répartir un petit
+        fichier sur tous les agents disponibles).
+        """
+        with self.lock:
+            row_cap = min(self.row_cap, self._completion_rows_limit())
+            budget = self._prompt_budget()
+        if limit:
+            row_cap = min(row_cap, limit)
+        used = 0
+        end = start
+        while end < len(items) and end - start < row_cap:
+            cost = estimate_item_prompt_tokens(items[end])
+            if end > start and used + cost > budget:
+                break
+            used += cost
+            end += 1
+        return max(end, min(start + 1, len(items)))
+
+    def share_limit(self, remaining: int, workers: int) -> Optional[int]:
+        """Plafond de lignes pour répartir la fin d'une conversion sur `workers` agents
+
+        None tant qu'il reste de quoi remplir un batch complet par agent ; ensuite
+        les lignes restantes sont partagées, sans descendre sous min_rows.
+        """
+        with self.lock:
+            row_cap = min(self.row_cap, self._completion_rows_limit())
+        if remaining >= workers * row_cap:
+            return None
+        return max(self.min_rows, -(-remaining // max(1, workers)))
+
+    def pack(self, items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Découpe toute la liste en batches selon l'état courant du batcher"""
+        batches = []
+        start = 0
+        while start < len(items):
+            end = self.plan_batch(items, start)
+            batches.append(items[start:end])
+            start = end
+        return batches
+
+    def max_tokens_for(self, batch: List[Dict[str, Any]]) -> int:
+        """Valeur de max_tokens à demander pour un batch donné"""
+        with self.lock:
+            estimate = len(batch) * self.completion_tokens_per_row * COMPLETION_SAFETY
+        return int(min(self.max_output_tokens, math.ceil(estimate) + 64))
+
+    def observe(self, meta: Dict[str, Any]) -> None:
+        """
+        Met à jour le plafond à partir d'une réponse observée.
+
+        `meta` contient "rows", "latency", "truncated" et, si l'API les fournit,
+        "completion_tokens" et "parsed". "capped" indique un batch réduit par la
+        répartition de fin de conversion : il compte comme un batch plein.
+        """
+        rows = int(meta.get("rows") or 0)
+        if rows <= 0:
+            return
+        latency = float(meta.get("latency") or 0.0)
+        with self.lock:
+            self.observations += 1
+            self.total_latency += latency
+            if meta.get("truncated"):
+                self.truncations += 1
+                self.row_cap = max(1, min(self.row_cap, rows) // 2)
+                # La réponse a dépassé l'estimation : relever le coût par ligne
+                self.completion_tokens_per_row *= 1.25
+                return
+            completion_tokens = meta.get("completion_tokens")
+            if completion_tokens:
+                observed = completion_tokens / rows
+                self.completion_tokens_per_row = 0.8 * self.completion_tokens_per_row + 0.2 * observed
+            if latency > self.target_latency * 1.5:
+                self.row_cap = max(1, int(self.row_cap * 0.75))
+            elif latency < self.target_latency and (rows >= self.row_cap or meta.get("capped")):
+                self.row_cap = min(self.max_rows, self.row_cap + max(1, self.row_cap // 4))
+
+    def restore(self, state: Optional[Dict[str, Any]]) -> None:
+        """Reprend le plafond et le coût par ligne d'un état sauvegardé (reprise de conversion)"""
+        if not state:
+            return
+        with self.lock:
+            if state.get("row_cap"):
+                self.row_cap = max(1, min(self.max_rows, int(state["row_cap"])))
+            if state.get("completion_tokens_per_row"):
+                self.completion_tokens_per_row = float(state["completion_tokens_per_row"])
+
+    def snapshot(self) -> Dict[str, Any]:
+        """État du batcher pour les statistiques de conversion"""
+        with self.lock:
+            avg_latency = self.total_latency / self.observations if self.observations else 0.0
+            return {
+                "row_cap": self.row_cap,
+                "max_rows": self.max_rows,
+                "completion_tokens_per_row": round(self.completion_tokens_per_row, 1),
+                "prompt_budget_tokens": self._prompt_budget(),
+                "requests": self.observations,
+                "truncated_requests": self.truncations,
+                "avg_latency": f"{avg_latency:.2f}s",
+            }
@@ -0,0 +1,250 @@
+"""
+Cube carbone multi-entités et multi-périodes
+
+Chaque conversion est réduite, depuis son instantané colonnaire, à quelques
+cellules (code NACRE, catégorie) -> montant, CO2, lignes, rangées sous l'entité
+et la période de ses métadonnées (ConversionCreate.entity / period). Les
+cellules de toutes les conversions forment un petit cube persisté dans
+db/carbon_cube.json : consolidations et drill-downs (entité × période × code ×
+catégorie) sont calculés sur le cube, sans relire les lignes.
+
+Une conversion terminée met à jour sa seule entrée ; une entrée dont le journal
+des lignes (corrections) ou les facteurs d'émission ont changé depuis est
+recalculée à la requête suivante,
+de même qu'une conversion terminée absente du cube (mise à jour de fin de
+conversion en échec). Les conversions sans montants sont notées avec leur
+version pour ne pas être relues à chaque requête. Les écritures du fichier sont
+sérialisées entre processus (API et workers) par un fichier verrou.
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from ..config import settings
+from ..utils.file_lock import file_lock
+from .co2_analyzer import co2_analyzer, normalize_code
+from .columnar import load_snapshot
+from .nacre_categorization import get_categorizer
+from .storage import get_conversion_meta, list_conversion_ids, rows_version
+
+
+CUBE_DIMENSIONS = ["entity", "period", "code", "category"]
+CUBE_MEASURES = ["montant", "co2_kg", "lines"]
+# Valeur de regroupement des conversions sans entité ou sans période
+UNSPECIFIED = "(non renseigné)"
+
+
+def _data_version(conv_id: str) -> str:
+    """Version des cellules d'une conversion : journal des lignes et facteurs d'émission"""
+    return f"{rows_version(conv_id)}|{co2_analyzer.emission_version()}"
+
+
+class CarbonCube:
+    """Cube entité × période × code × catégorie, indexé par conversion"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Conversions sans cellules (pas de montants) -> version du journal examinée
+        self.skipped: Dict[str, str] = {}
+        self.stamp: Optional[tuple] = None
+        self._frame: Optional[pd.DataFrame] = None
+
+    def _path(self) -> str:
+        return os.path.join(settings.storage_dir, "db", "carbon_cube.json")
+
+    def _file_lock(self):
+        """Verrou inter-processus des lectures-modifications-écritures du fichier"""
+        os.makedirs(os.path.dirname(self._path()), exist_ok=True)
+        return file_lock(f"{self._path()}.lock")
+
+    def _load(self) -> None:
+        """Recharge le cube si un autre processus l'a réécrit (verrou tenu)"""
+        try:
+            st = os.stat(self._path())
+        except OSError:
+            return
+        # Chaque écriture remplace le fichier : l'inode change même à mtime égale
+        stamp = (st.st_ino, st.st_mtime_ns)
+        if stamp == self.stamp:
+            return
+        try:
+            with open(self._path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.entries = data.get("conversions", {})
+        self.skipped = data.get("skipped", {})
+        self.stamp = stamp
+        self._frame = None
+
+    def _save(self) -> None:
+        path = self._path()
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"conversions": self.entries, "skipped": self.skipped}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        st = os.stat(path)
+        self.stamp = (st.st_ino, st.st_mtime_ns)
+        self._frame = None
+
+    def _entry(self, conv_id: str) -> Optional[Dict[str, Any]]:
+        """Cellules d'une conversion ; None si elle n'existe pas, sans "cells" si elle n'a pas de montants"""
+        conv = get_conversion_meta(conv_id)
+        if conv is None:
+            return None
+        meta = conv.get("meta") or {}
+        version = _data_version(conv_id)
+        df = load_snapshot(conv_id, ["code", "co2_kg", "amount"])
+        if df is None or not df["co2_kg"].notna().any():
+            return {"version": version}
+        priced = df[df["co2_kg"].notna()]
+        grouped = priced.groupby("code", sort=False).agg(
+            montant=("amount", "sum"), co2_kg=("co2_kg", "sum"), lines=("co2_kg", "size"),
+        )
+        categorizer = get_categorizer()
+        cells = []
+        for code, montant, co2_kg, lines in grouped.itertuples():
+            entry = co2_analyzer.emission_index.get(normalize_code(code)) or {}
+            category = categorizer.categorize_code(code, entry.get("description", ""))
+            cells.append([code, category, float(montant), float(co2_kg), int(lines)])
+        return {
+            "entity": meta.get("entity") or UNSPECIFIED,
+            "period": meta.get("period") or UNSPECIFIED,
+            "version": version,
+            "unpriced_lines": int(len(df) - len(priced)),
+            "cells": cells,
+        }
+
+    def _set(self, conv_id: str, entry: Optional[Dict[str, Any]]) -> None:
+        """Range l'entrée calculée (verrous tenus)"""
+        self.entries.pop(conv_id, None)
+        self.skipped.pop(conv_id, None)
+        if entry is None:
+            return
+        if "cells" in entry:
+            self.entries[conv_id] = entry
+        else:
+            self.skipped[conv_id] = entry["version"]
+
+    def refresh(self, conv_id: str) -> bool:
+        """Met à jour l'entrée d'une conversion (à la fin de la conversion) ; False si elle est retirée"""
+        entry = self._entry(conv_id)
+        with self.lock, self._file_lock():
+            self._load()
+            self._set(conv_id, entry)
+            self._save()
+            return conv_id in self.entries
+
+    def rebuild(self) -> int:
+        """Reconstruit le cube depuis toutes les conversions enregistrées"""
+        computed = {conv_id: self._entry(conv_id) for conv_id in list_conversion_ids()}
+        with self.lock, self._file_lock():
+            self.entries, self.skipped = {}, {}
+            for conv_id, entry in computed.items():
+                self._set(conv_id, entry)
+            self._save()
+            return len(self.entries)
+
+    def _missing(self) -> List[str]:
+        """Conversions terminées sans entrée, ou sans montants lors du dernier examen mais modifiées depuis"""
+        missing = []
+        for conv_id in list_conversion_ids():
+            if conv_id in self.entries or self.skipped.get(conv_id) == _data_version(conv_id):
+                continue
+            if (get_conversion_meta(conv_id) or {}).get("status") == "completed":
+                missing.append(conv_id)
+        return missing
+
+    def _refresh_stale(self) -> None:
+        """Recalcule les entrées dont le journal des lignes a changé (corrections) et indexe les absentes"""
+        if not os.path.exists(self._path()):
+            # Premier usage : indexer les conversions existantes
+            self.rebuild()
+            return
+        with self.lock:
+            self._load()
+            stale = [cid for cid, e in self.entries.items() if e.get("version") != _data_version(cid)]
+            stale += self._missing()
+        for conv_id in stale:
+            self.refresh(conv_id)
+
+    def frame(self) -> pd.DataFrame:
+        """Cellules de toutes les conversions, une ligne par (conversion, code)"""
+        self._refresh_stale()
+        with self.lock:
+            if self._frame is None:
+                records = [
+                    (conv_id, e["entity"], e["period"], *cell)
+                    for conv_id, e in self.entries.items()
+                    for cell in e["cells"]
+                ]
+                self._frame = pd.DataFrame.from_records(
+                    records, columns=["conversion_id", "entity", "period", "code", "category", *CUBE_MEASURES],
+                )
+            return self._frame
+
+    def rollup(
+        self,
+        by: List[str],
+        filters: Optional[Dict[str, List[str]]] = None,
+        period_from: Optional[str] = None,
+        period_to: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Totaux regroupés selon `by` (sous-ensemble de CUBE_DIMENSIONS)
+
+        filters : valeurs retenues par dimension ; period_from / period_to
+        bornent les périodes (comparaison de chaînes, "2025-01" <= "2025-03").
+        """
+        unknown = [d for d in by if d not in CUBE_DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Dimensions inconnues: {', '.join(unknown)}")
+        df = self.frame()
+        mask = pd.Series(True, index=df.index)
+        for dim, values in (filters or {}).items():
+            if values:
+                mask &= df[dim].isin(values)
+        if period_from:
+            mask &= df["period"] >= period_from
+        if period_to:
+            mask &= df["period"] <= period_to
+        df = df[mask]
+
+        if by:
+            grouped = df.groupby(by, sort=True)[CUBE_MEASURES].sum().reset_index()
+            conversions = df.groupby(by, sort=True)["conversion_id"].nunique().to_numpy()
+            groups = [
+                {
+                    **{dim: row[dim] for dim in by},
+                    "total_montant": float(row["montant"]),
+                    "total_co2_kg": float(row["co2_kg"]),
+                    "total_co2_tonnes": float(row["co2_kg"]) / 1000,
+                    "lines": int(row["lines"]),
+                    "conversions": int(n),
+                }
+                for row, n in zip(grouped.to_dict("records"), conversions)
+            ]
+        else:
+            groups = []
+        return {
+            "by": by,
+            "groups": groups,
+            "totals": {
+                "total_montant": float(df["montant"].sum()),
+                "total_co2_kg": float(df["co2_kg"].sum()),
+                "total_co2_tonnes": float(df["co2_kg"].sum()) / 1000,
+                "lines": int(df["lines"].sum()),
+                "conversions": int(df["conversion_id"].nunique()),
+            },
+        }
+
+
+_cube = CarbonCube()
+
+
+def get_carbon_cube() -> CarbonCube:
+    return _cube
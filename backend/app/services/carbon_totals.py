@@ -0,0 +1,250 @@
+"""
+Agrégats CO2 courants d'une conversion, tenus à jour par deltas
+
+Chaque ligne enregistrée (append_conversion_rows) ajoute sa contribution aux
+totaux par code ; une correction (patch_conversion_rows) retire l'ancienne et
+ajoute la nouvelle. Les totaux par catégorie et par source s'en déduisent
+(FootprintAggregates). Ils sont persistés dans conv_<id>.co2.json avec la
+version du journal des lignes et celle des facteurs d'émission qu'ils
+reflètent : s'ils ne les suivent plus (écriture d'un autre processus, journal
+réécrit, nouveau CSV de facteurs), ils sont recalculés entièrement à la lecture
+suivante, puis les deltas reprennent.
+
+Seules les conversions avec une colonne montant (meta.amount_column) sont
+suivies. Les messages d'erreur par ligne ne sont pas conservés, seulement
+leur nombre par motif.
+"""
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from ..config import settings
+from .co2_analyzer import FOOTPRINT_STATUSES, FootprintAggregates, co2_analyzer, parse_amounts
+from .csv_io import preview_csv, read_csv_chunks
+from .storage import get_conversion_meta, get_conversion_rows, get_upload, rows_version
+from .xlsx_io import iterate_xlsx
+
+
+# Montants parsés par conversion : (chemin, mtime, colonne, montants par row_index)
+_amounts: Dict[str, tuple] = {}
+_amounts_lock = threading.Lock()
+# Nombre de conversions dont les montants restent en mémoire
+AMOUNTS_CACHE_SIZE = 8
+
+
+def _totals_path(conv_id: str) -> str:
+    return os.path.join(settings.storage_dir, "db", f"conv_{conv_id}.co2.json")
+
+
+def upload_amounts(conv: Dict[str, Any], montant_column: str) -> pd.Series:
+    """Colonne montant du fichier d'origine, indexée par numéro de ligne (valeurs brutes)"""
+    up = get_upload(conv.get("upload_id") or "")
+    path = (up or {}).get("path", "")
+    if not path or not os.path.exists(path):
+        raise ValueError("Fichier d'origine introuvable")
+    if path.lower().endswith(".xlsx"):
+        values = []
+        for i, row in enumerate(iterate_xlsx(path)):
+            if i == 0 and montant_column not in row:
+                raise ValueError(f"Colonne montant '{montant_column}' absente du fichier")
+            values.append(row.get(montant_column))
+        return pd.Series(values, dtype=object)
+    columns, _ = preview_csv(path, limit=0)
+    if montant_column not in columns:
+        raise ValueError(f"Colonne montant '{montant_column}' absente du fichier")
+    parts = [chunk[montant_column] for chunk in read_csv_chunks(path, settings.co2_chunk_rows)]
+    return pd.concat(parts, ignore_index=True) if parts else pd.Series([], dtype=object)
+
+
+def _parsed_amounts(conv_id: str, conv: Dict[str, Any], column: str) -> np.ndarray:
+    """Montants parsés de la conversion, relus seulement si le fichier a changé"""
+    path = (get_upload(conv.get("upload_id") or "") or {}).get("path", "")
+    mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+    with _amounts_lock:
+        cached = _amounts.get(conv_id)
+        if cached and cached[:3] == (path, mtime, column):
+            return cached[3]
+    values = parse_amounts(upload_amounts(conv, column)).to_numpy()
+    with _amounts_lock:
+        _amounts[conv_id] = (path, mtime, column, values)
+        while len(_amounts) > AMOUNTS_CACHE_SIZE:
+            _amounts.pop(next(iter(_amounts)))
+    return values
+
+
+def _empty(version: str, column: str) -> Dict[str, Any]:
+    return {
+        "rows_version": version,
+        "emission_version": co2_analyzer.emission_version(),
+        "amount_column": column,
+        "lines": 0,
+        "by_code": {},
+        "status_counts": {status: 0 for status in FOOTPRINT_STATUSES},
+    }
+
+
+def _apply(totals: Dict[str, Any], rows: List[Dict[str, Any]], amounts: np.ndarray, sign: int) -> None:
+    """Ajoute (sign=1) ou retire (sign=-1) la contribution des lignes aux totaux"""
+    if not rows:
+        return
+    index = np.array([int(r.get("row_index", -1)) for r in rows])
+    inside = (index >= 0) & (index < len(amounts))
+    montants = np.full(len(index), np.nan)
+    montants[inside] = amounts[index[inside]]
+    frame = co2_analyzer.footprint_frame(pd.Series([r.get("chosen_code") or "" for r in rows]), pd.Series(montants))
+
+    ok = frame[frame["status"] == "ok"]
+    grouped = ok.groupby("code", sort=False, observed=True).agg(
+        total_montant=("montant", "sum"), total_co2_kg=("co2_kg", "sum"), occurrences=("co2_kg", "size"),
+    )
+    by_code = totals["by_code"]
+    for code, total_montant, total_co2_kg, occurrences in grouped.itertuples():
+        entry = by_code.setdefault(code, [0.0, 0.0, 0])
+        entry[0] += sign * float(total_montant)
+        entry[1] += sign * float(total_co2_kg)
+        entry[2] += sign * int(occurrences)
+        if entry[2] <= 0:
+            del by_code[code]
+    for status, count in frame["status"].value_counts().items():
+        totals["status_counts"][status] = totals["status_counts"].get(status, 0) + sign * int(count)
+    totals["lines"] += sign * len(rows)
+
+
+def _load(conv_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_totals_path(conv_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save(conv_id: str, totals: Dict[str, Any]) -> None:
+    path = _totals_path(conv_id)
+    # Nom temporaire unique entre threads et processus (API et workers)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(totals, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _column(conv: Optional[Dict[str, Any]]) -> Optional[str]:
+    return ((conv or {}).get("meta") or {}).get("amount_column")
+
+
+def _current(totals: Optional[Dict[str, Any]], version: str, column: str) -> bool:
+    """Totaux calculés pour cette version du journal, cette colonne et ces facteurs"""
+    return (
+        totals is not None
+        and totals.get("rows_version") == version
+        and totals.get("amount_column") == column
+        and totals.get("emission_version") == co2_analyzer.emission_version()
+    )
+
+
+def _update(
+    conv_id: str,
+    version_before: str,
+    version_after: Optional[str],
+    removed: List[Dict[str, Any]],
+    added: List[Dict[str, Any]],
+) -> None:
+    conv = get_conversion_meta(conv_id)
+    column = _column(conv)
+    if not column:
+        return
+    totals = _load(conv_id)
+    if totals is None and version_before.startswith("0:"):
+        # Premières lignes de la conversion : totaux vides
+        totals = _empty(version_before, column)
+    if version_after is None or not _current(totals, version_before, column):
+        # Totaux périmés, ou écriture d'un autre processus intercalée : recalcul complet à la prochaine lecture
+        return
+    amounts = _parsed_amounts(conv_id, conv, column)
+    _apply(totals, removed, amounts, -1)
+    _apply(totals, added, amounts, 1)
+    # Version issue de cette seule écriture : si un autre processus a écrit depuis,
+    # elle diffère de la version courante et les totaux seront recalculés
+    totals["rows_version"] = version_after
+    _save(conv_id, totals)
+
+
+def rows_appended(conv_id: str, version_before: str, version_after: Optional[str], rows: List[Dict[str, Any]]) -> None:
+    """
+    Delta après l'ajout de lignes au journal (appelé par storage, verrou de la conversion tenu)
+
+    version_after : version du journal juste après cette écriture, None si un
+    autre processus a écrit entre la lecture de version_before et celle-ci.
+    """
+    _update(conv_id, version_before, version_after, [], rows)
+
+
+def rows_changed(
+    conv_id: str,
+    version_before: str,
+    version_after: Optional[str],
+    before: List[Dict[str, Any]],
+    after: List[Dict[str, Any]],
+) -> None:
+    """Delta après des corrections : anciennes lignes retirées, lignes corrigées ajoutées"""
+    _update(conv_id, version_before, version_after, before, after)
+
+
+def _rebuild(conv_id: str, conv: Dict[str, Any], column: str) -> Dict[str, Any]:
+    version = rows_version(conv_id)
+    totals = _empty(version, column)
+    _apply(totals, get_conversion_rows(conv_id), _parsed_amounts(conv_id, conv, column), 1)
+    # Lignes ajoutées pendant le recalcul : elles seront comptées au prochain
+    if rows_version(conv_id) == version:
+        _save(conv_id, totals)
+    return totals
+
+
+def _aggregates(totals: Dict[str, Any], column: str) -> FootprintAggregates:
+    aggregates = FootprintAggregates(co2_analyzer, column)
+    aggregates.lines = totals["lines"]
+    aggregates.by_code = totals["by_code"]
+    aggregates.errors_count = totals["lines"] - totals["status_counts"].get("ok", 0)
+    return aggregates
+
+
+def carbon_totals(conv_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Bilan courant de la conversion (totaux par code, catégorie et source)
+
+    None si la conversion n'existe pas ou n'a pas de colonne montant.
+    Sans recalcul tant que les totaux suivent le journal des lignes.
+    """
+    conv = get_conversion_meta(conv_id)
+    column = _column(conv)
+    if not column:
+        return None
+    totals = _load(conv_id)
+    if not _current(totals, rows_version(conv_id), column):
+        totals = _rebuild(conv_id, conv, column)
+    result = _aggregates(totals, column).result()
+    result["status_counts"] = totals["status_counts"]
+    return result
+
+
+def live_totals(conv_id: str) -> Optional[Dict[str, Any]]:
+    """Totaux CO2 persistés, sans recalcul (flux de progression) ; None s'il n'y en a pas"""
+    totals = _load(conv_id)
+    if totals is None:
+        return None
+    ok = totals["status_counts"].get("ok", 0)
+    total_co2 = sum(entry[1] for entry in totals["by_code"].values())
+    return {
+        "total_co2_kg": total_co2,
+        "total_co2_tonnes": total_co2 / 1000,
+        "processed_lines": ok,
+        "errors_count": totals["lines"] - ok,
+    }
@@ -16,11 +16,21 @@ from sklearn.neural_network import MLPClassifier
 import json
 import base64
 from io import BytesIO
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, List, Any, Optional, Tuple, Union
 import logging
 
 logger = logging.getLogger(__name__)
 
+ConversionData = Union[List[Dict], pd.DataFrame]
+
+
+def _frame(conversion_data: Optional[ConversionData]) -> pd.DataFrame:
+    """DataFrame des données de conversion (liste de lignes ou instantané colonnaire)"""
+    if isinstance(conversion_data, pd.DataFrame):
+        return conversion_data
+    return pd.DataFrame(conversion_data or [])
+
+
 class CarbonVisualizationService:
     """Service de génération de visualisations pour l'analyse carbone"""
     
@@ -103,14 +113,13 @@ class CarbonVisualizationService:
             logger.error(f"Erreur lors de la création de la heatmap: {e}")
             return {"error": str(e)}
     
-    def create_3d_visualization(self, conversion_data: List[Dict]) -> Dict:
+    def create_3d_visualization(self, conversion_data: ConversionData) -> Dict:
         """Crée une visualisation 3D des données d'émissions"""
         try:
-            if not conversion_data:
+            df = _frame(conversion_data)
+            if df.empty:
                 return {"error": "Aucune donnée de conversion disponible"}
             
-            df = pd.DataFrame(conversion_data)
-            
             # Vérifier les colonnes nécessaires
             required_cols = ['category', 'montant', 'total_emission']
             if not all(col in df.columns for col in required_cols):
@@ -175,14 +184,13 @@ class CarbonVisualizationService:
             logger.error(f"Erreur lors de la création de la visualisation 3D: {e}")
             return {"error": str(e)}
     
-    def create_neural_network_analysis(self, conversion_data: List[Dict]) -> Dict:
+    def create_neural_network_analysis(self, conversion_data: ConversionData) -> Dict:
         """Analyse avec réseau de neurones pour prédiction d'émissions"""
         try:
-            if not conversion_data:
+            df = _frame(conversion_data)
+            if df.empty:
                 return {"error": "Aucune donnée disponible"}
             
-            df = pd.DataFrame(conversion_data)
-            
             # Préparer les features
             if 'montant' not in df.columns or 'total_emission' not in df.columns:
                 return {"error": "Colonnes montant et total_emission requises"}
@@ -291,14 +299,13 @@ class CarbonVisualizationService:
             logger.error(f"Erreur lors de l'analyse par réseau de neurones: {e}")
             return {"error": str(e)}
     
-    def create_hierarchical_clustering(self, conversion_data: List[Dict]) -> Dict:
+    def create_hierarchical_clustering(self, conversion_data: ConversionData) -> Dict:
         """Crée un clustering hiérarchique des données"""
         try:
-            if not conversion_data:
+            df = _frame(conversion_data)
+            if df.empty:
                 return {"error": "Aucune donnée disponible"}
             
-            df = pd.DataFrame(conversion_data)
-            
             # Préparer les données pour le clustering
             if not all(col in df.columns for col in ['montant', 'total_emission']):
                 return {"error": "Colonnes montant et total_emission requises"}
@@ -390,7 +397,7 @@ class CarbonVisualizationService:
             logger.error(f"Erreur lors du clustering hiérarchique: {e}")
             return {"error": str(e)}
     
-    def create_comprehensive_dashboard(self, category_data: Dict, conversion_data: List[Dict]) -> Dict:
+    def create_comprehensive_dashboard(self, category_data: Dict, conversion_data: ConversionData) -> Dict:
         """Crée un dashboard complet avec tous les types de visualisation"""
         try:
             # Créer une figure avec sous-graphiques
@@ -434,8 +441,8 @@ class CarbonVisualizationService:
             )
             
             # 3. Corrélation montant-émissions (scatter)
-            if conversion_data:
-                df = pd.DataFrame(conversion_data)
+            df = _frame(conversion_data)
+            if not df.empty:
                 if 'montant' in df.columns and 'total_emission' in df.columns:
                     df_clean = df.dropna(subset=['montant', 'total_emission'])
                     if not df_clean.empty:
@@ -0,0 +1,274 @@
+"""
+Cascade de classification par niveaux de confiance
+
+Chaque niveau renvoie une confiance calibrée (0-100) ; seules les lignes sous le
+seuil passent au niveau suivant, plus coûteux : cache exact, règles apprises
+(fournisseur/compte), marge du meilleur score flou, modèle local, puis LLM.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..config import settings
+from ..utils.text import normalize_text
+from .nacre_dict import NacreEntry, get_nacre_dict
+from .patterns import get_pattern_sources_many, supplier_of
+from .local_classifier import get_local_classifier
+
+
+CACHE_PATH = os.path.join(settings.storage_dir, "db", "label_cache.json")
+TRAINING_PATH = os.path.join(settings.storage_dir, "db", "training.jsonl")
+
+# Poids (occurrences x confiance) à partir duquel une règle fournisseur/compte est jugée fiable
+PATTERN_FULL_SUPPORT = 5.0
+# Écart entre les deux meilleurs scores flous pour une confiance pleine
+FUZZY_FULL_MARGIN = 20.0
+
+
+def _top_code(weights: Dict[str, float]) -> str:
+    return max(weights.items(), key=lambda kv: kv[1])[0]
+
+
+def _cache_keys(label: str, context: Optional[Dict[str, Any]]) -> List[str]:
+    """Clés du cache exact : libellé + fournisseur, puis libellé seul"""
+    norm = normalize_text(label or "")
+    if not norm:
+        return []
+    sup = supplier_of(context or {})
+    return [f"{norm}|{sup}", norm] if sup else [norm]
+
+
+def _bump(bucket: Dict[str, Any], key: str, code: str, confidence: int):
+    entry = bucket.get(key) or {"codes": {}}
+    c = entry["codes"].get(code) or {"count": 0, "avg_conf": 0.0}
+    new_count = c["count"] + 1
+    entry["codes"][code] = {"count": new_count, "avg_conf": round((c["avg_conf"] * c["count"] + confidence) / new_count, 2)}
+    bucket[key] = entry
+
+
+class LabelCache:
+    """Libellés déjà classés : exemples d'apprentissage et résultats LLM confiants"""
+
+    def __init__(self, path: str = CACHE_PATH, training_path: str = TRAINING_PATH):
+        self.path = path
+        self.training_path = training_path
+        self.lock = threading.Lock()
+        self._entries: Optional[Dict[str, Any]] = None
+        self._mtimes: Tuple[float, float] = (0.0, 0.0)
+
+    def _current_mtimes(self) -> Tuple[float, float]:
+        def mtime(p: str) -> float:
+            return os.path.getmtime(p) if os.path.exists(p) else 0.0
+        return mtime(self.path), mtime(self.training_path)
+
+    def _learned(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _load(self) -> Dict[str, Any]:
+        mtimes = self._current_mtimes()
+        if self._entries is not None and mtimes == self._mtimes:
+            return self._entries
+        entries = self._learned()
+        if os.path.exists(self.training_path):
+            with open(self.training_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ex = json.loads(line)
+                    except Exception:
+                        continue
+                    code = (ex.get("code") or "").strip().upper()
+                    if not code:
+                        continue
+                    for key in _cache_keys(ex.get("label", ""), ex.get("context")):
+                        _bump(entries, key, code, int(ex.get("confidence") or 90))
+        self._entries = entries
+        self._mtimes = mtimes
+        return entries
+
+    def lookup_many(self, items: List[Dict[str, Any]]) -> List[Optional[Tuple[str, int]]]:
+        """(code, confiance) pour chaque élément, None si le libellé est inconnu"""
+        with self.lock:
+            entries = self._load()
+        found: List[Optional[Tuple[str, int]]] = []
+        for item in items:
+            hit = None
+            for key in _cache_keys(item.get("label_text", ""), item.get("context")):
+                entry = entries.get(key)
+                if not entry or not entry.get("codes"):
+                    continue
+                codes = entry["codes"]
+                total = sum(c["count"] for c in codes.values())
+                code, best = max(codes.items(), key=lambda kv: kv[1]["count"])
+                # Un libellé associé à plusieurs codes perd en confiance
+                hit = (code, int(round(best["avg_conf"] * best["count"] / total)))
+                break
+            found.append(hit)
+        return found
+
+    def learn(self, examples: List[Tuple[Dict[str, Any], str, int]]) -> int:
+        """Ajoute des couples (élément, code, confiance) au cache persistant"""
+        if not examples:
+            return 0
+        with self.lock:
+            learned = self._learned()
+            for item, code, confidence in examples:
+                for key in _cache_keys(item.get("label_text", ""), item.get("context")):
+                    _bump(learned, key, code, confidence)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(learned, f, ensure_ascii=False)
+            self._entries = None
+        return len(examples)
+
+
+_label_cache: Optional[LabelCache] = None
+
+
+def get_label_cache() -> LabelCache:
+    global _label_cache
+    if _label_cache is None:
+        _label_cache = LabelCache()
+    return _label_cache
+
+
+def _result(entry: Optional[NacreEntry], code: str, confidence: int, explanation: str,
+            alternatives: Optional[List[NacreEntry]] = None) -> Dict[str, Any]:
+    return {
+        "chosen_code": entry.code if entry else code,
+        "chosen_category": entry.category if entry else code,
+        "confidence": max(0, min(100, confidence)),
+        "alternatives": [
+            {"code": a.code, "category": a.category, "keywords": a.keywords} for a in (alternatives or [])
+        ],
+        "explanation": explanation,
+    }
+
+
+class ClassificationCascade:
+    """Enchaîne les niveaux de classification du moins au plus coûteux"""
+
+    def __init__(self, min_confidence: Optional[int] = None, enabled: Optional[bool] = None):
+        self.min_confidence = settings.cascade_min_confidence if min_confidence is None else min_confidence
+        self.enabled = settings.cascade_enabled if enabled is None else enabled
+        self.nacre = get_nacre_dict()
+        self.tiers: Dict[str, Dict[str, Any]] = {}
+
+    def _exact_cache(self, items: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+        results = []
+        for hit in get_label_cache().lookup_many(items):
+            if hit is None:
+                results.append(None)
+                continue
+            code, confidence = hit
+            results.append(_result(self.nacre.get(code), code, confidence, "Libellé déjà classé (cache)"))
+        return results
+
+    def _patterns(self, items: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+        results = []
+        for by_supplier, by_account in get_pattern_sources_many([item.get("context") or {} for item in items]):
+            weights = dict(by_supplier)
+            for code, weight in by_account.items():
+                weights[code] = weights.get(code, 0.0) + weight
+            total = sum(weights.values())
+            if total <= 0:
+                results.append(None)
+                continue
+            code, top = max(weights.items(), key=lambda kv: kv[1])
+            # Part du code dominant, pondérée par le volume d'historique
+            confidence = int(round(100 * (top / total) * min(1.0, top / PATTERN_FULL_SUPPORT)))
+            if not (by_supplier and by_account and _top_code(by_supplier) == code == _top_code(by_account)):
+                # Fournisseur seul (qui peut couvrir plusieurs catégories), compte seul ou
+                # sources en désaccord : la règle ne tranche pas sans le niveau suivant
+                confidence = min(confidence, self.min_confidence - 1)
+            results.append(_result(self.nacre.get(code), code, confidence, "Règle apprise fournisseur/compte"))
+        return results
+
+    def _fuzzy(self, items: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+        results = []
+        for item in items:
+            scored = self.nacre.scored_candidates(item["label_text"], item.get("context") or {}, top_k=settings.max_candidates)
+            # Les candidats servent aussi aux niveaux suivants (prompt LLM)
+            item["candidates"] = [e for _, e in scored]
+            if not scored:
+                results.append(None)
+                continue
+            best, entry = scored[0]
+            second = scored[1][0] if len(scored) > 1 else 0.0
+            margin = best - second
+            confidence = int(round(best * min(1.0, margin / FUZZY_FULL_MARGIN)))
+            results.append(_result(entry, entry.code, confidence,
+                                   f"Correspondance dictionnaire (score {best:.0f}, marge {margin:.0f})",
+                                   [e for _, e in scored[:3]]))
+        return results
+
+    def _local_model(self, items: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+        local = get_local_classifier() if settings.local_model_enabled else None
+        if local is None or not local.is_ready():
+            return [None] * len(items)
+        return local.predict_many(items) or [None] * len(items)
+
+    def _record(self, tier: str, rows_in: int, hits: int, seconds: float):
+        self.tiers[tier] = {"rows_in": rows_in, "hits": hits, "time": f"{seconds:.2f}s"}
+
+    def run(self, items: List[Dict[str, Any]]) -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], List[Dict[str, Any]]]:
+        """Renvoie les éléments résolus (élément, résultat) et ceux à envoyer au LLM"""
+        tiers: List[Tuple[str, Callable, int]] = []
+        if self.enabled:
+            tiers = [
+                ("exact_cache", self._exact_cache, self.min_confidence),
+                ("patterns", self._patterns, self.min_confidence),
+                ("fuzzy", self._fuzzy, self.min_confidence),
+                ("local_model", self._local_model, settings.local_model_min_confidence),
+            ]
+        resolved: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        remaining = items
+        for name, tier, threshold in tiers:
+            if not remaining:
+                break
+            start = time.time()
+            passed = []
+            hits = 0
+            for item, result in zip(remaining, tier(remaining)):
+                if result is not None and result["confidence"] >= threshold:
+                    resolved.append((item, result))
+                    hits += 1
+                else:
+                    passed.append(item)
+            self._record(name, len(remaining), hits, time.time() - start)
+            remaining = passed
+
+        # Les lignes incertaines partent au LLM avec leurs candidats
+        for item in remaining:
+            if "candidates" not in item:
+                item["candidates"] = self.nacre.candidates_advanced(
+                    item["label_text"], item.get("context") or {}, top_k=settings.max_candidates
+                )
+            if not item["candidates"]:
+                item["candidates"] = [NacreEntry(code="ZZ.99", category="Inclassable", keywords=[], aggregated="")]
+        return resolved, remaining
+
+    def record_llm(self, rows_in: int, seconds: float):
+        self._record("llm", rows_in, rows_in, seconds)
+
+    def learn(self, items: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> int:
+        """Mémorise les réponses LLM confiantes pour les libellés identiques à venir"""
+        by_index = {item["row_index"]: item for item in items}
+        examples = []
+        for result in results:
+            item = by_index.get(result.get("row_index"))
+            code = result.get("chosen_code")
+            confidence = int(result.get("confidence", 0))
+            if item is not None and code and confidence >= self.min_confidence:
+                examples.append((item, code, confidence))
+        return get_label_cache().learn(examples)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self.tiers)
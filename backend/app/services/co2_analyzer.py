@@ -2,17 +2,79 @@
 IA - Analyse CO2
 Service spécialisé dans l'analyse et le calcul des bilans carbone basés sur les codes NACRE
 """
+import numpy as np
 import pandas as pd
 import json
 import logging
 import os
-from typing import Dict, List, Any, Optional, Tuple
+import time
+from typing import Dict, Iterator, List, Any, Optional, Tuple, Union
 from openai import OpenAI
 from ..config import settings, GPT5_MODELS, GPT5_PARAMS
 from .nacre_dict import get_nacre_dict
 
 logger = logging.getLogger(__name__)
 
+# Messages d'erreur par ligne conservés dans un résultat (le total est dans errors_count)
+MAX_ERRORS = 1000
+# Statut d'une ligne dans footprint_frame
+FOOTPRINT_STATUSES = ["ok", "no_factor", "invalid_amount", "missing_code"]
+_SPACES_PATTERN = "[\\s\u00a0\u202f']"
+_NUMBER_PATTERN = r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?"
+
+
+def normalize_code(code: Any) -> str:
+    """Clé de recherche d'un code NACRE : "AA.01", "aa01" et "AA 01" donnent "AA01" """
+    return "".join(ch for ch in str(code or "").upper() if ch.isalnum())
+
+
+def parse_amounts(values: pd.Series) -> pd.Series:
+    """
+    Montants en float, en bloc : "1234.5", "1234,5", "1 234,50", "1.234,50", "1,234.50"
+    
+    Les valeurs illisibles donnent NaN. Chaque étape de normalisation n'est
+    appliquée que si une valeur au moins en a besoin.
+    """
+    values = pd.Series(values).reset_index(drop=True)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype("float64")
+    s = values.astype(str).str.strip()
+    # Espaces (y compris insécables) et apostrophes de milliers
+    if s.str.contains(_SPACES_PATTERN, regex=True).any():
+        s = s.str.replace(_SPACES_PATTERN, "", regex=True)
+    has_comma = s.str.contains(",", regex=False)
+    if has_comma.any():
+        both = has_comma & s.str.contains(".", regex=False)
+        if both.any():
+            # Virgule et point : le dernier est la décimale, l'autre le séparateur de milliers
+            comma_last = s.str.contains(r",[^.]*$", regex=True)
+            s = s.where(~(both & comma_last), s.str.replace(".", "", regex=False))
+            s = s.where(~(both & ~comma_last), s.str.replace(",", "", regex=False))
+        # Virgule répétée : milliers ; virgule seule : décimale française
+        repeated = s.str.contains(",.*,", regex=True)
+        if repeated.any():
+            s = s.where(~repeated, s.str.replace(",", "", regex=False))
+        s = s.str.replace(",", ".", regex=False)
+    repeated = s.str.contains(r"\..*\.", regex=True)
+    if repeated.any():
+        s = s.where(~repeated, s.str.replace(".", "", regex=False))
+
+    ok = s.str.fullmatch(_NUMBER_PATTERN).fillna(False).to_numpy(dtype=bool)
+    out = np.full(len(s), np.nan)
+    out[ok] = _to_float(s[ok])
+    return pd.Series(out)
+
+
+def _to_float(s: pd.Series) -> np.ndarray:
+    """Chaînes numériques validées -> float64 (conversion Arrow si pyarrow est installé)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        return s.astype("float64").to_numpy()
+    return pc.cast(pa.array(s, type=pa.string()), pa.float64()).to_numpy(zero_copy_only=False)
+
+
 class CO2AnalyzerAI:
     """IA spécialisée dans l'analyse CO2 et calcul de bilans carbone"""
     
@@ -31,12 +93,42 @@ class CO2AnalyzerAI:
         self.nacre_dict = get_nacre_dict()
         
         # Charger directement le CSV avec les facteurs d'émission
-        self.emission_data = self._load_emission_csv()
+        self.emission_csv_path = os.path.join(os.path.dirname(__file__), "nacre_dictionary_with_emissions.csv")
+        self.emission_mtime = None
+        self._load_emission_tables()
         
+    def _csv_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.emission_csv_path)
+        except OSError:
+            return None
+
+    def _load_emission_tables(self) -> None:
+        """CSV, index des facteurs et comptages du statut, (re)construits ensemble"""
+        self.emission_mtime = self._csv_mtime()
+        self.emission_data = self._load_emission_csv()
+        # Index code normalisé -> facteur retenu, construit une seule fois par version du CSV
+        self.emission_index = self._build_emission_index()
+        self.status_summary = self._build_status_summary()
+        self._missing_codes = set()
+
+    def refresh_emission_data(self) -> bool:
+        """Recharge les facteurs si le CSV a été modifié depuis le chargement (True si rechargé)"""
+        if self._csv_mtime() == self.emission_mtime:
+            return False
+        logger.info("CSV émissions modifié : rechargement des facteurs")
+        self._load_emission_tables()
+        return True
+
+    def emission_version(self) -> str:
+        """Version des facteurs (mtime du CSV), à inclure dans les clés des résultats qui en dépendent"""
+        self.refresh_emission_data()
+        return str(self.emission_mtime)
+
     def _load_emission_csv(self) -> Optional[pd.DataFrame]:
         """Charge le CSV contenant les facteurs d'émission"""
         try:
-            csv_path = os.path.join(os.path.dirname(__file__), "nacre_dictionary_with_emissions.csv")
+            csv_path = self.emission_csv_path
             if os.path.exists(csv_path):
                 df = pd.read_csv(csv_path)
                 logger.info(f"CSV émissions chargé: {len(df)} codes NACRE")
@@ -48,32 +140,22 @@ class CO2AnalyzerAI:
             logger.error(f"Erreur chargement CSV émissions: {e}")
             return None
         
-    def get_emission_factor(self, nacre_code: str) -> Optional[Dict[str, Any]]:
-        """
-        Récupère le facteur d'émission CO2 pour un code NACRE donné
-        
-        Returns:
-            Dict avec 'emission' (prioritaire), 'emission_factor' (fallback), et métadonnées
-        """
-        try:
-            if self.emission_data is None:
-                logger.warning("Données d'émission non disponibles")
-                return None
-                
-            # Rechercher le code NACRE dans le DataFrame
-            matches = self.emission_data[self.emission_data['code_nacre'] == nacre_code]
-            
-            if matches.empty:
-                logger.warning(f"Code NACRE {nacre_code} non trouvé dans le dictionnaire d'émissions")
-                return None
-            
-            entry = matches.iloc[0]  # Prendre la première correspondance
-            
+    def _build_emission_index(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Facteur retenu pour chaque code (None si aucune valeur valide)"""
+        index: Dict[str, Optional[Dict[str, Any]]] = {}
+        if self.emission_data is None:
+            return index
+        df = self.emission_data
+        columns = [
+            df[name] if name in df.columns else pd.Series([None] * len(df), index=df.index)
+            for name in ("code_nacre", "emission", "emission_factor", "description")
+        ]
+        for code, emission_value, emission_factor_value, description in zip(*columns):
+            key = normalize_code(code)
+            if not key or key in index:
+                # Première occurrence prioritaire, comme auparavant
+                continue
             # Priorité à la colonne 'emission', fallback sur 'emission_factor'
-            emission_value = entry.get('emission')
-            emission_factor_value = entry.get('emission_factor')
-            
-            # Déterminer quelle valeur utiliser
             if pd.notna(emission_value) and float(emission_value) > 0:
                 factor = float(emission_value)
                 source = "emission"
@@ -83,28 +165,128 @@ class CO2AnalyzerAI:
                 source = "emission_factor"
                 explanation = f"Utilise la colonne 'emission_factor' ({factor} kg CO2/€) - valeur sectorielle par défaut"
             else:
-                logger.warning(f"Pas de facteur d'émission valide pour le code {nacre_code}")
-                return None
-            
-            return {
+                index[key] = None
+                continue
+            index[key] = {
                 "factor": factor,
                 "source": source,
                 "explanation": explanation,
-                "code_nacre": nacre_code,
-                "description": entry.get('description', 'N/A')
+                "description": description if pd.notna(description) else 'N/A',
             }
-            
-        except Exception as e:
-            logger.error(f"Erreur lors de la récupération du facteur d'émission pour {nacre_code}: {e}")
+        return index
+
+    def get_emission_factor(self, nacre_code: str) -> Optional[Dict[str, Any]]:
+        """
+        Récupère le facteur d'émission CO2 pour un code NACRE donné (AA.01 ou AA01)
+        
+        Returns:
+            Dict avec 'emission' (prioritaire), 'emission_factor' (fallback), et métadonnées
+        """
+        self.refresh_emission_data()
+        if self.emission_data is None:
+            logger.warning("Données d'émission non disponibles")
+            return None
+        key = normalize_code(nacre_code)
+        if key not in self.emission_index:
+            # Un avertissement par code, pas à chaque ligne
+            if key not in self._missing_codes:
+                self._missing_codes.add(key)
+                logger.warning(f"Code NACRE {nacre_code} non trouvé dans le dictionnaire d'émissions")
             return None
+        entry = self.emission_index[key]
+        if entry is None:
+            if key not in self._missing_codes:
+                self._missing_codes.add(key)
+                logger.warning(f"Pas de facteur d'émission valide pour le code {nacre_code}")
+            return None
+        return {**entry, "code_nacre": nacre_code}
     
-    def calculate_carbon_footprint(self, data: List[Dict[str, Any]], montant_column: str) -> Dict[str, Any]:
+    def footprint_frame(self, codes: pd.Series, amounts: pd.Series) -> pd.DataFrame:
+        """
+        Calcul vectorisé ligne à ligne : code, montant, facteur, source et CO2
+        
+        Les codes sont joints aux facteurs via un catégoriel (nettoyage et recherche
+        une fois par code distinct) ; la colonne 'status' vaut "ok", "missing_code",
+        "invalid_amount" ou "no_factor".
+        """
+        self.refresh_emission_data()
+        raw = pd.Categorical(pd.Series(codes, dtype=object).reset_index(drop=True))
+        stripped = [str(c).strip() for c in raw.categories]
+        labels = list(dict.fromkeys(stripped + [""]))
+        position = {label: k for k, label in enumerate(labels)}
+        # Code -1 (valeur absente) -> dernier élément : code vide
+        mapping = np.array([position[c] for c in stripped] + [position[""]], dtype=np.int32)
+        code_ids = mapping[raw.codes]
+        entries = [self.emission_index.get(normalize_code(label)) for label in labels]
+        factors = np.array([e["factor"] if e else np.nan for e in entries])[code_ids]
+        sources = pd.Categorical([e["source"] if e else "" for e in entries])
+        montants = parse_amounts(amounts).to_numpy()
+
+        # Indices dans FOOTPRINT_STATUSES, le dernier motif applicable l'emporte
+        status = np.zeros(len(code_ids), dtype=np.int8)
+        status[np.isnan(factors)] = 1
+        status[np.isnan(montants)] = 2
+        status[code_ids == position[""]] = 3
+        return pd.DataFrame({
+            "code": pd.Categorical.from_codes(code_ids, categories=labels),
+            "montant": montants,
+            "emission_factor": factors,
+            "emission_source": pd.Categorical.from_codes(sources.codes[code_ids], categories=sources.categories),
+            "co2_kg": montants * factors,
+            "status": pd.Categorical.from_codes(status, categories=FOOTPRINT_STATUSES),
+        })
+
+    def _line_errors(self, frame: pd.DataFrame, raw_amounts: pd.Series, offset: int = 0) -> List[str]:
+        """Messages d'erreur (MAX_ERRORS premiers) des lignes non calculées"""
+        errors = []
+        for pos in np.flatnonzero((frame["status"] != "ok").to_numpy())[:MAX_ERRORS]:
+            line, status = offset + pos + 1, frame["status"].iat[pos]
+            if status == "missing_code":
+                errors.append(f"Ligne {line}: Code NACRE manquant")
+            elif status == "invalid_amount":
+                errors.append(f"Ligne {line}: Montant invalide '{raw_amounts.iat[pos]}'")
+            else:
+                errors.append(f"Ligne {line}: Facteur d'émission non trouvé pour {frame['code'].iat[pos]}")
+        return errors
+
+    def summarize_by_code(self, frame: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
+        """Agrégation par code NACRE des lignes calculées"""
+        ok = frame[frame["status"] == "ok"]
+        grouped = ok.groupby("code", sort=False, observed=True).agg(
+            total_montant=("montant", "sum"),
+            total_co2_kg=("co2_kg", "sum"),
+            occurrences=("co2_kg", "size"),
+        )
+        return {
+            code: self.code_summary(code, total_montant, total_co2_kg, occurrences)
+            for code, total_montant, total_co2_kg, occurrences in grouped.itertuples()
+        }
+
+    def code_summary(self, code: str, total_montant: float, total_co2_kg: float, occurrences: int) -> Dict[str, Any]:
+        entry = self.emission_index.get(normalize_code(code)) or {}
+        return {
+            "total_montant": float(total_montant),
+            "total_co2_kg": float(total_co2_kg),
+            "occurrences": int(occurrences),
+            "emission_factor": entry.get("factor"),
+            "emission_source": entry.get("source"),
+            "description": entry.get("description", 'N/A'),
+        }
+
+    def calculate_carbon_footprint(
+        self,
+        data: Union[List[Dict[str, Any]], pd.DataFrame],
+        montant_column: str,
+        details_offset: int = 0,
+        details_limit: Optional[int] = None,
+    ) -> Dict[str, Any]:
         """
         Calcule le bilan carbone total d'un ensemble de données avec calcul de vitesse
         
         Args:
-            data: Liste des lignes avec codes NACRE et montants
+            data: Lignes (ou DataFrame) avec codes NACRE et montants
             montant_column: Nom de la colonne contenant les montants
+            details_offset, details_limit: page des détails par ligne (0 : sans détails, None : tous)
             
         Returns:
             Dictionnaire avec le résultat du calcul, détails et métriques de performance
@@ -113,119 +295,59 @@ class CO2AnalyzerAI:
         start_time = time.time()
         
         try:
+            if isinstance(data, pd.DataFrame):
+                n = len(data)
+                codes = data["code_nacre"] if "code_nacre" in data.columns else pd.Series([""] * n)
+                raw_amounts = data[montant_column] if montant_column in data.columns else pd.Series(["0"] * n)
+                codes, raw_amounts = codes.reset_index(drop=True), raw_amounts.reset_index(drop=True)
+            else:
+                n = len(data)
+                codes = pd.Series([row.get('code_nacre', '') for row in data], dtype=object)
+                raw_amounts = pd.Series([row.get(montant_column, '0') for row in data], dtype=object)
+
+            frame = self.footprint_frame(codes, raw_amounts)
+            ok = (frame["status"] == "ok").to_numpy()
+            processed = int(ok.sum())
+            total_co2 = float(frame["co2_kg"].to_numpy()[ok].sum())
+            total_montant = float(frame["montant"].to_numpy()[ok].sum())
+
+            emission_sources = {
+                source: {"count": int(count), "total_co2_kg": float(co2)}
+                for source, count, co2 in frame[ok].groupby("emission_source", sort=False, observed=True)["co2_kg"]
+                .agg(["size", "sum"]).itertuples()
+            }
+
+            # Détails par ligne : page demandée uniquement
+            ok_positions = np.flatnonzero(ok)
+            end = None if details_limit is None else details_offset + max(0, details_limit)
+            details = [self._line_detail(data, frame, pos) for pos in ok_positions[details_offset:end]]
+
+            errors_count = int(n - processed)
             results = {
-                "total_co2_kg": 0.0,
-                "total_co2_tonnes": 0.0,
-                "total_montant": 0.0,
-                "details_by_line": [],
-                "summary_by_code": {},
-                "emission_sources": {},  # Nouvelle section pour traquer les sources
-                "errors": [],
-                "processed_lines": 0,
-                "success_rate": 0.0,
+                "total_co2_kg": total_co2,
+                "total_co2_tonnes": total_co2 / 1000,
+                "total_montant": total_montant,
+                "details_by_line": details,
+                "details_page": {"offset": details_offset, "limit": details_limit, "total": processed},
+                "summary_by_code": self.summarize_by_code(frame),
+                "emission_sources": emission_sources,
+                "errors": self._line_errors(frame, raw_amounts),
+                "errors_count": errors_count,
+                "processed_lines": processed,
+                "success_rate": (processed / n) * 100 if n else 0,
                 "performance_metrics": {}
             }
             
-            # Calcul de vitesse - échantillonnage
-            sample_times = []
-            sample_interval = max(1, len(data) // 10)  # 10 échantillons max
-            
-            for i, row in enumerate(data):
-                line_start_time = time.time()
-                
-                try:
-                    # Extraire le code NACRE et le montant
-                    nacre_code = row.get('code_nacre', '').strip()
-                    montant_str = str(row.get(montant_column, '0')).replace(',', '.')
-                    
-                    # Validation des données
-                    if not nacre_code:
-                        results["errors"].append(f"Ligne {i+1}: Code NACRE manquant")
-                        continue
-                    
-                    try:
-                        montant = float(montant_str)
-                    except (ValueError, TypeError):
-                        results["errors"].append(f"Ligne {i+1}: Montant invalide '{montant_str}'")
-                        continue
-                    
-                    # Récupérer le facteur d'émission (nouvelle structure)
-                    emission_info = self.get_emission_factor(nacre_code)
-                    if emission_info is None:
-                        results["errors"].append(f"Ligne {i+1}: Facteur d'émission non trouvé pour {nacre_code}")
-                        continue
-                    
-                    emission_factor = emission_info["factor"]
-                    
-                    # Calculer les émissions CO2 pour cette ligne
-                    co2_kg = montant * emission_factor
-                    
-                    # Détails de la ligne avec source d'émission
-                    line_detail = {
-                        "line_number": i + 1,
-                        "nacre_code": nacre_code,
-                        "montant": montant,
-                        "emission_factor": emission_factor,
-                        "emission_source": emission_info["source"],
-                        "emission_explanation": emission_info["explanation"],
-                        "co2_kg": co2_kg,
-                        "description": row.get('libelle', row.get('description', emission_info.get('description', 'N/A')))
-                    }
-                    
-                    results["details_by_line"].append(line_detail)
-                    
-                    # Tracker les sources d'émission
-                    source = emission_info["source"]
-                    if source not in results["emission_sources"]:
-                        results["emission_sources"][source] = {"count": 0, "total_co2_kg": 0.0}
-                    results["emission_sources"][source]["count"] += 1
-                    results["emission_sources"][source]["total_co2_kg"] += co2_kg
-                    
-                    # Agrégation par code NACRE
-                    if nacre_code not in results["summary_by_code"]:
-                        results["summary_by_code"][nacre_code] = {
-                            "total_montant": 0.0,
-                            "total_co2_kg": 0.0,
-                            "occurrences": 0,
-                            "emission_factor": emission_factor,
-                            "emission_source": source,
-                            "description": emission_info.get('description', 'N/A')
-                        }
-                    
-                    results["summary_by_code"][nacre_code]["total_montant"] += montant
-                    results["summary_by_code"][nacre_code]["total_co2_kg"] += co2_kg
-                    results["summary_by_code"][nacre_code]["occurrences"] += 1
-                    
-                    # Totaux généraux
-                    results["total_co2_kg"] += co2_kg
-                    results["total_montant"] += montant
-                    results["processed_lines"] += 1
-                    
-                    # Échantillonnage de vitesse
-                    if i % sample_interval == 0:
-                        line_time = time.time() - line_start_time
-                        sample_times.append(line_time)
-                    
-                except Exception as line_error:
-                    results["errors"].append(f"Ligne {i+1}: Erreur de traitement - {str(line_error)}")
-                    continue
-            
-            # Calculs finaux
-            total_time = time.time() - start_time
-            results["total_co2_tonnes"] = results["total_co2_kg"] / 1000
-            results["success_rate"] = (results["processed_lines"] / len(data)) * 100 if data else 0
-            
             # Métriques de performance
-            avg_line_time = sum(sample_times) / len(sample_times) if sample_times else 0
-            lines_per_second = results["processed_lines"] / total_time if total_time > 0 else 0
-            
+            total_time = time.time() - start_time
+            lines_per_second = processed / total_time if total_time > 0 else 0
             results["performance_metrics"] = {
                 "total_processing_time_seconds": round(total_time, 3),
-                "average_line_processing_time_ms": round(avg_line_time * 1000, 2),
+                "average_line_processing_time_ms": round(total_time / n * 1000, 4) if n else 0,
                 "lines_per_second": round(lines_per_second, 1),
                 "estimated_time_for_1000_lines_seconds": round(1000 / lines_per_second, 1) if lines_per_second > 0 else 0,
                 "estimated_time_for_10000_lines_minutes": round((10000 / lines_per_second) / 60, 1) if lines_per_second > 0 else 0,
-                "memory_efficiency_score": "A" if len(data) < 1000 else "B" if len(data) < 5000 else "C"
+                "memory_efficiency_score": "A" if n < 1000 else "B" if n < 5000 else "C"
             }
             
             return results
@@ -242,6 +364,45 @@ class CO2AnalyzerAI:
                     "error": "Échec du traitement"
                 }
             }
+
+    def _line_detail(self, data: Union[List[Dict[str, Any]], pd.DataFrame], frame: pd.DataFrame, pos: int) -> Dict[str, Any]:
+        code = frame["code"].iat[pos]
+        entry = self.emission_index.get(normalize_code(code)) or {}
+        row = data.iloc[pos] if isinstance(data, pd.DataFrame) else data[pos]
+        return {
+            "line_number": int(pos) + 1,
+            "nacre_code": code,
+            "montant": float(frame["montant"].iat[pos]),
+            "emission_factor": float(frame["emission_factor"].iat[pos]),
+            "emission_source": entry.get("source"),
+            "emission_explanation": entry.get("explanation"),
+            "co2_kg": float(frame["co2_kg"].iat[pos]),
+            "description": row.get('libelle', row.get('description', entry.get('description', 'N/A')))
+        }
+    
+    def line_details(self, rows: pd.DataFrame, frame: pd.DataFrame, offset: int = 0) -> Iterator[Dict[str, Any]]:
+        """Détails des lignes calculées d'un morceau (offset : lignes des morceaux précédents)"""
+        positions = np.flatnonzero((frame["status"] == "ok").to_numpy())
+        ok = frame.iloc[positions]
+        label_column = next((c for c in ("libelle", "description") if c in rows.columns), None)
+        labels = rows[label_column].iloc[positions].tolist() if label_column else None
+        entries = {code: self.emission_index.get(normalize_code(code)) or {} for code in ok["code"].cat.categories}
+        columns = zip(
+            positions.tolist(), ok["code"].tolist(), ok["montant"].tolist(),
+            ok["emission_factor"].tolist(), ok["co2_kg"].tolist(),
+        )
+        for k, (pos, code, montant, factor, co2_kg) in enumerate(columns):
+            entry = entries[code]
+            yield {
+                "line_number": offset + pos + 1,
+                "nacre_code": code,
+                "montant": montant,
+                "emission_factor": factor,
+                "emission_source": entry.get("source"),
+                "emission_explanation": entry.get("explanation"),
+                "co2_kg": co2_kg,
+                "description": labels[k] if labels is not None else entry.get("description", 'N/A'),
+            }
     
     def generate_carbon_report(self, calculation_results: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -261,7 +422,7 @@ class CO2AnalyzerAI:
                 "processed_lines": calculation_results.get("processed_lines", 0),
                 "success_rate": calculation_results.get("success_rate", 0),
                 "top_emitters": self._get_top_emitters(calculation_results.get("summary_by_code", {})),
-                "errors_count": len(calculation_results.get("errors", []))
+                "errors_count": calculation_results.get("errors_count", len(calculation_results.get("errors", [])))
             }
             
             # Prompt pour l'analyse IA
@@ -422,30 +583,35 @@ Fournis une analyse complète avec recommandations concrètes pour réduire l'em
         else:
             return "À améliorer"
     
+    def _build_status_summary(self) -> Dict[str, Any]:
+        """Comptages du statut (sources et couverture des facteurs), calculés au chargement"""
+        counts = {"emission": 0, "emission_factor": 0, "none": 0}
+        factors = []
+        for entry in self.emission_index.values():
+            counts[entry["source"] if entry else "none"] += 1
+            if entry:
+                factors.append(entry["factor"])
+        indexed = len(self.emission_index)
+        return {
+            "total_nacre_codes": len(self.emission_data) if self.emission_data is not None else 0,
+            "emission_sources_analysis": {
+                "codes_with_emission_column": counts["emission"],
+                "codes_with_emission_factor_fallback": counts["emission_factor"],
+                "codes_without_emission_data": counts["none"],
+                "priority_explanation": "Utilise 'emission' en priorité, fallback sur 'emission_factor'"
+            },
+            "emission_coverage": {
+                "codes_with_factor": len(factors),
+                "coverage_pct": round(len(factors) / indexed * 100, 1) if indexed else 0.0,
+                "min_factor": min(factors) if factors else None,
+                "max_factor": max(factors) if factors else None,
+                "mean_factor": round(sum(factors) / len(factors), 4) if factors else None,
+            },
+        }
+
     def get_status(self) -> Dict[str, Any]:
-        """Retourne le statut de l'IA CO2 avec comptage correct des codes"""
-        nacre_count = 0
-        emission_sources_count = {"emission": 0, "emission_factor": 0, "none": 0}
-        
-        if self.emission_data is not None:
-            try:
-                nacre_count = len(self.emission_data)
-                
-                # Analyser les sources d'émission disponibles
-                for _, row in self.emission_data.iterrows():
-                    emission_value = row.get('emission')
-                    emission_factor_value = row.get('emission_factor')
-                    
-                    if pd.notna(emission_value) and float(emission_value) > 0:
-                        emission_sources_count["emission"] += 1
-                    elif pd.notna(emission_factor_value) and float(emission_factor_value) > 0:
-                        emission_sources_count["emission_factor"] += 1
-                    else:
-                        emission_sources_count["none"] += 1
-                        
-            except Exception as e:
-                logger.warning(f"Erreur lors du comptage des codes NACRE: {e}")
-        
+        """Retourne le statut de l'IA CO2 (comptages précalculés, rechargés si le CSV change)"""
+        self.refresh_emission_data()
         return {
             "name": "IA - Analyse CO2",
             "model": self.model,
@@ -459,13 +625,7 @@ Fournis une analyse complète avec recommandations concrètes pour réduire l'em
                 "Calcul vitesse de traitement et prédictions"
             ],
             "nacre_dict_loaded": bool(self.nacre_dict),
-            "total_nacre_codes": nacre_count,
-            "emission_sources_analysis": {
-                "codes_with_emission_column": emission_sources_count["emission"],
-                "codes_with_emission_factor_fallback": emission_sources_count["emission_factor"], 
-                "codes_without_emission_data": emission_sources_count["none"],
-                "priority_explanation": "Utilise 'emission' en priorité, fallback sur 'emission_factor'"
-            },
+            **self.status_summary,
             "performance_features": {
                 "processing_speed_calculation": "Échantillonnage intelligent",
                 "time_prediction": "Estimation pour 1K et 10K lignes",
@@ -473,5 +633,92 @@ Fournis une analyse complète avec recommandations concrètes pour réduire l'em
             }
         }
 
+
+class FootprintAggregates:
+    """
+    Agrégats courants d'un bilan calculé par morceaux (fichiers plus grands que la mémoire)
+    
+    Chaque morceau passe par footprint_frame puis s'ajoute aux totaux par code ;
+    les totaux par catégorie et par source s'en déduisent, un code n'ayant
+    qu'une catégorie et qu'une source de facteur.
+    """
+    
+    def __init__(self, analyzer: CO2AnalyzerAI, montant_column: str):
+        self.analyzer = analyzer
+        self.montant_column = montant_column
+        self.start_time = time.time()
+        self.lines = 0
+        # code -> [total_montant, total_co2_kg, occurrences]
+        self.by_code: Dict[str, List[float]] = {}
+        self.errors: List[str] = []
+        self.errors_count = 0
+
+    def add(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """Ajoute un morceau de lignes aux totaux et retourne son calcul ligne à ligne"""
+        n = len(chunk)
+        codes = chunk["code_nacre"] if "code_nacre" in chunk.columns else pd.Series([""] * n)
+        raw_amounts = chunk[self.montant_column] if self.montant_column in chunk.columns else pd.Series(["0"] * n)
+        raw_amounts = raw_amounts.reset_index(drop=True)
+        frame = self.analyzer.footprint_frame(codes, raw_amounts)
+
+        ok = frame[frame["status"] == "ok"]
+        grouped = ok.groupby("code", sort=False, observed=True).agg(
+            total_montant=("montant", "sum"),
+            total_co2_kg=("co2_kg", "sum"),
+            occurrences=("co2_kg", "size"),
+        )
+        for code, total_montant, total_co2_kg, occurrences in grouped.itertuples():
+            totals = self.by_code.setdefault(code, [0.0, 0.0, 0])
+            totals[0] += float(total_montant)
+            totals[1] += float(total_co2_kg)
+            totals[2] += int(occurrences)
+
+        if len(self.errors) < MAX_ERRORS:
+            errors = self.analyzer._line_errors(frame, raw_amounts, offset=self.lines)
+            self.errors += errors[:MAX_ERRORS - len(self.errors)]
+        self.errors_count += n - len(ok)
+        self.lines += n
+        return frame
+
+    def result(self) -> Dict[str, Any]:
+        from .nacre_categorization import get_categorizer
+
+        categorizer = get_categorizer()
+        summary_by_code = {code: self.analyzer.code_summary(code, *totals) for code, totals in self.by_code.items()}
+        summary_by_category: Dict[str, Dict[str, Any]] = {}
+        emission_sources: Dict[str, Dict[str, Any]] = {}
+        for code, summary in summary_by_code.items():
+            category = categorizer.categorize_code(code, summary["description"])
+            cat = summary_by_category.setdefault(category, {"total_montant": 0.0, "total_co2_kg": 0.0, "occurrences": 0, "codes": 0})
+            cat["total_montant"] += summary["total_montant"]
+            cat["total_co2_kg"] += summary["total_co2_kg"]
+            cat["occurrences"] += summary["occurrences"]
+            cat["codes"] += 1
+            source = emission_sources.setdefault(summary["emission_source"], {"count": 0, "total_co2_kg": 0.0})
+            source["count"] += summary["occurrences"]
+            source["total_co2_kg"] += summary["total_co2_kg"]
+
+        processed = sum(summary["occurrences"] for summary in summary_by_code.values())
+        total_co2 = sum(summary["total_co2_kg"] for summary in summary_by_code.values())
+        total_time = time.time() - self.start_time
+        return {
+            "total_co2_kg": total_co2,
+            "total_co2_tonnes": total_co2 / 1000,
+            "total_montant": sum(summary["total_montant"] for summary in summary_by_code.values()),
+            "summary_by_code": summary_by_code,
+            "summary_by_category": summary_by_category,
+            "emission_sources": emission_sources,
+            "errors": self.errors,
+            "errors_count": self.errors_count,
+            "processed_lines": processed,
+            "total_lines": self.lines,
+            "success_rate": (processed / self.lines) * 100 if self.lines else 0,
+            "performance_metrics": {
+                "total_processing_time_seconds": round(total_time, 3),
+                "lines_per_second": round(self.lines / total_time, 1) if total_time > 0 else 0,
+            },
+        }
+
+
 # Instance globale de l'IA CO2
 co2_analyzer = CO2AnalyzerAI()
@@ -0,0 +1,147 @@
+"""
+Instantané colonnaire des résultats d'une conversion (Arrow)
+
+À la fin d'une conversion, ses résultats sont matérialisés dans un fichier Arrow
+IPC (conv_<id>.columns.arrow) : row_index, code, catégorie, confiance, montant,
+facteur d'émission et CO2. Les analyses lisent seulement les colonnes utiles,
+depuis le fichier projeté en mémoire, au lieu de reconstruire un DataFrame à
+partir du JSON à chaque requête. L'instantané porte la version du journal des
+lignes et celle des facteurs d'émission : une correction ultérieure ou un
+nouveau CSV de facteurs le fait reconstruire à la lecture suivante.
+
+pyarrow est optionnel ; sans lui le DataFrame est reconstruit à chaque lecture.
+"""
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from ..config import settings
+from .csv_io import iterate_csv
+from .co2_analyzer import co2_analyzer, parse_amounts
+from .exports import EmissionFactors
+from .storage import get_conversion_meta, get_conversion_rows, get_upload, rows_version
+from .xlsx_io import iterate_xlsx
+
+
+SNAPSHOT_COLUMNS = ["row_index", "code", "category", "confidence", "amount", "emission_factor", "co2_kg"]
+
+
+def arrow_available() -> bool:
+    try:
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _snapshot_path(conv_id: str) -> str:
+    return os.path.join(settings.storage_dir, "db", f"conv_{conv_id}.columns.arrow")
+
+
+def _amounts(conv: Dict, indices: set) -> Dict[int, Optional[float]]:
+    """Montants des lignes source (colonne amount_column de la conversion)"""
+    column = (conv.get("meta") or {}).get("amount_column")
+    up = get_upload(conv.get("upload_id") or "")
+    if not column or not indices or not up or not os.path.exists(up.get("path", "")):
+        return {}
+    path = up["path"]
+    iterator = iterate_xlsx(path) if path.lower().endswith(".xlsx") else iterate_csv(path)
+    last = max(indices)
+    raw = {}
+    for i, row in enumerate(iterator):
+        if i > last:
+            break
+        if i in indices:
+            raw[i] = row.get(column)
+    # Même lecture des montants que le calcul CO2 (décimales françaises, milliers)
+    parsed = parse_amounts(pd.Series(list(raw.values()), dtype=object))
+    return {i: (None if pd.isna(value) else float(value)) for i, value in zip(raw, parsed)}
+
+
+def build_snapshot(conv_id: str) -> pd.DataFrame:
+    """Résultats de la conversion en colonnes (corrections comprises)"""
+    conv = get_conversion_meta(conv_id) or {}
+    rows = sorted(get_conversion_rows(conv_id), key=lambda r: int(r.get("row_index", 0)))
+    index = [int(r.get("row_index", 0)) for r in rows]
+    codes = [r.get("chosen_code") or "" for r in rows]
+    amounts = _amounts(conv, set(index))
+    factors = EmissionFactors()
+    by_code = {code: factors.get(code) for code in set(codes)}
+    df = pd.DataFrame({
+        "row_index": pd.Series(index, dtype="int64"),
+        "code": pd.Series(codes, dtype="object"),
+        "category": pd.Series([r.get("chosen_category") or "" for r in rows], dtype="object"),
+        "confidence": pd.Series([int(r.get("confidence") or 0) for r in rows], dtype="int64"),
+        "amount": pd.Series([amounts.get(i) for i in index], dtype="float64"),
+        "emission_factor": pd.Series([by_code[c] for c in codes], dtype="float64"),
+    })
+    df["co2_kg"] = df["amount"] * df["emission_factor"]
+    return df
+
+
+def write_snapshot(conv_id: str) -> bool:
+    """Matérialise l'instantané Arrow de la conversion (False sans pyarrow)"""
+    if not arrow_available():
+        return False
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    version = rows_version(conv_id)
+    emission_version = co2_analyzer.emission_version()
+    table = pa.Table.from_pandas(build_snapshot(conv_id), preserve_index=False)
+    table = table.replace_schema_metadata({"rows_version": version, "emission_version": emission_version})
+    path = _snapshot_path(conv_id)
+    # Fichier temporaire propre à cet appel : plusieurs reconstructions peuvent se croiser
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp, "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def _read_snapshot(conv_id: str, columns: Optional[List[str]]) -> Optional[pd.DataFrame]:
+    """Colonnes demandées de l'instantané s'il est à jour, None sinon"""
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    path = _snapshot_path(conv_id)
+    if not os.path.exists(path):
+        return None
+    with pa.memory_map(path, "r") as source:
+        reader = ipc.open_file(source)
+        metadata = reader.schema.metadata or {}
+        if (
+            metadata.get(b"rows_version", b"").decode() != rows_version(conv_id)
+            or metadata.get(b"emission_version", b"").decode() != co2_analyzer.emission_version()
+        ):
+            return None
+        table = reader.read_all()
+        if columns:
+            table = table.select(columns)
+        return table.to_pandas()
+
+
+def load_snapshot(conv_id: str, columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+    """Résultats d'une conversion en DataFrame, limités à `columns`
+
+    L'instantané est (re)construit s'il manque ou s'il est périmé ; None si la
+    conversion n'existe pas.
+    """
+    if get_conversion_meta(conv_id) is None:
+        return None
+    if arrow_available():
+        df = _read_snapshot(conv_id, columns)
+        if df is None and write_snapshot(conv_id):
+            df = _read_snapshot(conv_id, columns)
+        if df is not None:
+            return df
+    df = build_snapshot(conv_id)
+    return df[columns] if columns else df
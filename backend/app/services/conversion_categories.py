@@ -0,0 +1,101 @@
+"""
+Données catégorisées d'une conversion pour les visualisations carbone
+
+Les lignes catégorisées d'une conversion et leurs statistiques par catégorie
+sont gardées en mémoire par (conversion, version des données, colonne
+montant) : les vues successives d'une conversion inchangée ne relisent ni
+n'agrègent à nouveau ses lignes. La version combine le journal des lignes, les
+facteurs d'émission et le dictionnaire NACRE : une nouvelle ligne, une
+correction ou un nouveau CSV fait recalculer à la vue suivante.
+
+Les DataFrames et dictionnaires renvoyés sont partagés : ne pas les modifier.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pandas as pd
+
+from .co2_analyzer import co2_analyzer
+from .columnar import load_snapshot
+from .conversion_footprint import footprint_lines
+from .nacre_categorization import get_categorizer
+from .storage import get_conversion_meta, rows_version
+
+
+# Nombre d'entrées (conversion, version, colonne, type) gardées en mémoire
+CATEGORIES_CACHE_SIZE = 32
+_cache: "OrderedDict[tuple, Any]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def data_version(conv_id: str) -> str:
+    """Version des données catégorisées : journal des lignes, facteurs d'émission et dictionnaire NACRE"""
+    categorizer = get_categorizer()
+    categorizer.refresh_data()
+    return f"{rows_version(conv_id)}|{co2_analyzer.emission_version()}|{categorizer.csv_mtime}"
+
+
+def _cached(key: tuple, compute: Callable[[], Any]) -> Any:
+    """Valeur en cache pour key, calculée (hors verrou) si absente ; éviction LRU"""
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    value = compute()
+    with _cache_lock:
+        _cache[key] = value
+        while len(_cache) > CATEGORIES_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return value
+
+
+def snapshot_categories(conv_id: str) -> Optional[pd.DataFrame]:
+    """Lignes réelles d'une conversion (instantané colonnaire) catégorisées, None sans montants"""
+    def compute() -> Optional[pd.DataFrame]:
+        df = load_snapshot(conv_id, ["code", "amount", "co2_kg"])
+        if df is None or not df["amount"].notna().any():
+            return None
+        return pd.DataFrame({
+            "category": get_categorizer().categorize_many(df["code"]),
+            "montant": df["amount"],
+            "total_emission": df["co2_kg"],
+            "code_nacre": df["code"],
+        })
+
+    return _cached((conv_id, data_version(conv_id), None, "snapshot"), compute)
+
+
+def snapshot_category_stats(conv_id: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Statistiques par catégorie de l'instantané de la conversion, None sans montants"""
+    def compute() -> Optional[Dict[str, Dict[str, Any]]]:
+        df = snapshot_categories(conv_id)
+        return None if df is None else get_categorizer().conversion_category_stats(df)
+
+    return _cached((conv_id, data_version(conv_id), None, "snapshot_stats"), compute)
+
+
+def footprint_categories(conv_id: str, montant_column: str) -> Optional[Tuple[pd.DataFrame, Dict[str, Dict[str, Any]]]]:
+    """
+    Lignes chiffrées (calcul ligne à ligne, statut ok) catégorisées et leurs
+    statistiques par catégorie ; None si la conversion n'existe pas
+
+    ValueError si la colonne montant est absente du fichier d'origine.
+    """
+    if get_conversion_meta(conv_id) is None:
+        return None
+
+    def compute() -> Tuple[pd.DataFrame, Dict[str, Dict[str, Any]]]:
+        _, frame = footprint_lines(conv_id, montant_column)
+        categorizer = get_categorizer()
+        ok = frame[frame["status"] == "ok"]
+        codes = ok["code"].astype(str)
+        df = pd.DataFrame({
+            "category": categorizer.categorize_many(codes).to_numpy(),
+            "montant": ok["montant"].to_numpy(),
+            "total_emission": ok["co2_kg"].to_numpy(),
+            "code_nacre": codes.to_numpy(),
+        })
+        return df, categorizer.conversion_category_stats(df)
+
+    return _cached((conv_id, data_version(conv_id), montant_column, "footprint"), compute)
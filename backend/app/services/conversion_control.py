@@ -0,0 +1,134 @@
+"""
+Annulation et mise en pause coopératives des conversions
+
+Une demande d'arrêt est enregistrée dans son propre fichier (conv_<id>.control,
+remplacé atomiquement), visible des workers des autres processus sans passer par
+le document de la conversion que leurs écritures de progression réécrivent, et
+dans un registre local qui interrompt aussitôt les requêtes LLM en vol de ce
+processus. Les moteurs vérifient la demande entre deux batches ; les lignes déjà
+enregistrées restent consultables et une conversion en pause reprend depuis son
+checkpoint.
+"""
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from ..config import settings
+
+
+# Action demandée -> statut final de la conversion
+STOP_ACTIONS = {"cancel": "cancelled", "pause": "paused"}
+
+
+class ConversionStopped(Exception):
+    """Levée par un moteur qui s'arrête à la demande de l'utilisateur"""
+
+    def __init__(self, action: str, results: Optional[List[Any]] = None):
+        self.action = action
+        self.status = STOP_ACTIONS[action]
+        # Résultats partiels (None pour les lignes non traitées), moteur asynchrone
+        self.results = results
+        super().__init__(f"Conversion {self.status}")
+
+
+_requests: Dict[str, str] = {}
+_aborts: Dict[str, List[Callable[[], None]]] = {}
+_lock = threading.Lock()
+
+
+def _signal(conv_id: str, action: str) -> None:
+    with _lock:
+        _requests[conv_id] = action
+        hooks = _aborts.pop(conv_id, [])
+    for hook in hooks:
+        try:
+            hook()
+        except Exception as e:
+            print(f"⚠️ Interruption des requêtes de {conv_id}: {e}")
+
+
+def _control_path(conv_id: str) -> str:
+    return os.path.join(settings.storage_dir, "db", f"conv_{conv_id}.control")
+
+
+def stored_request(conv_id: str) -> Optional[str]:
+    """Action d'arrêt enregistrée pour la conversion (tous processus), None sinon"""
+    try:
+        with open(_control_path(conv_id), "r", encoding="utf-8") as f:
+            action = f.read().strip()
+    except OSError:
+        return None
+    return action if action in STOP_ACTIONS else None
+
+
+def request_stop(conv_id: str, action: str) -> None:
+    """Demande l'arrêt ("cancel" ou "pause") d'une conversion en cours"""
+    path = _control_path(conv_id)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(action)
+    os.replace(tmp, path)
+    _signal(conv_id, action)
+
+
+def stop_requested(conv_id: str, check_storage: bool = True) -> Optional[str]:
+    """Action d'arrêt en attente pour une conversion, None sinon
+
+    Sans `check_storage`, seul le registre local est consulté (aucune lecture disque).
+    """
+    with _lock:
+        action = _requests.get(conv_id)
+    if action or not check_storage:
+        return action
+    action = stored_request(conv_id)
+    if action:
+        # Demande faite depuis un autre processus : interrompre aussi les requêtes locales
+        _signal(conv_id, action)
+        return action
+    return None
+
+
+def raise_if_stopped(conv_id: str, check_storage: bool = True) -> None:
+    action = stop_requested(conv_id, check_storage)
+    if action:
+        raise ConversionStopped(action)
+
+
+def on_stop(conv_id: str, hook: Callable[[], None]) -> None:
+    """Enregistre une fonction qui interrompt les requêtes en vol lors d'un arrêt"""
+    with _lock:
+        action = _requests.get(conv_id)
+        if action is None:
+            _aborts.setdefault(conv_id, []).append(hook)
+            return
+    hook()
+
+
+def clear_local(conv_id: str) -> None:
+    """Oublie les demandes et interruptions de ce processus (début d'exécution)
+
+    Une demande faite pendant que la conversion était en file reste enregistrée
+    et sera relue au premier contrôle.
+    """
+    with _lock:
+        _requests.pop(conv_id, None)
+        _aborts.pop(conv_id, None)
+
+
+def clear(conv_id: str) -> None:
+    """Oublie la demande enregistrée et les demandes locales (fin d'exécution, reprise)"""
+    clear_local(conv_id)
+    try:
+        os.remove(_control_path(conv_id))
+    except OSError:
+        pass
+
+
+def control_status(conv: Dict[str, Any]) -> Optional[str]:
+    """Statut affiché pendant qu'une demande d'arrêt attend la fin du batch en cours"""
+    if conv.get("status") not in {"running", "processing"}:
+        return None
+    action = stored_request(conv.get("id") or "")
+    if action:
+        return "cancelling" if action == "cancel" else "pausing"
+    return None
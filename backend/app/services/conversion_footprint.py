@@ -0,0 +1,141 @@
+"""
+Bilan carbone d'une conversion enregistrée, calculé côté serveur
+
+Les codes retenus (corrections comprises, depuis l'instantané colonnaire) sont
+joints par row_index à la colonne montant du fichier d'origine, relue sur le
+serveur : le client n'a plus à renvoyer les lignes. Le résumé est mis en cache
+sur disque (conv_<id>.footprint.json) avec la version du journal des lignes, la
+colonne montant et la version des facteurs d'émission ; une nouvelle ligne, une
+correction ou un nouveau CSV de facteurs le fait recalculer.
+"""
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+from ..config import settings
+from .co2_analyzer import co2_analyzer
+from .carbon_totals import carbon_totals, upload_amounts
+from .columnar import load_snapshot
+from .storage import get_conversion_meta, rows_version
+
+
+def _cache_path(conv_id: str) -> str:
+    return os.path.join(settings.storage_dir, "db", f"conv_{conv_id}.footprint.json")
+
+
+def _read_cache(conv_id: str, key: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_cache_path(conv_id), "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cached if cached.get("key") == key else None
+
+
+def _write_cache(conv_id: str, entry: Dict[str, Any]) -> None:
+    path = _cache_path(conv_id)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def footprint_table(conv_id: str, montant_column: str) -> Optional[pd.DataFrame]:
+    """Lignes de la conversion (row_index, code_nacre, montant brut), None si elle n'existe pas"""
+    conv = get_conversion_meta(conv_id)
+    if conv is None:
+        return None
+    rows = load_snapshot(conv_id, ["row_index", "code"])
+    amounts = upload_amounts(conv, montant_column)
+    index = rows["row_index"].to_numpy()
+    return pd.DataFrame({
+        "row_index": index,
+        "code_nacre": rows["code"].to_numpy(),
+        "montant": amounts.reindex(index).to_numpy(),
+    })
+
+
+def conversion_footprint(
+    conv_id: str,
+    montant_column: Optional[str] = None,
+    details_offset: int = 0,
+    details_limit: Optional[int] = 0,
+    report: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """
+    Bilan carbone d'une conversion (None si elle n'existe pas)
+
+    montant_column vaut par défaut la colonne montant de la conversion ; pour
+    celle-ci le résumé vient des totaux courants (carbon_totals), sans relire
+    les lignes. Sinon le résumé sans détails (et le rapport s'il est demandé)
+    est servi depuis le cache tant que les lignes n'ont pas changé ; une page
+    de détails par ligne est toujours recalculée. ValueError si la colonne
+    montant est inconnue.
+    """
+    conv = get_conversion_meta(conv_id)
+    if conv is None:
+        return None
+    montant_column = montant_column or (conv.get("meta") or {}).get("amount_column")
+    if not montant_column:
+        raise ValueError("Colonne montant non spécifiée")
+
+    if not details_limit and not report and montant_column == (conv.get("meta") or {}).get("amount_column"):
+        # Colonne montant de la conversion : totaux tenus à jour ligne à ligne
+        totals = carbon_totals(conv_id)
+        if totals is not None:
+            return {
+                **totals,
+                "conversion_id": conv_id,
+                "montant_column": montant_column,
+                "rows_version": rows_version(conv_id),
+                "cached": True,
+            }
+
+    key = {
+        "rows_version": rows_version(conv_id),
+        "montant_column": montant_column,
+        "emission_version": co2_analyzer.emission_version(),
+    }
+    cached = _read_cache(conv_id, key) if not details_limit else None
+    if cached is not None:
+        results, report_doc = cached["results"], cached.get("report")
+    else:
+        table = footprint_table(conv_id, montant_column)
+        results = co2_analyzer.calculate_carbon_footprint(
+            table, "montant", details_offset=details_offset, details_limit=details_limit,
+        )
+        if "error" in results:
+            return results
+        # Numéro de ligne dans le calcul -> ligne du fichier d'origine
+        for detail in results["details_by_line"]:
+            detail["row_index"] = int(table["row_index"].iat[detail["line_number"] - 1])
+        report_doc = None
+    from_cache = cached is not None and (not report or report_doc is not None)
+    if report and report_doc is None:
+        report_doc = co2_analyzer.generate_carbon_report(results)
+    if not details_limit and not from_cache:
+        _write_cache(conv_id, {"key": key, "results": results, "report": report_doc})
+
+    response = report_doc if report else results
+    return {
+        **response,
+        "conversion_id": conv_id,
+        "montant_column": montant_column,
+        "rows_version": key["rows_version"],
+        "cached": from_cache,
+    }
+
+
+def footprint_lines(conv_id: str, montant_column: str) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Lignes de la conversion et leur calcul ligne à ligne (footprint_frame)"""
+    table = footprint_table(conv_id, montant_column)
+    if table is None:
+        return None
+    return table, co2_analyzer.footprint_frame(table["code_nacre"], table["montant"])
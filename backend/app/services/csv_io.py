@@ -2,6 +2,7 @@ import csv
 from typing import Iterator, Tuple, List, Dict
 import chardet
 import io
+import pandas as pd
 
 
 def _detect_encoding(path: str) -> str:
@@ -22,14 +23,7 @@ def _read_text(path: str) -> str:
     return data.decode(enc, errors='replace')
 
 
-def iterate_csv(path: str) -> Iterator[dict]:
-    text = _read_text(path)
-    # sniff delimiter from header line
-    first_n = text.splitlines()[:1]
-    if first_n:
-        header = first_n[0]
-    else:
-        header = ''
+def _sniff_delimiter(header: str) -> str:
     delimiters = [';', '\t', ',']
     best = ','
     best_count = 0
@@ -37,29 +31,44 @@ def iterate_csv(path: str) -> Iterator[dict]:
         c = header.count(d)
         if c > best_count:
             best = d; best_count = c
-    reader = csv.DictReader(io.StringIO(text), delimiter=best)
-    for row in reader:
-        yield row
+    return best
+
+
+def _open_reader(f) -> csv.DictReader:
+    # sniff delimiter from header line
+    header = f.readline()
+    f.seek(0)
+    return csv.DictReader(f, delimiter=_sniff_delimiter(header))
+
+
+def iterate_csv(path: str) -> Iterator[dict]:
+    """Stream the data rows of a CSV file (never loads the whole file)."""
+    enc = _detect_encoding(path)
+    with open(path, 'r', encoding=enc, errors='replace', newline='') as f:
+        for row in _open_reader(f):
+            yield row
+
+
+def read_csv_chunks(path: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Stream a CSV file as DataFrames of at most chunk_rows rows (values kept as strings)."""
+    enc = _detect_encoding(path)
+    with open(path, 'r', encoding=enc, errors='replace', newline='') as f:
+        sep = _sniff_delimiter(f.readline())
+        f.seek(0)
+        for chunk in pd.read_csv(f, sep=sep, dtype=str, keep_default_na=False, chunksize=max(1, chunk_rows)):
+            yield chunk
 
 
 def preview_csv(path: str, limit: int = 20) -> Tuple[List[str], List[Dict]]:
-    text = _read_text(path)
-    first_n = text.splitlines()[:1]
-    header = first_n[0] if first_n else ''
-    delimiters = [';', '\t', ',']
-    best = ','
-    best_count = 0
-    for d in delimiters:
-        c = header.count(d)
-        if c > best_count:
-            best = d; best_count = c
-    reader = csv.DictReader(io.StringIO(text), delimiter=best)
-    cols = reader.fieldnames or []
-    rows: List[Dict] = []
-    for i, row in enumerate(reader):
-        if i >= limit:
-            break
-        rows.append(row)
+    enc = _detect_encoding(path)
+    with open(path, 'r', encoding=enc, errors='replace', newline='') as f:
+        reader = _open_reader(f)
+        cols = reader.fieldnames or []
+        rows: List[Dict] = []
+        for i, row in enumerate(reader):
+            if i >= limit:
+                break
+            rows.append(row)
     return cols, rows
 
 
@@ -0,0 +1,166 @@
+"""
+Flux d'événements des conversions (Server-Sent Events)
+
+Le moteur signale chaque avancement au bus d'événements ; les flux SSE abonnés
+se réveillent et n'envoient que le delta : lignes ajoutées au journal depuis leur
+curseur et statut lorsque le document de la conversion a changé. Un worker d'un
+autre processus ne peut pas réveiller le bus : les flux vérifient aussi les
+fichiers toutes les EVENTS_POLL_SECONDS.
+"""
+import asyncio
+import json
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from ..config import settings
+from .carbon_totals import live_totals
+from .conversion_control import control_status
+from .storage import (
+    conversion_stamp, get_conversion_meta, rows_cursor_after, tail_conversion_edits, tail_conversion_rows,
+)
+
+
+# Statuts après lesquels la conversion n'évolue plus (jusqu'à une reprise)
+FINAL_STATUSES = {"completed", "cancelled", "paused", "error", "failed"}
+# Nombre maximal de lignes par événement "rows"
+ROWS_PER_EVENT = 500
+# Commentaire envoyé en l'absence d'événement pour garder la connexion ouverte
+HEARTBEAT_SECONDS = 15.0
+
+
+class ConversionEventBus:
+    """Réveille les flux abonnés à une conversion (threads du moteur -> boucle asyncio)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+
+    def subscribe(self, conv_id: str) -> asyncio.Event:
+        event = asyncio.Event()
+        with self.lock:
+            self.subscribers.setdefault(conv_id, set()).add((asyncio.get_running_loop(), event))
+        return event
+
+    def unsubscribe(self, conv_id: str, event: asyncio.Event) -> None:
+        with self.lock:
+            subs = self.subscribers.get(conv_id, set())
+            for sub in [s for s in subs if s[1] is event]:
+                subs.discard(sub)
+            if not subs:
+                self.subscribers.pop(conv_id, None)
+
+    def notify(self, conv_id: str) -> None:
+        with self.lock:
+            subs = list(self.subscribers.get(conv_id, ()))
+        for loop, event in subs:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Boucle fermée : le flux a disparu
+                pass
+
+
+_bus = ConversionEventBus()
+
+
+def notify_conversion(conv_id: str) -> None:
+    """Signale un avancement de la conversion (lignes enregistrées, statut)"""
+    _bus.notify(conv_id)
+
+
+def _sse(event: str, data: Any, event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _row_events(rows: List[Dict[str, Any]], last_seq: int) -> Tuple[List[str], int]:
+    """Événements "rows" pour les lignes postérieures à last_seq, et le nouveau last_seq"""
+    rows = [r for r in rows if int(r.get("seq", 0)) > last_seq]
+    events = []
+    for i in range(0, len(rows), ROWS_PER_EVENT):
+        chunk = rows[i:i + ROWS_PER_EVENT]
+        last_seq = int(chunk[-1].get("seq", last_seq))
+        events.append(_sse("rows", {"rows": chunk, "last_seq": last_seq}, last_seq))
+    return events, last_seq
+
+
+def _progress(conv: Dict[str, Any]) -> Dict[str, Any]:
+    stats = conv.get("stats", {})
+    co2 = live_totals(conv.get("id") or "")
+    if co2:
+        stats = {**stats, "co2": co2}
+    return {
+        "conversion_id": conv.get("id"),
+        "status": control_status(conv) or conv.get("status", "unknown"),
+        "processed_rows": conv.get("processed_rows", 0),
+        "total_rows": conv.get("total_rows", 0),
+        "stats": stats,
+    }
+
+
+async def conversion_event_stream(
+    conv_id: str,
+    after: int = 0,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+) -> AsyncIterator[str]:
+    """Événements SSE d'une conversion
+
+    - `rows` : lignes enregistrées (seq > after), `id` = dernier seq pour Last-Event-ID
+    - `edits` : corrections faites depuis la connexion (row_index, champs modifiés)
+    - `progress` : statut et compteurs, à chaque mise à jour du document
+    - `end` : la conversion est terminée, annulée, en pause ou en erreur
+    """
+    event = _bus.subscribe(conv_id)
+    # Reconnexion : se placer directement après la dernière ligne reçue
+    cursor = await asyncio.to_thread(rows_cursor_after, conv_id, after) if after else None
+    # Les lignes envoyées intègrent déjà les corrections antérieures
+    _, edits_cursor = await asyncio.to_thread(tail_conversion_edits, conv_id)
+    stamp = None
+    last_seq = after
+    last_sent = time.time()
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            if is_disconnected is not None and await is_disconnected():
+                break
+            event.clear()
+
+            rows, cursor = await asyncio.to_thread(tail_conversion_rows, conv_id, cursor)
+            events, last_seq = _row_events(rows, last_seq)
+            for chunk in events:
+                yield chunk
+                last_sent = time.time()
+
+            edits, edits_cursor = await asyncio.to_thread(tail_conversion_edits, conv_id, edits_cursor)
+            if edits:
+                yield _sse("edits", {"edits": [{"row_index": e.get("row_index"), "changes": e.get("changes")} for e in edits]})
+                last_sent = time.time()
+
+            current = conversion_stamp(conv_id)
+            if current != stamp:
+                stamp = current
+                conv = await asyncio.to_thread(get_conversion_meta, conv_id)
+                if conv is None:
+                    yield _sse("end", {"conversion_id": conv_id, "status": "missing", "last_seq": last_seq})
+                    break
+                yield _sse("progress", _progress(conv))
+                last_sent = time.time()
+                if conv.get("status") in FINAL_STATUSES:
+                    # Lignes enregistrées juste avant le statut final
+                    rows, cursor = await asyncio.to_thread(tail_conversion_rows, conv_id, cursor)
+                    events, last_seq = _row_events(rows, last_seq)
+                    for chunk in events:
+                        yield chunk
+                    yield _sse("end", {"conversion_id": conv_id, "status": conv.get("status"), "last_seq": last_seq})
+                    break
+
+            if time.time() - last_sent >= HEARTBEAT_SECONDS:
+                yield ": ping\n\n"
+                last_sent = time.time()
+            try:
+                await asyncio.wait_for(event.wait(), timeout=settings.events_poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        _bus.unsubscribe(conv_id, event)
@@ -0,0 +1,223 @@
+"""
+Exports des conversions (CSV, XLSX, Parquet)
+
+Le fichier d'origine est relu ligne à ligne et joint aux classifications ; les
+lignes produites sont écrites au fil de l'eau : CSV par paquets d'octets, XLSX
+avec le mode write_only d'openpyxl, Parquet par row groups via pyarrow (optionnel).
+"""
+import csv
+import os
+import tempfile
+import zlib
+from io import StringIO
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from ..models import ExportCreate
+from .co2_analyzer import parse_amounts
+from .storage import get_conversion_rows
+
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+# Lignes par row group Parquet
+PARQUET_ROW_GROUP_ROWS = 50_000
+# Taille des morceaux lus dans les fichiers XLSX/Parquet générés
+FILE_CHUNK_BYTES = 1 << 20
+# Lignes dont les montants sont parsés ensemble (mêmes règles que le bilan CO2)
+AMOUNT_CHUNK_ROWS = 5_000
+
+
+def _classifications(conv_id: str) -> Dict[int, Tuple]:
+    """row_index -> (code, catégorie, confiance), corrections comprises"""
+    return {
+        int(r.get("row_index", i)): (r.get("chosen_code", ""), r.get("chosen_category", ""), r.get("confidence", ""))
+        for i, r in enumerate(get_conversion_rows(conv_id))
+    }
+
+
+class EmissionFactors:
+    """Facteurs d'émission mémorisés par code pour la durée d'un export"""
+
+    def __init__(self):
+        from .co2_analyzer import co2_analyzer
+        self.analyzer = co2_analyzer
+        self.factors: Dict[str, Optional[float]] = {}
+
+    def get(self, code: str) -> Optional[float]:
+        if not code:
+            return None
+        if code not in self.factors:
+            info = self.analyzer.get_emission_factor(code)
+            self.factors[code] = info["factor"] if info else None
+        return self.factors[code]
+
+
+def _with_co2(pending: List[Tuple[List[Any], Any, Optional[float]]]) -> Iterator[List[Any]]:
+    """Lignes en attente complétées du CO2 (montant × facteur), montants parsés en bloc"""
+    amounts = parse_amounts(pd.Series([amount for _, amount, _ in pending], dtype=object)).to_numpy()
+    for (values, _, factor), amount in zip(pending, amounts):
+        values.append(round(float(amount) * factor, 6) if factor is not None and amount == amount else "")
+        yield values
+
+
+def export_table(iterator: Iterable[Dict[str, Any]], payload: ExportCreate) -> Iterator[List[Any]]:
+    """En-têtes (premier élément) puis valeurs de chaque ligne exportée
+
+    Les classifications ne sont lues qu'après l'envoi des en-têtes. Avec le CO2,
+    les lignes sont produites par paquets de AMOUNT_CHUNK_ROWS.
+    """
+    pref = payload.classification_prefix
+    keep: List[str] = []
+    by_idx: Dict[int, Tuple] = {}
+    factors = EmissionFactors() if payload.include_emissions else None
+    with_co2 = False
+    pending: List[Tuple[List[Any], Any, Optional[float]]] = []
+    for i, row in enumerate(iterator):
+        if i == 0:
+            # En-têtes stables : colonnes conservées, classification puis émissions
+            keep = [col for col in payload.columns_to_keep if col in row]
+            headers = list(keep)
+            if payload.include_classification:
+                headers += [f"{pref}code", f"{pref}category", f"{pref}confidence"]
+            if factors is not None:
+                headers.append(f"{pref}emission_factor")
+                with_co2 = bool(payload.amount_column) and payload.amount_column in row
+                if with_co2:
+                    headers.append(f"{pref}co2_kg")
+            yield headers
+            if payload.include_classification or factors is not None:
+                by_idx = _classifications(payload.conversion_id)
+        cls = by_idx.get(i)
+        values = [row[col] for col in keep]
+        if payload.include_classification:
+            values += list(cls) if cls else ["", "", ""]
+        if factors is not None:
+            factor = factors.get(cls[0]) if cls else None
+            values.append(factor if factor is not None else "")
+            if with_co2:
+                pending.append((values, row.get(payload.amount_column), factor))
+                if len(pending) >= AMOUNT_CHUNK_ROWS:
+                    yield from _with_co2(pending)
+                    pending = []
+                continue
+        yield values
+    if pending:
+        yield from _with_co2(pending)
+
+
+def csv_chunks(table: Iterable[List[Any]], chunk_bytes: int) -> Iterator[bytes]:
+    """Lignes CSV encodées par paquets d'environ chunk_bytes octets"""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for n, values in enumerate(table):
+        writer.writerow(values)
+        # En-têtes envoyés aussitôt, les lignes par paquets
+        if n == 0 or buf.tell() >= chunk_bytes:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 : format gzip
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+
+def _temp_path(suffix: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="nacre_export_", suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def _file_chunks(path: str) -> Iterator[bytes]:
+    """Contenu d'un fichier généré, supprimé une fois envoyé"""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(FILE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def xlsx_chunks(table: Iterable[List[Any]]) -> Iterator[bytes]:
+    """Classeur écrit en mode write_only (lignes non conservées en mémoire)
+
+    Un XLSX est une archive zip : le fichier est envoyé une fois complet.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("export")
+    for values in table:
+        ws.append(values)
+    path = _temp_path(".xlsx")
+    try:
+        wb.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    yield from _file_chunks(path)
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def parquet_chunks(table: Iterable[List[Any]], payload: ExportCreate) -> Iterator[bytes]:
+    """Fichier Parquet écrit par row groups de PARQUET_ROW_GROUP_ROWS lignes"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = iter(table)
+    headers = next(rows, None)
+    if headers is None:
+        return
+    pref = payload.classification_prefix
+    numeric = {
+        f"{pref}confidence": pa.int64(),
+        f"{pref}emission_factor": pa.float64(),
+        f"{pref}co2_kg": pa.float64(),
+    }
+    schema = pa.schema([(h, numeric.get(h, pa.string())) for h in headers])
+    casts = [(int if t == pa.int64() else float) if t != pa.string() else str for t in schema.types]
+
+    def _group(batch: List[List[Any]]):
+        columns = [
+            pa.array([None if v in ("", None) else cast(v) for v in column], type=t)
+            for column, cast, t in zip(zip(*batch), casts, schema.types)
+        ]
+        return pa.Table.from_arrays(columns, schema=schema)
+
+    path = _temp_path(".parquet")
+    try:
+        with pq.ParquetWriter(path, schema) as writer:
+            batch: List[List[Any]] = []
+            for values in rows:
+                batch.append(values)
+                if len(batch) >= PARQUET_ROW_GROUP_ROWS:
+                    writer.write_table(_group(batch))
+                    batch = []
+            if batch:
+                writer.write_table(_group(batch))
+    except Exception:
+        os.remove(path)
+        raise
+    yield from _file_chunks(path)
@@ -0,0 +1,301 @@
+"""
+File de travaux durable (SQLite) pour les conversions
+
+L'API enregistre les conversions à traiter ; des workers (thread intégré à l'API
+ou processus `python -m app.worker`) les réservent une à une, par priorité puis
+ordre d'arrivée. Un worker signale sa présence par un battement régulier : un
+travail dont le worker a disparu est remis en file et repris depuis son checkpoint.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from ..config import settings
+
+
+DB_PATH = os.path.join(settings.storage_dir, "db", "jobs.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversion_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_pick ON jobs (status, priority DESC, id);
+CREATE INDEX IF NOT EXISTS jobs_conversion ON jobs (conversion_id);
+CREATE TABLE IF NOT EXISTS llm_slots (
+    slot INTEGER PRIMARY KEY,
+    holder TEXT,
+    acquired_at REAL
+);
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+@contextmanager
+def _db(path: str) -> Iterator[sqlite3.Connection]:
+    fresh = not os.path.exists(path)
+    if fresh:
+        # Base absente (premier lancement ou historique effacé)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = _connect(path)
+    try:
+        if fresh:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        yield conn
+    finally:
+        conn.close()
+
+
+def _conversion_failed(conversion_id: str, error: Optional[str]) -> None:
+    """Passe en erreur une conversion dont le travail a définitivement échoué"""
+    from .storage import get_conversion_meta, update_conversion
+
+    conv = get_conversion_meta(conversion_id)
+    if conv is None or conv.get("status") in {"completed", "cancelled", "paused", "error"}:
+        return
+    update_conversion(conversion_id, {"status": "error", "error": error or "Échec du traitement"})
+    try:
+        from .events import notify_conversion
+        notify_conversion(conversion_id)
+    except Exception:
+        pass
+
+
+def _row(r: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+    if r is None:
+        return None
+    job = dict(r)
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+
+class JobQueue:
+    """File de travaux partagée entre l'API et les workers (plusieurs processus)"""
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        with _db(path) as conn:
+            conn.executescript(_SCHEMA)
+
+    def enqueue(self, conversion_id: str, payload: Dict[str, Any], priority: int = 0) -> int:
+        with _db(self.path) as conn:
+            cur = conn.execute(
+                "INSERT INTO jobs (conversion_id, payload, priority, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (conversion_id, json.dumps(payload, ensure_ascii=False), priority, time.time()),
+            )
+            return int(cur.lastrowid)
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Réserve le prochain travail en file (priorité la plus haute, puis le plus ancien)"""
+        with _db(self.path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            r = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id LIMIT 1"
+            ).fetchone()
+            if r is None:
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker_id = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ? WHERE id = ?",
+                (worker_id, now, now, r["id"]),
+            )
+            conn.execute("COMMIT")
+            job = _row(r)
+            job.update({"status": "running", "worker_id": worker_id, "attempts": r["attempts"] + 1})
+            return job
+
+    def heartbeat(self, job_id: int) -> None:
+        with _db(self.path) as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def finish(self, job_id: int, status: str = "done", error: Optional[str] = None) -> None:
+        with _db(self.path) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+            r = conn.execute("SELECT conversion_id FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if status == "failed" and r is not None:
+            _conversion_failed(r["conversion_id"], error)
+
+    def cancel_queued(self, conversion_id: str) -> int:
+        """Retire de la file les travaux pas encore réservés d'une conversion"""
+        with _db(self.path) as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE conversion_id = ? AND status = 'queued'",
+                (time.time(), conversion_id),
+            )
+            return cur.rowcount
+
+    def requeue_stale(self, stale_after: Optional[float] = None) -> int:
+        """Remet en file les travaux dont le worker ne donne plus signe de vie"""
+        stale_after = stale_after or settings.job_stale_seconds
+        limit = time.time() - stale_after
+        with _db(self.path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            failed = [r["conversion_id"] for r in conn.execute(
+                "SELECT conversion_id FROM jobs WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (limit, settings.job_max_attempts),
+            )]
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Trop de tentatives', finished_at = ? "
+                "WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (time.time(), limit, settings.job_max_attempts),
+            )
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', worker_id = NULL WHERE status = 'running' AND heartbeat_at < ?",
+                (limit,),
+            )
+            conn.execute("COMMIT")
+        for conversion_id in failed:
+            _conversion_failed(conversion_id, "Trop de tentatives")
+        return cur.rowcount
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with _db(self.path) as conn:
+            return _row(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def active_for(self, conversion_id: str) -> Optional[Dict[str, Any]]:
+        """Travail en file ou en cours pour une conversion"""
+        with _db(self.path) as conn:
+            return _row(conn.execute(
+                "SELECT * FROM jobs WHERE conversion_id = ? AND status IN ('queued', 'running') ORDER BY id DESC LIMIT 1",
+                (conversion_id,),
+            ).fetchone())
+
+    def latest_for(self, conversion_id: str) -> Optional[Dict[str, Any]]:
+        with _db(self.path) as conn:
+            return _row(conn.execute(
+                "SELECT * FROM jobs WHERE conversion_id = ? ORDER BY id DESC LIMIT 1", (conversion_id,)
+            ).fetchone())
+
+    def position(self, job: Dict[str, Any]) -> int:
+        """Nombre de travaux qui passeront avant celui-ci (0 s'il est en cours)"""
+        if job.get("status") != "queued":
+            return 0
+        with _db(self.path) as conn:
+            r = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority > ? OR (priority = ? AND id < ?))",
+                (job["priority"], job["priority"], job["id"]),
+            ).fetchone()
+            return int(r[0])
+
+    def status(self, conversion_id: str) -> Optional[Dict[str, Any]]:
+        """Résumé du travail d'une conversion pour ConversionStatus.stats"""
+        job = self.latest_for(conversion_id)
+        if job is None:
+            return None
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "priority": job["priority"],
+            "queue_position": self.position(job),
+            "attempts": job["attempts"],
+            "worker": job["worker_id"],
+            "error": job["error"],
+        }
+
+    def acquire_llm_slot(self, holder: str, size: int) -> Optional[int]:
+        """Réserve une des `size` places LLM partagées par tous les processus ; None si toutes sont prises"""
+        now = time.time()
+        with _db(self.path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR IGNORE INTO llm_slots (slot) VALUES (?)", [(i,) for i in range(size)])
+            r = conn.execute(
+                "SELECT slot FROM llm_slots WHERE slot < ? AND (holder IS NULL OR acquired_at < ?) ORDER BY slot LIMIT 1",
+                (size, now - settings.llm_slot_stale_seconds),
+            ).fetchone()
+            if r is not None:
+                conn.execute("UPDATE llm_slots SET holder = ?, acquired_at = ? WHERE slot = ?", (holder, now, r["slot"]))
+            conn.execute("COMMIT")
+            return None if r is None else int(r["slot"])
+
+    def release_llm_slot(self, slot: int, holder: str) -> None:
+        with _db(self.path) as conn:
+            conn.execute("UPDATE llm_slots SET holder = NULL WHERE slot = ? AND holder = ?", (slot, holder))
+
+    def counts(self) -> Dict[str, int]:
+        with _db(self.path) as conn:
+            return {r["status"]: r["n"] for r in conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
+
+
+class JobWorker:
+    """Boucle de traitement : réserve un travail, l'exécute, signale sa fin"""
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], Optional[str]], worker_id: Optional[str] = None,
+                 queue: Optional[JobQueue] = None):
+        # handler(job) exécute la conversion et renvoie un message d'erreur ou None
+        self.handler = handler
+        self.worker_id = worker_id or f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.queue = queue or get_job_queue()
+
+    def _beat(self, job_id: int, done: threading.Event):
+        while not done.wait(settings.job_heartbeat_seconds):
+            try:
+                self.queue.heartbeat(job_id)
+            except Exception:
+                pass
+
+    def run_once(self) -> bool:
+        """Traite un travail s'il y en a un ; renvoie False si la file est vide"""
+        self.queue.requeue_stale()
+        job = self.queue.claim(self.worker_id)
+        if job is None:
+            return False
+        done = threading.Event()
+        beat = threading.Thread(target=self._beat, args=(job["id"], done), daemon=True)
+        beat.start()
+        try:
+            error = self.handler(job)
+            self.queue.finish(job["id"], "failed" if error else "done", error)
+        except Exception as e:
+            self.queue.finish(job["id"], "failed", str(e))
+        finally:
+            done.set()
+        return True
+
+    def run_forever(self, stop: Optional[threading.Event] = None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                if not self.run_once():
+                    stop.wait(settings.job_poll_seconds)
+            except Exception as e:
+                print(f"❌ Worker {self.worker_id}: {e}")
+                stop.wait(settings.job_poll_seconds)
+
@@ -0,0 +1,250 @@
+"""
+Classifieur local léger entraîné sur les exemples d'apprentissage (training.jsonl)
+
+TF-IDF sur n-grammes de caractères + régression logistique : la prédiction est
+vectorisée et tourne sur CPU, ce qui permet de classer sans appel LLM les lignes
+où le modèle est très confiant.
+
+Les probabilités brutes de la régression logistique ne sont pas calibrées : une
+partie des exemples est tenue à l'écart de l'entraînement (holdout), et une
+régression isotone y apprend la précision observée en fonction de la
+probabilité. La confiance renvoyée est cette précision estimée.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..config import settings
+from .nacre_dict import get_nacre_dict
+from .patterns import account_of, supplier_of
+
+logger = logging.getLogger(__name__)
+
+
+TRAINING_PATH = os.path.join(settings.storage_dir, "db", "training.jsonl")
+MODEL_PATH = os.path.join(settings.storage_dir, "data", "local_classifier.joblib")
+
+
+def build_text(label: str, context: Optional[Dict[str, Any]] = None) -> str:
+    """Texte d'entrée du modèle : libellé + fournisseur + compte"""
+    # Mêmes clés que les patterns : exemples d'apprentissage et lignes à classer concordent
+    context = context or {}
+    sup = supplier_of(context)
+    acc = account_of(context)
+    parts = [str(label or "").strip()]
+    if sup:
+        parts.append(f"f:{sup}")
+    if acc:
+        parts.append(f"c:{acc}")
+    return " | ".join(parts)
+
+
+def _load_examples(path: str) -> Tuple[List[str], List[str]]:
+    texts: List[str] = []
+    codes: List[str] = []
+    if not os.path.exists(path):
+        return texts, codes
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                ex = json.loads(line)
+            except Exception:
+                continue
+            label = (ex.get("label") or "").strip()
+            code = (ex.get("code") or "").strip().upper()
+            if label and code:
+                texts.append(build_text(label, ex.get("context")))
+                codes.append(code)
+    return texts, codes
+
+
+class LocalClassifier:
+    """Modèle TF-IDF + régression logistique sérialisé sur disque avec joblib"""
+
+    def __init__(self, model_path: str = MODEL_PATH, training_path: str = TRAINING_PATH):
+        self.model_path = model_path
+        self.training_path = training_path
+        self.pipeline = None
+        # Régression isotone : probabilité brute → précision observée sur le holdout
+        self.calibrator = None
+        # mtime du fichier chargé : un ré-entraînement par un autre processus le change
+        self.model_mtime: Optional[float] = None
+        self.meta: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def _model_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.model_path)
+        except OSError:
+            return None
+
+    def load(self) -> bool:
+        """Charge le modèle sérialisé s'il existe (un modèle sans calibration est ignoré)"""
+        self.model_mtime = self._model_mtime()
+        if self.model_mtime is None:
+            with self.lock:
+                self.pipeline, self.calibrator, self.meta = None, None, {}
+            return False
+        try:
+            import joblib
+            payload = joblib.load(self.model_path)
+            if "calibrator" not in payload:
+                logger.warning(f"Modèle local sans calibration ({self.model_path}) : ré-entraînement nécessaire")
+                return False
+            with self.lock:
+                self.pipeline = payload["pipeline"]
+                self.calibrator = payload["calibrator"]
+                self.meta = payload.get("meta", {})
+            return True
+        except Exception as e:
+            logger.warning(f"Modèle local illisible ({self.model_path}): {e}")
+            return False
+
+    def refresh(self) -> bool:
+        """Recharge le modèle si le fichier a changé depuis le chargement (True si rechargé)"""
+        if self._model_mtime() == self.model_mtime:
+            return False
+        self.load()
+        return True
+
+    def is_ready(self) -> bool:
+        return self.pipeline is not None
+
+    def train(self) -> Dict[str, Any]:
+        """Entraîne le modèle sur training.jsonl, le calibre sur le holdout et le sérialise"""
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.isotonic import IsotonicRegression
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.model_selection import train_test_split
+        from sklearn.pipeline import Pipeline
+        import joblib
+
+        start = time.time()
+        texts, codes = _load_examples(self.training_path)
+        n_classes = len(set(codes))
+        if len(texts) < settings.local_model_min_examples or n_classes < 2:
+            return {
+                "trained": False,
+                "reason": f"Exemples insuffisants ({len(texts)} exemples, {n_classes} codes)",
+                "examples": len(texts),
+                "classes": n_classes,
+            }
+
+        pipeline = Pipeline([
+            ("tfidf", TfidfVectorizer(
+                analyzer="char_wb",
+                ngram_range=(2, 4),
+                lowercase=True,
+                strip_accents="unicode",
+                sublinear_tf=True,
+                min_df=1,
+            )),
+            ("clf", LogisticRegression(max_iter=1000)),
+        ])
+        fit_texts, holdout_texts, fit_codes, holdout_codes = train_test_split(
+            texts, codes, test_size=settings.local_model_holdout, random_state=0
+        )
+        # Le modèle servi est celui du calibrage : réentraîné sur tout, il serait plus confiant que mesuré
+        pipeline.fit(fit_texts, fit_codes)
+
+        # Précision observée sur les exemples jamais vus, selon la probabilité du code choisi
+        proba = pipeline.predict_proba(holdout_texts)
+        predicted = pipeline.classes_[proba.argmax(axis=1)]
+        correct = [float(p == c) for p, c in zip(predicted, holdout_codes)]
+        calibrator = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds="clip")
+        calibrator.fit(proba.max(axis=1), correct)
+
+        meta = {
+            "examples": len(texts),
+            "classes": n_classes,
+            "holdout_examples": len(holdout_texts),
+            "holdout_accuracy": round(sum(correct) / len(correct), 3),
+            "trained_at": time.time(),
+            "training_time": f"{time.time() - start:.2f}s",
+        }
+        os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
+        tmp_path = self.model_path + ".tmp"
+        joblib.dump({"pipeline": pipeline, "calibrator": calibrator, "meta": meta}, tmp_path)
+        os.replace(tmp_path, self.model_path)
+
+        with self.lock:
+            self.pipeline = pipeline
+            self.calibrator = calibrator
+            self.meta = meta
+        self.model_mtime = self._model_mtime()
+        logger.info(f"Modèle local entraîné: {len(texts)} exemples, {n_classes} codes")
+        return {"trained": True, **meta}
+
+    def _category_for(self, code: str) -> str:
+        entry = get_nacre_dict().get(code)
+        return entry.category if entry else code
+
+    def predict_many(self, items: List[Dict[str, Any]], top_k: int = 3) -> List[Dict[str, Any]]:
+        """Prédit en un seul appel vectorisé pour une liste d'éléments (label_text, context)"""
+        with self.lock:
+            pipeline, calibrator = self.pipeline, self.calibrator
+        if pipeline is None or not items:
+            return []
+        import numpy as np
+
+        texts = [build_text(it.get("label_text", ""), it.get("context")) for it in items]
+        proba = pipeline.predict_proba(texts)
+        classes = pipeline.classes_
+        k = min(top_k, len(classes))
+        top = np.argsort(-proba, axis=1)[:, :k]
+        # Confiance = précision estimée sur le holdout pour cette probabilité
+        accuracy = calibrator.predict(proba[np.arange(len(texts)), top[:, 0]])
+
+        results = []
+        for i, idx in enumerate(top):
+            best = float(proba[i, idx[0]])
+            code = str(classes[idx[0]])
+            results.append({
+                "chosen_code": code,
+                "chosen_category": self._category_for(code),
+                "confidence": int(round(float(accuracy[i]) * 100)),
+                "alternatives": [
+                    {"code": str(classes[j]), "category": self._category_for(str(classes[j])), "keywords": []}
+                    for j in idx
+                ],
+                "explanation": f"Classification locale (modèle appris, probabilité {best:.2f})",
+            })
+        return results
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.local_model_enabled,
+            "ready": self.is_ready(),
+            "min_confidence": settings.local_model_min_confidence,
+            "model_path": self.model_path,
+            **self.meta,
+        }
+
+
+_local_classifier: Optional[LocalClassifier] = None
+
+
+def get_local_classifier() -> LocalClassifier:
+    global _local_classifier
+    if _local_classifier is None:
+        _local_classifier = LocalClassifier()
+        _local_classifier.load()
+    else:
+        # Modèle ré-entraîné par un autre processus (API ou worker)
+        _local_classifier.refresh()
+    return _local_classifier
+
+
+def retrain_local_classifier() -> Dict[str, Any]:
+    """Ré-entraîne le modèle local (appelé après un apprentissage Sophie)"""
+    try:
+        return get_local_classifier().train()
+    except Exception as e:
+        logger.error(f"Erreur d'entraînement du modèle local: {e}")
+        return {"trained": False, "reason": str(e)}
@@ -1,9 +1,11 @@
 """
 Service de catégorisation des codes NACRE pour l'analyse des émissions carbone
 """
+import os
+import re
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Union
 from pathlib import Path
 import logging
 
@@ -183,80 +185,153 @@ class NACRECategorizer:
             }
         }
         
+        self._compile_rules()
+        self.csv_path = Path(__file__).parent / "nacre_dictionary_with_emissions.csv"
+        self.csv_mtime: Optional[float] = None
+        # Statistiques par catégorie du dictionnaire, calculées une fois par version du CSV
+        self.category_stats: Optional[Dict] = None
         self.df = None
         self.load_nacre_data()
     
+    def _compile_rules(self):
+        """Compile les règles : table préfixe -> catégorie et expression unique des mots-clés"""
+        # Premier préfixe rencontré dans l'ordre des catégories
+        self.prefix_categories: Dict[str, str] = {}
+        self.keyword_categories: List[str] = []
+        alternatives = []
+        for category, config in self.categories.items():
+            if category == "Autres":
+                continue
+            for prefix in config["prefixes"]:
+                self.prefix_categories.setdefault(prefix, category)
+            if config["keywords"]:
+                self.keyword_categories.append(category)
+                alternatives.append(".*?(" + "|".join(re.escape(k) for k in config["keywords"]) + ")")
+        # Une alternative (un groupe) par catégorie, essayées dans l'ordre depuis le début de
+        # la description : le groupe trouvé est la première catégorie dont un mot-clé apparaît
+        self.keyword_pattern = re.compile("^(?:" + "|".join(alternatives) + ")", re.DOTALL) if alternatives else None
+    
+    def _csv_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.csv_path)
+        except OSError:
+            return None
+    
     def load_nacre_data(self):
         """Charge les données NACRE avec émissions"""
+        self.csv_mtime = self._csv_mtime()
+        self.category_stats = None
         try:
-            csv_path = Path(__file__).parent / "nacre_dictionary_with_emissions.csv"
-            self.df = pd.read_csv(csv_path)
+            self.df = pd.read_csv(self.csv_path)
             logger.info(f"Chargé {len(self.df)} codes NACRE")
         except Exception as e:
             logger.error(f"Erreur lors du chargement des données NACRE: {e}")
             self.df = pd.DataFrame()
     
+    def refresh_data(self) -> bool:
+        """Recharge le dictionnaire si le CSV a été modifié depuis le chargement (True si rechargé)"""
+        if self._csv_mtime() == self.csv_mtime:
+            return False
+        logger.info("Dictionnaire NACRE modifié : rechargement")
+        self.load_nacre_data()
+        return True
+    
     def categorize_code(self, code: str, description: str = "") -> str:
         """Catégorise un code NACRE individuel"""
         if not code:
             return "Autres"
         
-        # Extraire le préfixe (2 premières lettres)
-        prefix = code[:2].upper() if len(code) >= 2 else ""
-        
-        # Recherche par préfixe
-        for category, config in self.categories.items():
-            if category == "Autres":
-                continue
-            if prefix in config["prefixes"]:
-                return category
+        # Recherche par préfixe (2 premières lettres)
+        category = self.prefix_categories.get(code[:2].upper())
+        if category:
+            return category
         
         # Recherche par mots-clés dans la description
-        if description:
-            description_upper = description.upper()
-            for category, config in self.categories.items():
-                if category == "Autres":
-                    continue
-                for keyword in config["keywords"]:
-                    if keyword in description_upper:
-                        return category
+        if description and self.keyword_pattern is not None:
+            match = self.keyword_pattern.match(description.upper())
+            if match:
+                return self.keyword_categories[match.lastindex - 1]
         
         return "Autres"
     
+    def categorize_many(self, codes, descriptions=None) -> pd.Series:
+        """
+        Catégorise un ensemble de codes (et leurs descriptions), mêmes règles que categorize_code
+        
+        Les règles ne sont appliquées qu'aux couples (code, description) distincts,
+        par opérations vectorisées ; le résultat garde l'index de `codes`.
+        """
+        codes = codes if isinstance(codes, pd.Series) else pd.Series(codes)
+        keys, _ = pd.factorize(codes, use_na_sentinel=False)
+        if descriptions is not None:
+            descriptions = descriptions if isinstance(descriptions, pd.Series) else pd.Series(descriptions)
+            description_keys, unique_descriptions = pd.factorize(descriptions, use_na_sentinel=False)
+            keys, _ = pd.factorize(keys.astype(np.int64) * (len(unique_descriptions) + 1) + description_keys)
+        # Première ligne de chaque couple distinct (factorize numérote dans l'ordre d'apparition)
+        first = pd.Series(keys).drop_duplicates().index.to_numpy()
+        
+        unique_codes = pd.Series(codes.to_numpy()[first], dtype=object).where(lambda s: s.notna(), "").astype(str)
+        categories = unique_codes.str[:2].str.upper().map(self.prefix_categories)
+        if descriptions is not None and self.keyword_pattern is not None:
+            pending = (categories.isna() & unique_codes.ne("")).to_numpy()
+            if pending.any():
+                unique_descriptions = pd.Series(descriptions.to_numpy()[first[pending]], dtype=object)
+                unique_descriptions = unique_descriptions.where(unique_descriptions.map(type) == str, "")
+                matched = unique_descriptions.str.upper().str.extract(self.keyword_pattern).notna().to_numpy()
+                found = matched.any(axis=1)
+                by_keyword = np.array(self.keyword_categories, dtype=object)[matched.argmax(axis=1)]
+                categories[pending] = np.where(found, by_keyword, None)
+        categories = categories.fillna("Autres").to_numpy(dtype=object)
+        return pd.Series(categories[keys], index=codes.index)
+    
     def categorize_all_codes(self) -> pd.DataFrame:
         """Catégorise tous les codes NACRE"""
         if self.df.empty:
             return pd.DataFrame()
         
         # Ajouter la colonne catégorie
-        self.df['category'] = self.df.apply(
-            lambda row: self.categorize_code(row['code_nacre'], row['description']), 
-            axis=1
-        )
+        self.df['category'] = self.categorize_many(self.df['code_nacre'], self.df['description'])
         
         return self.df
     
     def get_category_stats(self) -> Dict:
-        """Calcule les statistiques par catégorie"""
+        """
+        Statistiques par catégorie du dictionnaire NACRE
+        
+        Calculées une seule fois par version du CSV et partagées entre les
+        requêtes : le résultat ne doit pas être modifié.
+        """
+        self.refresh_data()
+        if self.category_stats is None:
+            self.category_stats = self._compute_category_stats()
+        return self.category_stats
+    
+    def _compute_category_stats(self) -> Dict:
+        """Statistiques par catégorie en un seul groupby"""
         if self.df.empty or 'category' not in self.df.columns:
             self.categorize_all_codes()
         
         # Nettoyer les données
-        df_clean = self.df.dropna(subset=['emission'])
+        df_clean = self.df.dropna(subset=['emission']) if 'emission' in self.df.columns else pd.DataFrame()
+        if df_clean.empty:
+            grouped, examples = pd.DataFrame(), {}
+        else:
+            grouped = df_clean.groupby('category')['emission'].agg(['count', 'mean', 'sum', 'min', 'max'])
+            # Max 10 exemples par catégorie
+            examples = df_clean.groupby('category').head(10).groupby('category')['code_nacre'].agg(list)
         
         stats = {}
         for category in self.categories.keys():
-            cat_data = df_clean[df_clean['category'] == category]
-            
-            if len(cat_data) > 0:
+            if category in grouped.index:
+                count, mean, total, minimum, maximum = grouped.loc[category]
                 stats[category] = {
-                    'count': len(cat_data),
-                    'avg_emission': float(cat_data['emission'].mean()),
-                    'total_emission': float(cat_data['emission'].sum()),
-                    'min_emission': float(cat_data['emission'].min()),
-                    'max_emission': float(cat_data['emission'].max()),
+                    'count': int(count),
+                    'avg_emission': float(mean),
+                    'total_emission': float(total),
+                    'min_emission': float(minimum),
+                    'max_emission': float(maximum),
                     'color': self.categories[category]['color'],
-                    'codes': cat_data['code_nacre'].tolist()[:10]  # Max 10 exemples
+                    'codes': examples[category]
                 }
             else:
                 stats[category] = {
@@ -271,22 +346,36 @@ class NACRECategorizer:
         
         return stats
     
-    def analyze_conversion_data(self, conversion_data: List[Dict]) -> Dict:
-        """Analyse les données d'une conversion spécifique"""
-        if not conversion_data:
+    def conversion_category_stats(self, df: pd.DataFrame) -> Dict:
+        """Statistiques par catégorie des lignes d'une conversion (category, montant, total_emission)"""
+        category_stats = {}
+        grouped = df.groupby("category").agg(
+            count=("montant", "size"), total_emission=("total_emission", "sum"), total_amount=("montant", "sum"),
+        )
+        for category, count, total_emission, total_amount in grouped.itertuples():
+            category_stats[category] = {
+                'count': int(count),
+                'total_emission': float(total_emission),
+                'total_amount': float(total_amount),
+                'avg_emission': float(total_emission) / count,
+                'color': self.categories.get(category, {}).get('color', '#BDC3C7')
+            }
+        return category_stats
+    
+    def analyze_conversion_data(self, conversion_data: Union[List[Dict], pd.DataFrame]) -> Dict:
+        """Analyse les données d'une conversion spécifique (lignes ou instantané colonnaire)"""
+        if isinstance(conversion_data, pd.DataFrame):
+            df_conversion = conversion_data.copy()
+        else:
+            # Convertir en DataFrame
+            df_conversion = pd.DataFrame(conversion_data or [])
+        if df_conversion.empty:
             return {}
         
-        # Convertir en DataFrame
-        df_conversion = pd.DataFrame(conversion_data)
-        
         # Ajouter les catégories
         if 'code_nacre' in df_conversion.columns:
-            df_conversion['category'] = df_conversion.apply(
-                lambda row: self.categorize_code(
-                    row.get('code_nacre', ''), 
-                    row.get('description', '')
-                ), 
-                axis=1
+            df_conversion['category'] = self.categorize_many(
+                df_conversion['code_nacre'], df_conversion.get('description')
             )
             
             # Calculer les émissions si montant disponible
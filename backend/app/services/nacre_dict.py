@@ -30,6 +30,7 @@ class NacreDictionary:
     def __init__(self, path: Optional[str] = None):
         self.path = path or self._resolve_default_path()
         self.entries: list[NacreEntry] = []
+        self._by_code: dict[str, NacreEntry] | None = None
         self._load()
 
     def _resolve_default_path(self) -> str:
@@ -118,7 +119,10 @@ class NacreDictionary:
         return [e for _, e in scored[:top_k]] if scored else self.entries[:top_k]
 
     def candidates_advanced(self, label: str, context: dict, top_k: int) -> List[NacreEntry]:
-        # Use fuzzy scoring (RapidFuzz) on aggregated text
+        return [e for _, e in self.scored_candidates(label, context, top_k)]
+
+    def scored_candidates(self, label: str, context: dict, top_k: int) -> List[tuple[float, NacreEntry]]:
+        # Use fuzzy scoring (RapidFuzz) on aggregated text, keeping the scores
         from rapidfuzz import fuzz
         query_parts = [label.strip()]
         for k, v in context.items():
@@ -130,7 +134,18 @@ class NacreDictionary:
             s = fuzz.token_set_ratio(query, e.aggregated)
             scored.append((s, e))
         scored.sort(key=lambda x: x[0], reverse=True)
-        return [e for _, e in scored[:top_k]]
+        return scored[:top_k]
+
+    def get(self, code: str) -> NacreEntry | None:
+        """Lookup an entry by code, accepting both AA.01 and AA01 forms."""
+        if self._by_code is None:
+            index: dict[str, NacreEntry] = {}
+            for e in self.entries:
+                index[e.code] = e
+                index.setdefault(e.code.replace(".", ""), e)
+            self._by_code = index
+        val = (code or "").strip().upper()
+        return self._by_code.get(val) or self._by_code.get(val.replace(".", ""))
 
 
 singleton_dict: NacreDictionary | None = None
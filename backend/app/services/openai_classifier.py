@@ -1,13 +1,72 @@
-﻿import json
-from typing import List, Optional, Dict, Any
+﻿import copy
+import json
+import logging
+import threading
+import time
+from typing import List, Optional, Dict, Any, Callable
 
 from openai import OpenAI
 
 from ..config import settings, GPT5_MODELS, GPT5_PARAMS
 from ..utils.text import normalize_text
-from .nacre_dict import NacreEntry
+from .batching import estimate_tokens
+from .nacre_dict import NacreEntry, get_nacre_dict
 from .patterns import get_boosts
 
+logger = logging.getLogger(__name__)
+
+# Share of the input price billed for cached prompt tokens
+CACHED_TOKEN_DISCOUNT = 0.5
+# Shortest prompt prefix the API caches; the batch system message must reach it
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+class UsageTracker:
+    """Accumulates token usage of classification requests for a conversion"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.cached_requests = 0
+        self.latency_cached = 0.0
+        self.latency_uncached = 0.0
+
+    def add(self, meta: Dict[str, Any]) -> None:
+        if not meta.get("rows"):
+            return
+        cached = int(meta.get("cached_tokens") or 0)
+        latency = float(meta.get("latency") or 0.0)
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += int(meta.get("prompt_tokens") or 0)
+            self.completion_tokens += int(meta.get("completion_tokens") or 0)
+            self.cached_tokens += cached
+            if cached:
+                self.cached_requests += 1
+                self.latency_cached += latency
+            else:
+                self.latency_uncached += latency
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            uncached_requests = self.requests - self.cached_requests
+            hit_rate = self.cached_tokens / self.prompt_tokens * 100 if self.prompt_tokens else 0.0
+            avg_cached = self.latency_cached / self.cached_requests if self.cached_requests else 0.0
+            avg_uncached = self.latency_uncached / uncached_requests if uncached_requests else 0.0
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cache_hit_rate": f"{hit_rate:.1f}%",
+                "saved_prompt_tokens": int(self.cached_tokens * CACHED_TOKEN_DISCOUNT),
+                "avg_latency_cached": f"{avg_cached:.2f}s",
+                "avg_latency_uncached": f"{avg_uncached:.2f}s",
+            }
+
 
 class Classifier:
     def __init__(self):
@@ -15,6 +74,7 @@ class Classifier:
         self.model = GPT5_MODELS.get("classification", "gpt-4o-mini")
         self.client = None
         self.gpt5_params = GPT5_PARAMS.get("classification", {})
+        self._batch_prefix: Optional[str] = None
         
         # Try to initialize OpenAI client safely
         if self.api_key:
@@ -35,7 +95,7 @@ class Classifier:
         top_k: int = 1,
     ) -> dict:
         if not self.client:
-            return self._heuristic(label_text, candidates, top_k)
+            return self._heuristic(label_text, candidates, top_k, context)
 
         prompt = self._build_prompt(label_text, context, candidates, top_k)
         
@@ -46,59 +106,160 @@ class Classifier:
                     {"role": "system", "content": self._get_system_prompt()},
                     {"role": "user", "content": prompt},
                 ],
+                extra_body=self._cache_routing(),
                 **self.gpt5_params
             )
             content = resp.choices[0].message.content or "{}"
             data = json.loads(content)
             return self._sanitize_output(data, candidates, context)
         except Exception:
-            return self._heuristic(label_text, candidates, top_k)
+            return self._heuristic(label_text, candidates, top_k, context)
 
     def classify_batch(
         self,
         batch_data: List[dict],
         top_k: int = 1,
+        max_tokens: Optional[int] = None,
+        observer: Optional[Callable[[Dict[str, Any]], None]] = None,
     ) -> List[dict]:
-        """Classify multiple labels in a single API call for better performance"""
+        """Classify multiple labels in a single API call for better performance.
+
+        `max_tokens` overrides the completion budget for this call and `observer`
+        receives the call metadata (rows, parsed, latency, truncated, token usage)
+        so the caller can adapt its batch sizes.
+        """
         if not self.client or not batch_data:
-            return [self._heuristic(item["label_text"], item["candidates"], top_k) for item in batch_data]
+            return [self._heuristic(item["label_text"], item["candidates"], top_k, item.get("context")) for item in batch_data]
 
         try:
             # Build batch prompt
             batch_prompt = self._build_batch_prompt(batch_data, top_k)
-            
+            params = dict(self.gpt5_params)
+            if max_tokens:
+                params["max_tokens"] = max_tokens
+
+            # Static instructions and NACRE reference first so the API can reuse
+            # the cached prefix; only the rows differ from one request to the next
+            started = time.time()
             resp = self.client.chat.completions.create(
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": self._get_batch_system_prompt()},
+                    {"role": "system", "content": self.get_batch_prefix()},
                     {"role": "user", "content": batch_prompt},
                 ],
-                **self.gpt5_params
+                extra_body=self._cache_routing(),
+                **params
             )
-            
-            content = resp.choices[0].message.content or "[]"
-            results = json.loads(content)
-            
+            latency = time.time() - started
+
+            choice = resp.choices[0]
+            truncated = getattr(choice, "finish_reason", None) == "length"
+            content = choice.message.content or "[]"
+            try:
+                results = json.loads(content)
+            except json.JSONDecodeError:
+                if not truncated:
+                    raise
+                # Keep the complete objects before the cut-off point
+                results = self._salvage_json_array(content)
+
             # Sanitize each result
             sanitized_results = []
             for i, result in enumerate(results):
                 if i < len(batch_data):
                     sanitized = self._sanitize_output(result, batch_data[i]["candidates"], batch_data[i]["context"])
                     sanitized_results.append(sanitized)
-            
+            parsed = len(sanitized_results)
+
+            if observer is not None:
+                usage = getattr(resp, "usage", None)
+                details = getattr(usage, "prompt_tokens_details", None)
+                try:
+                    observer({
+                        "rows": len(batch_data),
+                        "parsed": parsed,
+                        "latency": latency,
+                        "truncated": truncated,
+                        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                        "cached_tokens": getattr(details, "cached_tokens", None),
+                        "completion_tokens": getattr(usage, "completion_tokens", None),
+                    })
+                except Exception:
+                    pass
+
             # Fill missing results with heuristic fallback
             while len(sanitized_results) < len(batch_data):
                 item = batch_data[len(sanitized_results)]
-                sanitized_results.append(self._heuristic(item["label_text"], item["candidates"], top_k))
+                sanitized_results.append(self._heuristic(item["label_text"], item["candidates"], top_k, item.get("context")))
             
             return sanitized_results
             
         except Exception:
             # Fallback to individual heuristic classification
-            return [self._heuristic(item["label_text"], item["candidates"], top_k) for item in batch_data]
+            return [self._heuristic(item["label_text"], item["candidates"], top_k, item.get("context")) for item in batch_data]
+
+    def _salvage_json_array(self, content: str) -> List[dict]:
+        """Parse the complete objects of a JSON array cut off by max_tokens"""
+        start = content.find("[")
+        if start < 0:
+            return []
+        decoder = json.JSONDecoder()
+        items = []
+        pos = start + 1
+        while pos < len(content):
+            while pos < len(content) and content[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(content) or content[pos] == "]":
+                break
+            try:
+                obj, pos = decoder.raw_decode(content, pos)
+            except json.JSONDecodeError:
+                break
+            if isinstance(obj, dict):
+                items.append(obj)
+        return items
+
+    def scoped(self) -> "Classifier":
+        """Copy with its own HTTP client, so closing it aborts only one conversion's requests"""
+        clone = copy.copy(self)
+        if self.client is not None:
+            clone.client = OpenAI(api_key=self.api_key)
+        return clone
+
+    def close(self) -> None:
+        """Close the HTTP client; in-flight requests fail and fall back immediately"""
+        if self.client is not None:
+            self.client.close()
+
+    def _cache_routing(self) -> Optional[dict]:
+        """Route requests sharing the same prefix to the same prompt cache"""
+        if not settings.prompt_cache_key:
+            return None
+        return {"prompt_cache_key": settings.prompt_cache_key}
+
+    def get_batch_prefix(self) -> str:
+        """Stable, cacheable system message: instructions plus optional NACRE reference
+
+        The instructions alone are sized above PROMPT_CACHE_MIN_TOKENS so the
+        prefix is cached in the default configuration too.
+        """
+        if self._batch_prefix is None:
+            prefix = self._get_batch_system_prompt()
+            if settings.prompt_nacre_reference:
+                prefix += "\n\n" + self._build_nacre_reference()
+            if estimate_tokens(prefix) < PROMPT_CACHE_MIN_TOKENS:
+                logger.warning(f"Batch prompt prefix below the prompt-cache minimum (~{estimate_tokens(prefix)} tokens)")
+            self._batch_prefix = prefix
+        return self._batch_prefix
+
+    def _build_nacre_reference(self) -> str:
+        """Full code → category list, sorted so the block is byte-identical across requests"""
+        entries = sorted(get_nacre_dict().entries, key=lambda e: e.code)
+        lines = [f"{e.code}: {e.category}" for e in entries]
+        return "RÉFÉRENTIEL NACRE (code: catégorie):\n" + "\n".join(lines)
 
     def _get_batch_system_prompt(self) -> str:
-        """System prompt for batch classification"""
+        """System prompt for batch classification (static, ordered before any per-request content)"""
         return (
             "Tu es un expert en classification NACRE. Ta mission est de classifier plusieurs libellés "
             "comptables en une seule fois.\n\n"
@@ -106,7 +267,67 @@ class Classifier:
             "1. Analyse chaque libellé avec son contexte (fournisseur, compte comptable, montant)\n"
             "2. Privilégie la précision sémantique pour chaque classification\n"
             "3. Utilise le contexte pour lever les ambiguïtés\n"
-            "4. Traite chaque ligne indépendamment mais efficacement\n\n"
+            "4. Traite chaque ligne indépendamment mais efficacement\n"
+            "5. Les candidats de chaque ligne renvoient à une liste (L1, L2, ...) définie en tête du message\n\n"
+            "LECTURE DU LIBELLÉ:\n"
+            "- Les libellés comptables sont souvent abrégés, en majuscules, sans accents et tronqués : "
+            "FACT = facture, ABT = abonnement, MAINT = maintenance, LOC = location, PREST = prestation, "
+            "FOURN = fourniture, ACH = achat, REGUL = régularisation, AV = avoir.\n"
+            "- Ignore les numéros de facture, de commande, les dates, les références internes et les "
+            "codes postaux : ils ne renseignent pas sur la nature de la dépense.\n"
+            "- Cherche d'abord l'objet acheté (bien, service, travaux), puis sa nature précise "
+            "(matériau, usage, frais ou congelé, neuf ou réparation).\n"
+            "- Un libellé qui décrit plusieurs objets se classe selon l'objet principal, en général "
+            "celui qui porte la plus grande part du montant.\n\n"
+            "USAGE DU CONTEXTE:\n"
+            "- Le fournisseur précise souvent le secteur : un traiteur relève de l'alimentation, un "
+            "éditeur de logiciels des services informatiques, une entreprise du BTP des travaux.\n"
+            "- Le compte comptable (plan comptable général) oriente la nature de la dépense : 60 achats "
+            "(601/602 matières et fournitures, 604 prestations, 606 fournitures non stockées, 6061 "
+            "énergie et eau, 6063 petit équipement, 6064 fournitures administratives), 61 services "
+            "extérieurs (613 locations, 615 entretien et réparations, 616 assurances), 62 autres "
+            "services extérieurs (622 honoraires, 623 publicité, 624 transports, 625 déplacements, "
+            "626 télécommunications), 21 et 23 immobilisations (équipements, travaux).\n"
+            "- Le montant aide à distinguer un petit équipement d'un investissement, ou un achat "
+            "ponctuel d'un contrat annuel.\n"
+            "- Si le contexte contredit le libellé, privilégie le libellé et baisse la confiance.\n\n"
+            "CHOIX DU CODE:\n"
+            "- Choisis toujours un code parmi les candidats de la liste de la ligne, jamais en dehors.\n"
+            "- Entre deux candidats proches, préfère le plus spécifique à l'objet acheté plutôt qu'une "
+            "catégorie générique ou « autres ».\n"
+            "- Distingue les biens (fournitures, matériels) des services associés (location, "
+            "maintenance, installation) : une maintenance de matériel n'est pas un achat de matériel.\n"
+            "- Distingue les travaux (construction, rénovation) de l'entretien courant des bâtiments.\n"
+            "- Pour l'alimentation, respecte l'état du produit (frais, surgelé, sec) lorsque le "
+            "libellé l'indique.\n\n"
+            "ÉCHELLE DE CONFIANCE:\n"
+            "- 90 à 100 : le libellé désigne sans ambiguïté l'objet d'un seul candidat.\n"
+            "- 70 à 89 : le choix est probable, confirmé par le fournisseur ou le compte.\n"
+            "- 50 à 69 : plusieurs candidats restent plausibles ; le choix repose sur un indice faible.\n"
+            "- moins de 50 : libellé trop vague ou sans rapport avec les candidats.\n"
+            "Ne surestime pas la confiance : les lignes peu sûres sont revues par un humain.\n\n"
+            "CAS PARTICULIERS:\n"
+            "- Avoirs, remboursements et régularisations : classe selon la nature de la dépense "
+            "d'origine, comme la facture qu'ils corrigent.\n"
+            "- Frais de port ou de livraison facturés avec des marchandises : classe avec les "
+            "marchandises ; facturés seuls par un transporteur : classe en transport.\n"
+            "- Location longue durée de véhicules ou de matériel : classe en location, pas en achat.\n"
+            "- Cotisations, taxes, frais bancaires et salaires ne sont pas des achats de biens ou de "
+            "services : si aucun candidat ne convient, choisis le plus proche avec une confiance basse.\n"
+            "- Un même libellé peut revenir sur de nombreuses lignes : classe-le de façon cohérente.\n\n"
+            "EXEMPLES DE RAISONNEMENT:\n"
+            "- « FACT 2024-118 ABT LICENCES OFFICE 365 », fournisseur éditeur, compte 6064 : il s'agit "
+            "d'un abonnement logiciel, donc d'un service informatique et non de fournitures de bureau.\n"
+            "- « MAINT PHOTOCOPIEUR T3 », compte 615 : maintenance d'un matériel, classée en entretien "
+            "et réparation de matériel et non en achat de matériel de bureau.\n"
+            "- « CARBURANT GAZOLE FLOTTE », fournisseur pétrolier, compte 6061 : achat de carburant pour "
+            "véhicules, distinct de l'énergie des bâtiments (électricité, gaz, chauffage).\n"
+            "- « REPAS SEMINAIRE EQUIPE », fournisseur traiteur, compte 625 : prestation de restauration, "
+            "et non achat de denrées alimentaires.\n"
+            "- « TRAVAUX REFECTION TOITURE », compte 231 : travaux de construction ou de rénovation de "
+            "bâtiment, et non entretien courant.\n"
+            "- « DIVERS » sans contexte exploitable : choisis le candidat le plus générique et donne une "
+            "confiance inférieure à 50.\n\n"
             "RÉPONSE REQUISE:\n"
             "Retourne uniquement un JSON array avec cette structure exacte:\n"
             "[\n"
@@ -122,8 +343,14 @@ class Classifier:
         )
 
     def _build_batch_prompt(self, batch_data: List[dict], top_k: int) -> str:
-        """Build batch classification prompt"""
-        
+        """Build the row-specific part of the batch prompt.
+
+        Identical candidate lists are written once and referenced by id; when the
+        NACRE reference is part of the cached prefix, lists only carry the codes.
+        """
+        with_categories = not settings.prompt_nacre_reference
+        list_ids: Dict[tuple, str] = {}
+        list_blocks = []
         batch_items = []
         for i, item in enumerate(batch_data):
             # Format context information
@@ -139,21 +366,27 @@ class Classifier:
             context_str = " | ".join(context_info) if context_info else "Aucun contexte"
             
             # Format candidates (limit to top 8 for batch processing)
-            candidates = item.get("candidates", [])
-            candidates_str = "\n".join([
-                f"  - {c.code}: {c.category}"
-                for c in candidates[:min(8, len(candidates))]
-            ])
+            candidates = item.get("candidates", [])[:8]
+            key = tuple(c.code for c in candidates)
+            if key not in list_ids:
+                list_ids[key] = f"L{len(list_ids) + 1}"
+                if with_categories:
+                    body = "\n".join(f"  - {c.code}: {c.category}" for c in candidates)
+                else:
+                    body = "  " + ", ".join(key)
+                list_blocks.append(f"{list_ids[key]}:\n{body}")
             
             batch_items.append(
                 f"LIGNE {i+1}:\n"
                 f"Libellé: {item['label_text']}\n"
                 f"Contexte: {context_str}\n"
-                f"Candidats:\n{candidates_str}"
+                f"Candidats: {list_ids[key]}"
             )
         
         return (
-            f"CLASSIFICATION BATCH DE {len(batch_data)} LIBELLÉS:\n\n" +
+            "LISTES DE CANDIDATS:\n" +
+            "\n".join(list_blocks) +
+            f"\n\nCLASSIFICATION BATCH DE {len(batch_data)} LIBELLÉS:\n\n" +
             "\n\n".join(batch_items) +
             f"\n\nClassifie chaque libellé et retourne un array JSON de {len(batch_data)} résultats."
         )
@@ -247,7 +480,7 @@ class Classifier:
             ]
         }
 
-    def _heuristic(self, label_text: str, candidates: List[NacreEntry], top_k: int) -> dict:
+    def _heuristic(self, label_text: str, candidates: List[NacreEntry], top_k: int, context: Optional[dict] = None) -> dict:
         """Fallback heuristic classification when OpenAI is not available"""
         
         if not candidates:
@@ -262,6 +495,7 @@ class Classifier:
         # Simple keyword matching
         normalized_label = normalize_text(label_text).lower()
         scores = []
+        boosts = get_boosts(context or {})
         
         for candidate in candidates:
             score = 0
@@ -270,11 +504,8 @@ class Classifier:
                 if normalize_text(keyword).lower() in normalized_label:
                     score += len(keyword)
             
-            # Boost score based on patterns
-            boosts = get_boosts(label_text)
-            for pattern, boost in boosts:
-                if pattern in candidate.code or pattern.lower() in candidate.category.lower():
-                    score += boost
+            # Boost score based on supplier/account patterns
+            score += boosts.get(candidate.code, 0)
             
             scores.append((candidate, score))
         
@@ -5,16 +5,24 @@ Implémente un vrai parallélisme avec des workers indépendants
 import asyncio
 import time
 from typing import List, Dict, Any, Callable, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import wait, FIRST_COMPLETED, CancelledError
+from functools import partial
 import threading
 from dataclasses import dataclass
 
-from ..services.openai_classifier import get_classifier
+from ..services.openai_classifier import get_classifier, UsageTracker
 from ..services.nacre_dict import NacreEntry
-from ..services.storage import append_conversion_row, update_conversion
+from ..services.batching import TokenBudgetBatcher, estimate_tokens
+from ..services.scheduler import get_scheduler
+from ..services.conversion_control import ConversionStopped, on_stop, raise_if_stopped, stop_requested
+from ..services.storage import append_conversion_rows, update_conversion
 from ..models import RowClassification
 
 
+# Intervalle de vérification d'une demande d'arrêt venant d'un autre processus
+STOP_POLL_SECONDS = 1.0
+
+
 @dataclass
 class ProcessingTask:
     """Tâche de traitement pour un agent"""
@@ -22,6 +30,11 @@ class ProcessingTask:
     items: List[Dict[str, Any]]
     indices: List[int]
     conv_id: str
+    batcher: Optional[TokenBudgetBatcher] = None
+    usage: Optional[UsageTracker] = None
+    classifier: Optional[Any] = None
+    # Batch réduit par la répartition de fin de conversion (et non par le batcher)
+    capped: bool = False
 
 
 @dataclass
@@ -39,6 +52,39 @@ class ParallelProcessor:
     def __init__(self):
         self.active_workers = 0
         self.lock = threading.Lock()
+
+    def _classify_with_budget(
+        self, clf, items: List[Dict[str, Any]], batcher: TokenBudgetBatcher, usage: Optional[UsageTracker] = None,
+        conv_id: Optional[str] = None, capped: bool = False
+    ) -> List[Dict[str, Any]]:
+        """Classifie un batch et renvoie la fin d'une réponse tronquée dans des requêtes plus petites"""
+        results: List[Dict[str, Any]] = []
+        start = 0
+        size = len(items)
+        while start < len(items):
+            chunk = items[start:start + size]
+            meta: Dict[str, Any] = {"capped": capped and start == 0}
+            if conv_id:
+                raise_if_stopped(conv_id, check_storage=False)
+            chunk_results = clf.classify_batch(
+                chunk, top_k=3, max_tokens=batcher.max_tokens_for(chunk), observer=meta.update
+            )
+            if conv_id:
+                # Requête interrompue par un arrêt : ne pas enregistrer le repli heuristique
+                raise_if_stopped(conv_id, check_storage=False)
+            batcher.observe(meta)
+            if usage is not None:
+                usage.add(meta)
+            parsed = meta.get("parsed", len(chunk))
+            if meta.get("truncated") and parsed < len(chunk) and len(chunk) > 1:
+                # Conserver les lignes complètes, renvoyer les suivantes
+                results.extend(chunk_results[:parsed])
+                start += parsed
+                size = len(chunk) - parsed if parsed else max(1, len(chunk) // 2)
+                continue
+            results.extend(chunk_results)
+            start += len(chunk)
+        return results
     
     def _worker_agent(self, task: ProcessingTask) -> ProcessingResult:
         """Agent de traitement individuel"""
@@ -53,7 +99,7 @@ class ParallelProcessor:
         try:
             # Chaque agent a son propre classifier pour éviter les conflits
             try:
-                clf = get_classifier()
+                clf = task.classifier or get_classifier()
                 print(f"🤖 Agent {worker_id} classifier initialized successfully")
             except Exception as clf_error:
                 print(f"❌ Agent {worker_id} failed to initialize classifier: {clf_error}")
@@ -62,21 +108,21 @@ class ParallelProcessor:
             
             print(f"🤖 Agent {worker_id} traite {len(task.items)} éléments (Task {task.task_id})")
             
-            # Traitement par batch pour cet agent
-            batch_items = [item["label_text"] for item in task.items]
-            batch_contexts = [item.get("context", "") for item in task.items]
-            
             try:
-                if clf is not None:
-                    # Classification par batch pour l'efficacité
-                    batch_results = clf.classify_batch(batch_items, batch_contexts, top_k=3)
+                if clf is not None and task.batcher is not None:
+                    # Classification par batch dimensionné selon le budget de tokens
+                    batch_results = self._classify_with_budget(
+                        clf, task.items, task.batcher, task.usage, task.conv_id, task.capped
+                    )
+                elif clf is not None:
+                    batch_results = clf.classify_batch(task.items, top_k=3)
                 else:
                     # Fallback: use dictionary-based matching
                     from ..services.nacre_dict import get_nacre_dict
                     nacre_dict = get_nacre_dict()
                     batch_results = []
-                    for item in batch_items:
-                        candidates = nacre_dict.candidates(item, top_k=3)
+                    for item in task.items:
+                        candidates = nacre_dict.candidates(item["label_text"], top_k=3)
                         if candidates:
                             batch_results.append({
                                 "chosen_code": candidates[0].code,
@@ -97,6 +143,9 @@ class ParallelProcessor:
                 # Petit délai pour rendre le progrès visible (pour debug)
                 time.sleep(0.5)
                 
+                # Lignes du batch enregistrées en une écriture (et un seul delta des totaux CO2)
+                records = []
+                batch_rows = []
                 for i, (item, result) in enumerate(zip(task.items, batch_results)):
                     # Créer l'objet RowClassification
                     rc = RowClassification(
@@ -114,15 +163,23 @@ class ParallelProcessor:
                         rationale=result.get("rationale", []),
                     )
                     
-                    # Sauvegarder immédiatement (thread-safe)
-                    append_conversion_row(task.conv_id, rc.model_dump())
-                    results.append(result)
+                    records.append(rc.model_dump())
+                    result["row_index"] = task.indices[i]
+                    batch_rows.append(result)
+                
+                # Sauvegarder le batch dès qu'il est classé (thread-safe)
+                append_conversion_rows(task.conv_id, records)
+                results.extend(batch_rows)
                     
+            except ConversionStopped:
+                # Les lignes de ce batch seront classées à la reprise
+                raise
             except Exception as e:
                 print(f"❌ Agent {worker_id} erreur batch: {e}")
                 errors += len(task.items)
                 
                 # Fallback individuel
+                records = []
                 for i, item in enumerate(task.items):
                     fb_cands = item.get("candidates", [])
                     if fb_cands:
@@ -157,8 +214,9 @@ class ParallelProcessor:
                         rationale=result.get("rationale", []),
                     )
                     
-                    append_conversion_row(task.conv_id, rc.model_dump())
+                    records.append(rc.model_dump())
                     results.append(result)
+                append_conversion_rows(task.conv_id, records)
         
         finally:
             with self.lock:
@@ -179,7 +237,10 @@ class ParallelProcessor:
         conv_id: str, 
         all_items: List[Dict[str, Any]], 
         speed_multiplier: int = 1,
-        progress_callback: Optional[Callable[[int, int, float], None]] = None
+        progress_callback: Optional[Callable[[int, int, float], None]] = None,
+        stats: Optional[Dict[str, Any]] = None,
+        batcher_state: Optional[Dict[str, Any]] = None,
+        priority: str = "normal"
     ) -> List[Dict[str, Any]]:
         """
         Traite les éléments en parallèle avec des agents multiples
@@ -189,6 +250,12 @@ class ParallelProcessor:
             all_items: Tous les éléments à traiter
             speed_multiplier: Multiplicateur de vitesse (1, 2, 4)
             progress_callback: Callback pour le suivi du progrès
+            stats: Statistiques de conversion enrichies avec l'état du batching
+            batcher_state: État du batcher sauvegardé au dernier checkpoint (reprise)
+            priority: Niveau de priorité auprès de l'ordonnanceur partagé (interactive, normal, bulk)
+        
+        Lève ConversionStopped après les batches en vol si la conversion est annulée
+        ou mise en pause ; les lignes déjà classées sont enregistrées.
         """
         start_time = time.time()
         total_items = len(all_items)
@@ -196,78 +263,145 @@ class ParallelProcessor:
         if total_items == 0:
             return []
         
-        # Configuration basée sur la vitesse - réduire la taille des tâches pour plus de mises à jour
+        # Le multiplicateur de vitesse fixe le nombre de batches en vol pour cette conversion ;
+        # les agents eux-mêmes appartiennent au pool partagé de l'ordonnanceur. La taille des
+        # batches est déterminée par le budget de tokens et s'adapte en cours de route
         if speed_multiplier == 1:  # 1x
             num_workers = 2
-            items_per_task = 3  # Réduire pour plus de mises à jour fréquentes
         elif speed_multiplier == 2:  # 2x
             num_workers = 4
-            items_per_task = 4  # Réduire pour plus de mises à jour fréquentes
         else:  # 4x
             num_workers = 6
-            items_per_task = 6  # Réduire pour plus de mises à jour fréquentes
+
+        # Client HTTP propre à la conversion : le fermer interrompt ses requêtes en vol
+        clf = None
+        try:
+            clf = get_classifier().scoped()
+            on_stop(conv_id, clf.close)
+            batcher = TokenBudgetBatcher(
+                model=clf.model,
+                system_prompt_tokens=estimate_tokens(clf.get_batch_prefix()),
+            )
+        except Exception as e:
+            print(f"⚠️ Batcher indisponible, batches par défaut: {e}")
+            batcher = TokenBudgetBatcher(model="")
+        batcher.restore(batcher_state)
+        usage = UsageTracker()
         
-        print(f"🚀 Démarrage traitement parallèle: {num_workers} agents, {items_per_task} éléments/tâche")
+        print(f"🚀 Démarrage traitement parallèle: {num_workers} agents, batches adaptatifs (max {batcher.max_rows} lignes)")
         
-        # Créer les tâches pour les agents
-        tasks = []
+        # Traitement parallèle avec ThreadPoolExecutor
+        all_results = []
+        completed_tasks = 0
+        total_errors = 0
+        items_processed = 0  # Compteur précis des éléments traités
+        next_start = 0
         task_id = 0
         
-        for i in range(0, total_items, items_per_task):
-            end_idx = min(i + items_per_task, total_items)
-            task_items = all_items[i:end_idx]
-            task_indices = list(range(i, end_idx))
-            
-            tasks.append(ProcessingTask(
+        def next_task() -> Optional[ProcessingTask]:
+            # Les tâches sont formées au moment de la soumission pour profiter des ajustements du batcher
+            nonlocal next_start, task_id
+            if next_start >= total_items:
+                return None
+            # En fin de conversion, répartir les lignes restantes sur tous les agents
+            # (batches d'au moins BATCH_MIN_ROWS lignes) plutôt qu'en un seul gros batch
+            share = batcher.share_limit(total_items - next_start, num_workers)
+            end_idx = batcher.plan_batch(all_items, next_start, limit=share)
+            task_items = all_items[next_start:end_idx]
+            task = ProcessingTask(
                 task_id=task_id,
                 items=task_items,
-                indices=task_indices,
-                conv_id=conv_id
-            ))
+                indices=[item.get("row_index", next_start + j) for j, item in enumerate(task_items)],
+                conv_id=conv_id,
+                batcher=batcher,
+                usage=usage,
+                classifier=clf,
+                capped=share is not None and end_idx - next_start == share,
+            )
+            next_start = end_idx
             task_id += 1
+            return task
         
-        print(f"📋 {len(tasks)} tâches créées pour {total_items} éléments")
+        scheduler = get_scheduler()
+        scheduler.register(conv_id, priority)
         
-        # Traitement parallèle avec ThreadPoolExecutor
-        all_results = []
-        completed_tasks = 0
-        total_errors = 0
-        items_processed = 0  # Compteur précis des éléments traités
+        def submit(task: ProcessingTask):
+            return scheduler.submit(conv_id, partial(self._worker_agent, task), cost=len(task.items))
         
-        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="NACREAgent") as executor:
-            # Soumettre toutes les tâches
-            future_to_task = {executor.submit(self._worker_agent, task): task for task in tasks}
+        stopped = stop_requested(conv_id)
+        try:
+            future_to_task = {}
+            for _ in range(num_workers if stopped is None else 0):
+                task = next_task()
+                if task is None:
+                    break
+                future_to_task[submit(task)] = task
             
-            # Collecter les résultats au fur et à mesure
-            for future in as_completed(future_to_task):
-                task = future_to_task[future]
-                
-                try:
-                    result = future.result()
-                    all_results.extend(result.results)
-                    total_errors += result.errors
-                    completed_tasks += 1
-                    items_processed += len(task.items)  # Ajouter le nombre réel d'éléments traités
+            # Collecter les résultats au fur et à mesure et soumettre les batches suivants
+            while future_to_task:
+                done, _ = wait(future_to_task, timeout=STOP_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                if stopped is None:
+                    stopped = stop_requested(conv_id)
+                    if stopped:
+                        # Abandonner les batches encore en file ; ceux en vol sont interrompus
+                        print(f"⏹️ Arrêt demandé ({stopped}) pour la conversion {conv_id}")
+                        for pending in future_to_task:
+                            pending.cancel()
+                for future in done:
+                    task = future_to_task.pop(future)
                     
-                    # Callback de progrès avec le nombre réel d'éléments
-                    if progress_callback:
-                        elapsed_time = time.time() - start_time
-                        # Passer les éléments traités au lieu des tâches
-                        progress_callback(items_processed, total_items, elapsed_time)
+                    try:
+                        result = future.result()
+                        all_results.extend(result.results)
+                        total_errors += result.errors
+                        completed_tasks += 1
+                        items_processed += len(task.items)  # Ajouter le nombre réel d'éléments traités
+                        
+                        if stats is not None:
+                            stats["batching"] = batcher.snapshot()
+                            stats["llm_usage"] = usage.snapshot()
+                            stats["scheduler"] = scheduler.flow_status(conv_id, total_items - items_processed)
+                        
+                        # Callback de progrès avec le nombre réel d'éléments
+                        if progress_callback:
+                            elapsed_time = time.time() - start_time
+                            # Passer les éléments traités au lieu des tâches
+                            progress_callback(items_processed, total_items, elapsed_time)
+                        
+                        print(f"📊 Tâche {result.task_id} terminée ({completed_tasks} tâches) - {items_processed}/{total_items} éléments")
+                        
+                    except (CancelledError, ConversionStopped):
+                        continue
+                    except Exception as e:
+                        print(f"❌ Erreur dans la tâche {task.task_id}: {e}")
+                        total_errors += len(task.items)
+                        completed_tasks += 1
+                        items_processed += len(task.items)  # Compter même les éléments en erreur
                     
-                    print(f"📊 Tâche {result.task_id} terminée ({completed_tasks}/{len(tasks)}) - {items_processed}/{total_items} éléments")
-                    
-                except Exception as e:
-                    print(f"❌ Erreur dans la tâche {task.task_id}: {e}")
-                    total_errors += len(task.items)
-                    completed_tasks += 1
-                    items_processed += len(task.items)  # Compter même les éléments en erreur
+                    new_task = next_task() if stopped is None else None
+                    if new_task is not None:
+                        future_to_task[submit(new_task)] = new_task
+        finally:
+            scheduler.unregister(conv_id)
+            if clf is not None:
+                clf.close()
+        
+        if stats is not None:
+            stats["batching"] = batcher.snapshot()
+            stats["llm_usage"] = usage.snapshot()
+        if stopped:
+            print(f"⏹️ Conversion {conv_id} arrêtée: {len(all_results)}/{total_items} éléments classés")
+            raise ConversionStopped(stopped)
         
         total_time = time.time() - start_time
         rate = len(all_results) / total_time if total_time > 0 else 0
         
         print(f"🎯 Traitement terminé: {len(all_results)} éléments en {total_time:.1f}s ({rate:.1f} items/sec)")
         print(f"📈 Statistiques: {num_workers} agents, {total_errors} erreurs, {completed_tasks} tâches")
+        llm_usage = usage.snapshot()
+        if llm_usage["requests"]:
+            print(f"💾 Cache de prompt: {llm_usage['cached_tokens']}/{llm_usage['prompt_tokens']} tokens en cache "
+                  f"({llm_usage['cache_hit_rate']})")
         
         return all_results
 
@@ -280,7 +414,10 @@ def process_conversion_parallel(
     conv_id: str,
     all_items: List[Dict[str, Any]],
     speed_multiplier: int = 1,
-    progress_callback: Optional[Callable[[int, int, float], None]] = None
+    progress_callback: Optional[Callable[[int, int, float], None]] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    batcher_state: Optional[Dict[str, Any]] = None,
+    priority: str = "normal"
 ) -> List[Dict[str, Any]]:
     """
     Point d'entrée principal pour le traitement parallèle
@@ -289,5 +426,8 @@ def process_conversion_parallel(
         conv_id=conv_id,
         all_items=all_items,
         speed_multiplier=speed_multiplier,
-        progress_callback=progress_callback
+        progress_callback=progress_callback,
+        stats=stats,
+        batcher_state=batcher_state,
+        priority=priority
     )
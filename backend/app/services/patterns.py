@@ -2,13 +2,17 @@ import json
 import os
 import time
 from collections import defaultdict
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 
 from ..config import settings
 
 
 PATH = os.path.join(settings.storage_dir, "db", "patterns.json")
 
+# Words identifying the supplier / account column when a conversion does not name it
+SUPPLIER_COLUMN_WORDS = ("fournisseur", "supplier", "vendor", "tiers")
+ACCOUNT_COLUMN_WORDS = ("compte", "account")
+
 
 def _load() -> Dict[str, Any]:
     os.makedirs(os.path.join(settings.storage_dir, "db"), exist_ok=True)
@@ -26,15 +30,69 @@ def _save(obj: Dict[str, Any]):
         json.dump(obj, f, ensure_ascii=False)
 
 
+def context_roles(
+    columns: List[str], supplier_column: Optional[str] = None, account_column: Optional[str] = None
+) -> Dict[str, str]:
+    """Context columns holding the supplier and the account of a conversion.
+
+    Columns named in the conversion win; otherwise the first context column whose
+    name contains a known word is used. Returns {"supplier": column, "account": column}
+    with the roles that could be resolved.
+    """
+    roles: Dict[str, str] = {}
+    for role, explicit, words in (
+        ("supplier", supplier_column, SUPPLIER_COLUMN_WORDS),
+        ("account", account_column, ACCOUNT_COLUMN_WORDS),
+    ):
+        column = explicit or next(
+            (c for c in columns if c not in roles.values() and any(w in c.lower() for w in words)), None
+        )
+        if column:
+            roles[role] = column
+    return roles
+
+
+def row_context(row: Dict[str, Any], columns: List[str], roles: Dict[str, str]) -> Dict[str, Any]:
+    """Context of a source row: its context columns, plus the supplier and account
+    under the canonical "supplier" / "account" keys read by the prompt and the patterns."""
+    context = {k: row.get(k) for k in columns}
+    for role, column in roles.items():
+        context.setdefault(role, row.get(column))
+    return context
+
+
+def supplier_of(context: Dict[str, Any]) -> str:
+    """Normalised supplier name of a row context (key of the suppliers map)."""
+    return str(context.get("supplier") or context.get("fournisseur") or context.get("Fournisseur") or "").strip().lower()
+
+
+def account_of(context: Dict[str, Any]) -> str:
+    """Normalised account number of a row context (key of the accounts map)."""
+    return str(context.get("account") or context.get("compte") or context.get("compte_comptable") or context.get("Compte") or "").strip().lower()
+
+
 def update_patterns(context: Dict[str, Any], chosen_code: str, confidence: int):
     """Update frequency maps for supplier/account → code.
     We store counts and simple avg confidence.
     """
-    sup = str(context.get("fournisseur") or context.get("supplier") or context.get("Fournisseur") or "").strip().lower()
-    acc = str(context.get("compte") or context.get("compte_comptable") or context.get("Compte") or "").strip().lower()
-    if not sup and not acc:
-        return
+    update_patterns_many([(context, chosen_code, confidence)])
+
+
+def update_patterns_many(observations: List[Tuple[Dict[str, Any], str, int]]):
+    """Same as update_patterns for many (context, code, confidence), with one read and one write."""
     data = _load()
+    changed = False
+    for context, chosen_code, confidence in observations:
+        changed = _observe(data, context, chosen_code, confidence) or changed
+    if changed:
+        _save(data)
+
+
+def _observe(data: Dict[str, Any], context: Dict[str, Any], chosen_code: str, confidence: int) -> bool:
+    sup = supplier_of(context)
+    acc = account_of(context)
+    if not sup and not acc:
+        return False
     now = time.time()
 
     def _bump(bucket: Dict[str, Any], key: str):
@@ -55,23 +113,42 @@ def update_patterns(context: Dict[str, Any], chosen_code: str, confidence: int):
         accounts = data.get("accounts") or {}
         _bump(accounts, acc)
         data["accounts"] = accounts
-
-    _save(data)
+    return True
 
 
 def get_boosts(context: Dict[str, Any]) -> Dict[str, float]:
     """Return a map code → weight based on historical patterns for supplier/account.
     Weight is proportional to frequency and confidence.
     """
-    sup = str(context.get("fournisseur") or context.get("supplier") or context.get("Fournisseur") or "").strip().lower()
-    acc = str(context.get("compte") or context.get("compte_comptable") or context.get("Compte") or "").strip().lower()
+    return _weights(_load(), context)
+
+
+def get_boosts_many(contexts: List[Dict[str, Any]]) -> List[Dict[str, float]]:
+    """Same as get_boosts for many rows, reading patterns.json once."""
     data = _load()
+    return [_weights(data, context or {}) for context in contexts]
+
+
+def get_pattern_sources_many(contexts: List[Dict[str, Any]]) -> List[Tuple[Dict[str, float], Dict[str, float]]]:
+    """Supplier weights and account weights kept apart, for many rows (patterns.json read once)."""
+    data = _load()
+    return [
+        (_bucket_weights(data, "suppliers", supplier_of(context or {})), _bucket_weights(data, "accounts", account_of(context or {})))
+        for context in contexts
+    ]
+
+
+def _bucket_weights(data: Dict[str, Any], bucket: str, key: str) -> Dict[str, float]:
+    entry = (data.get(bucket) or {}).get(key) if key else None
+    if not entry:
+        return {}
+    return {code: stats["count"] * (stats["avg_conf"] / 100.0) for code, stats in entry["codes"].items()}
+
+
+def _weights(data: Dict[str, Any], context: Dict[str, Any]) -> Dict[str, float]:
     weights: Dict[str, float] = defaultdict(float)
-    if sup and (sup in (data.get("suppliers") or {})):
-        for code, stats in data["suppliers"][sup]["codes"].items():
-            weights[code] += stats["count"] * (stats["avg_conf"] / 100.0)
-    if acc and (acc in (data.get("accounts") or {})):
-        for code, stats in data["accounts"][acc]["codes"].items():
-            weights[code] += stats["count"] * (stats["avg_conf"] / 100.0)
+    for bucket, key in (("suppliers", supplier_of(context)), ("accounts", account_of(context))):
+        for code, weight in _bucket_weights(data, bucket, key).items():
+            weights[code] += weight
     return dict(weights)
 
@@ -0,0 +1,209 @@
+"""
+Ordonnanceur équitable des requêtes LLM entre conversions concurrentes
+
+Un pool unique de workers exécute les batches de toutes les conversions actives
+du processus. Les batches sont servis par file équitable pondérée (start-time
+fair queuing) : chaque conversion avance en temps virtuel au rythme coût/poids,
+si bien qu'une conversion interactive (poids fort) passe devant un traitement de
+masse sans l'affamer.
+
+Avec la file de travaux, l'API et chaque processus `python -m app.worker` ont
+leur propre ordonnanceur : avant chaque batch, un worker réserve une place dans
+la base SQLite des travaux, si bien que LLM_POOL_SIZE plafonne les appels LLM
+simultanés de tous les processus. L'ordre équitable vaut au sein d'un processus ;
+entre processus, les places sont servies au premier qui les demande.
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from ..config import settings
+
+
+# Poids relatifs des niveaux de priorité
+PRIORITY_WEIGHTS = {
+    "interactive": 8.0,
+    "normal": 2.0,
+    "bulk": 1.0,
+}
+# Attente entre deux tentatives de réservation d'une place LLM partagée
+SLOT_POLL_SECONDS = 0.05
+# Ordre de réservation dans la file de travaux (plus haut = plus tôt)
+PRIORITY_RANKS = {"interactive": 2, "normal": 1, "bulk": 0}
+
+
+def resolve_priority(level: Optional[str], total_rows: int) -> str:
+    """Niveau effectif : "auto" classe les petits fichiers en interactif"""
+    if level in PRIORITY_WEIGHTS:
+        return level
+    return "interactive" if total_rows <= settings.interactive_max_rows else "normal"
+
+
+class _Flow:
+    def __init__(self, conv_id: str, level: str):
+        self.conv_id = conv_id
+        self.level = level
+        self.weight = PRIORITY_WEIGHTS[level]
+        self.finish_tag = 0.0
+        self.queued = 0
+        self.running = 0
+        self.rows_done = 0
+        self.first_dispatch: Optional[float] = None
+
+
+class LLMScheduler:
+    """Pool partagé de workers LLM servant les conversions par file équitable pondérée"""
+
+    def __init__(self, workers: Optional[int] = None, shared: Optional[bool] = None):
+        self.workers = max(1, workers or settings.llm_pool_size)
+        # Places LLM partagées entre processus via la base des travaux
+        self.shared = settings.job_queue_enabled if shared is None else shared
+        self.cond = threading.Condition()
+        self.heap: List[tuple] = []
+        self.flows: Dict[str, _Flow] = {}
+        self.virtual_time = 0.0
+        self.seq = itertools.count()
+        self._threads: List[threading.Thread] = []
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"NACREAgent-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def register(self, conv_id: str, level: str = "normal") -> None:
+        with self.cond:
+            flow = self.flows.get(conv_id)
+            if flow is None:
+                flow = self.flows[conv_id] = _Flow(conv_id, level if level in PRIORITY_WEIGHTS else "normal")
+            # Une conversion qui (re)démarre part du temps virtuel courant, sans crédit accumulé
+            flow.finish_tag = max(flow.finish_tag, self.virtual_time)
+
+    def unregister(self, conv_id: str) -> None:
+        with self.cond:
+            self.flows.pop(conv_id, None)
+
+    def submit(self, conv_id: str, fn: Callable[[], Any], cost: float = 1.0) -> Future:
+        """Met un batch en file pour une conversion ; `cost` est sa taille (lignes)"""
+        future: Future = Future()
+        with self.cond:
+            self._ensure_started()
+            flow = self.flows.get(conv_id)
+            if flow is None:
+                flow = self.flows[conv_id] = _Flow(conv_id, "normal")
+            start = max(self.virtual_time, flow.finish_tag)
+            flow.finish_tag = start + max(cost, 1.0) / flow.weight
+            flow.queued += 1
+            heapq.heappush(self.heap, (start, next(self.seq), conv_id, fn, future, cost))
+            self.cond.notify()
+        return future
+
+    def _acquire_slot(self, holder: str) -> Optional[int]:
+        """Attend une place LLM partagée entre processus (None sans file de travaux)"""
+        if not self.shared:
+            return None
+        from .job_queue import get_job_queue
+
+        queue = get_job_queue()
+        while True:
+            try:
+                slot = queue.acquire_llm_slot(holder, self.workers)
+            except Exception as e:
+                # Base indisponible : ne pas bloquer les conversions, plafond local seulement
+                print(f"⚠️ Place LLM partagée indisponible: {e}")
+                return None
+            if slot is not None:
+                return slot
+            time.sleep(SLOT_POLL_SECONDS)
+
+    def _release_slot(self, slot: Optional[int], holder: str) -> None:
+        if slot is None:
+            return
+        from .job_queue import get_job_queue
+
+        try:
+            get_job_queue().release_llm_slot(slot, holder)
+        except Exception as e:
+            print(f"⚠️ Libération de la place LLM {slot} impossible: {e}")
+
+    def _run(self):
+        holder = f"{os.getpid()}-{threading.current_thread().name}"
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+            # Réserver la place avant de choisir le batch : le plus prioritaire à ce moment-là est servi
+            slot = self._acquire_slot(holder)
+            with self.cond:
+                if not self.heap:
+                    self._release_slot(slot, holder)
+                    continue
+                start, _, conv_id, fn, future, cost = heapq.heappop(self.heap)
+                flow = self.flows.get(conv_id)
+                if flow is not None:
+                    flow.queued -= 1
+                # Batch annulé avant d'être servi (conversion arrêtée)
+                if not future.set_running_or_notify_cancel():
+                    self._release_slot(slot, holder)
+                    continue
+                self.virtual_time = max(self.virtual_time, start)
+                if flow is not None:
+                    flow.running += 1
+                    if flow.first_dispatch is None:
+                        flow.first_dispatch = time.time()
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._release_slot(slot, holder)
+                with self.cond:
+                    flow = self.flows.get(conv_id)
+                    if flow is not None:
+                        flow.running -= 1
+                        flow.rows_done += int(cost)
+
+    def flow_status(self, conv_id: str, remaining_rows: Optional[int] = None) -> Dict[str, Any]:
+        """Position dans la file, débit et ETA d'une conversion pour ConversionStatus.stats"""
+        with self.cond:
+            flow = self.flows.get(conv_id)
+            if flow is None:
+                return {}
+            own = [entry[0] for entry in self.heap if entry[2] == conv_id]
+            head = min(own) if own else None
+            # Batches d'autres conversions servis avant le prochain batch de celle-ci
+            ahead = sum(1 for entry in self.heap if entry[2] != conv_id and head is not None and entry[0] < head)
+            total_weight = sum(f.weight for f in self.flows.values())
+            elapsed = time.time() - flow.first_dispatch if flow.first_dispatch else 0.0
+            rate = flow.rows_done / elapsed if elapsed > 0 else 0.0
+            status = {
+                "priority": flow.level,
+                "weight": flow.weight,
+                "share": f"{flow.weight / total_weight * 100:.0f}%" if total_weight else "100%",
+                "active_conversions": len(self.flows),
+                "queued_batches": flow.queued,
+                "running_batches": flow.running,
+                "queue_position": ahead,
+                "throughput": f"{rate:.1f} rows/sec",
+            }
+            if remaining_rows is not None and rate > 0:
+                status["eta_seconds"] = int(remaining_rows / rate)
+            return status
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
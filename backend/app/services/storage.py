@@ -1,6 +1,9 @@
 import json
 import os
 import shutil
+import tempfile
+import threading
+import time
 import uuid
 from typing import Any
 
@@ -39,27 +42,166 @@ def create_conversion(upload_id: str, meta: dict[str, Any]) -> dict[str, Any]:
         "total_rows": 0,
         "stats": {},
         "meta": meta,
-        "rows": [],
+        "checkpoint": {"committed_rows": 0, "last_row_index": None},
     }
     _put_json(f"conv_{cid}.json", rec)
-    return rec
+    return {**rec, "rows": []}
 
 
-def update_conversion(conv_id: str, patch: dict[str, Any]) -> dict[str, Any]:
-    rec = _get_json(f"conv_{conv_id}.json") or {}
-    rec.update(patch)
-    _put_json(f"conv_{conv_id}.json", rec)
-    return rec
+# Rows are stored apart from the conversion document, in an append-only
+# JSON-lines log (conv_<id>.rows.jsonl): committing a row is a single append
+# instead of rewriting the whole document, and a restart keeps every row
+# committed so far.
+#
+# Reviewer corrections go to a second log (conv_<id>.edits.jsonl) of keyed
+# updates that is merged into every read: a patch is an append, whatever the
+# size of the conversion.
+_locks: dict[str, threading.RLock] = {}
+_locks_guard = threading.Lock()
+_row_state: dict[str, dict[str, Any]] = {}
+_edit_state: dict[str, dict[str, Any]] = {}
 
 
-def append_conversion_row(conv_id: str, row_rec: dict[str, Any]):
+def _conv_lock(conv_id: str) -> threading.RLock:
+    with _locks_guard:
+        lock = _locks.get(conv_id)
+        if lock is None:
+            lock = _locks[conv_id] = threading.RLock()
+        return lock
+
+
+def _rows_path(conv_id: str) -> str:
+    return _db_path(f"conv_{conv_id}.rows.jsonl")
+
+
+def _edits_path(conv_id: str) -> str:
+    return _db_path(f"conv_{conv_id}.edits.jsonl")
+
+
+def _read_new_lines(path: str, ino: int, offset: int) -> tuple[list[tuple[int, bytes]], int, int, bool]:
+    """Complete lines (offset, bytes) written to `path` since `offset`.
+
+    Returns the lines, the file inode, the offset to continue from, and whether
+    the file was replaced (rewritten) since `ino`, in which case it is read from
+    the start.
+    """
     try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return [], 0, 0, ino != 0
+    reset = st.st_ino != ino or st.st_size < offset
+    if reset:
+        offset = 0
+    if st.st_size == offset:
+        return [], st.st_ino, offset, reset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        chunk = f.read(st.st_size - offset)
+    lines = []
+    pos = 0
+    end = chunk.rfind(b"\n") + 1
+    for line in chunk[:end].splitlines(keepends=True):
+        lines.append((offset + pos, line))
+        pos += len(line)
+    return lines, st.st_ino, offset + end, reset
+
+
+def _read_rows_log(conv_id: str) -> list[dict[str, Any]]:
+    path = _rows_path(conv_id)
+    rows: list[dict[str, Any]] = []
+    if not os.path.exists(path):
+        return rows
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                # Partial line left by an interrupted write
+                continue
+    return rows
+
+
+def _state(conv_id: str) -> dict[str, Any]:
+    """In-memory sequence counter, committed row indexes and row offsets (caller holds the lock).
+
+    Kept in step with the log, including rows appended by another process.
+    """
+    state = _row_state.get(conv_id)
+    path = _rows_path(conv_id)
+    if state is None and not os.path.exists(path):
+        rows = (_get_json(f"conv_{conv_id}.json") or {}).get("rows", [])
+        state = _row_state[conv_id] = {
+            "seq": max((int(r.get("seq", 0)) for r in rows), default=0),
+            "indices": {int(r.get("row_index", -1)) for r in rows},
+            "offsets": {},
+            "ino": 0,
+            "size": 0,
+        }
+        return state
+    if state is None:
+        state = {"ino": 0, "size": 0}
+    lines, ino, size, reset = _read_new_lines(path, state["ino"], state["size"])
+    if reset or "offsets" not in state:
+        state = {"seq": 0, "indices": set(), "offsets": {}}
+    for offset, line in lines:
+        try:
+            r = json.loads(line)
+        except ValueError:
+            # Partial line left by an interrupted write
+            continue
+        idx = int(r.get("row_index", -1))
+        state["seq"] = max(state["seq"], int(r.get("seq", 0)))
+        state["indices"].add(idx)
+        state["offsets"][idx] = offset
+    state["ino"], state["size"] = ino, size
+    _row_state[conv_id] = state
+    return state
+
+
+def _write_rows(conv_id: str, rows: list[dict[str, Any]]):
+    """Rewrite the whole rows log; `rows` already carry any edits, so the edits log is dropped."""
+    path = _rows_path(conv_id)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    seq = 0
+    offsets: dict[int, int] = {}
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for r in rows:
+                seq = max(seq + 1, int(r.get("seq", 0)))
+                offsets[int(r.get("row_index", -1))] = f.tell()
+                f.write((json.dumps({**r, "seq": seq}, ensure_ascii=False) + "\n").encode("utf-8"))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    if os.path.exists(_edits_path(conv_id)):
+        os.remove(_edits_path(conv_id))
+    _edit_state.pop(conv_id, None)
+    st = os.stat(path)
+    _row_state[conv_id] = {
+        "seq": seq,
+        "indices": set(offsets),
+        "offsets": offsets,
+        "ino": st.st_ino,
+        "size": st.st_size,
+    }
+
+
+def update_conversion(conv_id: str, patch: dict[str, Any]) -> dict[str, Any]:
+    with _conv_lock(conv_id):
         rec = _get_json(f"conv_{conv_id}.json") or {}
-        rows = rec.get("rows", [])
-        rows.append(row_rec)
-        rec["rows"] = rows
-        rec["processed_rows"] = len(rows)
+        patch = dict(patch)
+        if "rows" in patch:
+            _write_rows(conv_id, patch.pop("rows"))
+            rec.pop("rows", None)
+        rec.update(patch)
         _put_json(f"conv_{conv_id}.json", rec)
+        return rec
+
+
+def append_conversion_row(conv_id: str, row_rec: dict[str, Any]):
+    try:
+        append_conversion_rows(conv_id, [row_rec])
     except Exception as e:
         print(f"❌ Error appending row to conversion {conv_id}: {e}")
         import traceback
@@ -67,8 +209,337 @@ def append_conversion_row(conv_id: str, row_rec: dict[str, Any]):
         raise
 
 
+def append_conversion_rows(conv_id: str, row_recs: list[dict[str, Any]]):
+    """Append rows to the conversion's rows log with a single write."""
+    if not row_recs:
+        return
+    ensure_dirs()
+    with _conv_lock(conv_id):
+        version = rows_version(conv_id)
+        state = _state(conv_id)
+        if not os.path.exists(_rows_path(conv_id)):
+            # Legacy document with inline rows: move them to the log first
+            rec = _get_json(f"conv_{conv_id}.json") or {}
+            if rec.get("rows"):
+                _write_rows(conv_id, rec.pop("rows"))
+                _put_json(f"conv_{conv_id}.json", rec)
+                state = _state(conv_id)
+        with open(_rows_path(conv_id), "ab") as f:
+            offset = f.tell()
+            ino = os.fstat(f.fileno()).st_ino
+            parts: list[bytes] = []
+            pos = offset
+            if offset > state["size"]:
+                # Partial line left by an interrupted write: start on a fresh line
+                parts.append(b"\n")
+                pos += 1
+            for r in row_recs:
+                state["seq"] += 1
+                idx = int(r.get("row_index", -1))
+                line = (json.dumps({**r, "seq": state["seq"]}, ensure_ascii=False) + "\n").encode("utf-8")
+                state["indices"].add(idx)
+                state["offsets"][idx] = pos
+                parts.append(line)
+                pos += len(line)
+            f.write(b"".join(parts))
+            f.flush()
+            os.fsync(f.fileno())
+            state["ino"] = ino
+            state["size"] = pos
+        _carbon_delta("rows_appended", conv_id, version, _version_after(version, 0, ino, offset, pos), row_recs)
+
+
+def _version_after(version: str, part: int, ino: int, start: int, end: int) -> str | None:
+    """rows_version right after this call's own write of [start, end) to one of the two logs.
+
+    None when that log had changed since `version` was read (a write from another
+    process came first): a delta against `version` would then miss those rows.
+    """
+    parts = version.split(":")
+    if parts[part] != f"{ino}-{start}" and not (parts[part] == "0" and start == 0):
+        return None
+    parts[part] = f"{ino}-{end}"
+    return ":".join(parts)
+
+
+def _carbon_delta(hook: str, conv_id: str, *args):
+    """Running CO2 totals follow every committed or corrected row (caller holds the lock)."""
+    try:
+        from . import carbon_totals
+        getattr(carbon_totals, hook)(conv_id, *args)
+    except Exception as e:
+        # The totals are rebuilt on their next read; never fail a commit for them
+        print(f"⚠️ CO2 totals not updated for {conv_id}: {e}")
+
+
+def _edits(conv_id: str) -> dict[int, dict[str, Any]]:
+    """Merged corrections by row index, kept in step with the edits log (caller holds the lock)."""
+    state = _edit_state.get(conv_id) or {"ino": 0, "size": 0, "changes": {}}
+    lines, ino, size, reset = _read_new_lines(_edits_path(conv_id), state["ino"], state["size"])
+    if reset:
+        state["changes"] = {}
+    for _, line in lines:
+        try:
+            edit = json.loads(line)
+        except ValueError:
+            continue
+        idx = int(edit.get("row_index", -1))
+        state["changes"][idx] = {**state["changes"].get(idx, {}), **(edit.get("changes") or {})}
+    state["ino"], state["size"] = ino, size
+    _edit_state[conv_id] = state
+    return state["changes"]
+
+
+def _with_edits(conv_id: str, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    with _conv_lock(conv_id):
+        changes = _edits(conv_id)
+    if not changes:
+        return rows
+    return [{**r, **changes[int(r.get("row_index", -1))]} if int(r.get("row_index", -1)) in changes else r for r in rows]
+
+
+def get_conversion_row(conv_id: str, row_index: int) -> dict[str, Any] | None:
+    """One committed row, with its corrections, read at its offset in the log."""
+    with _conv_lock(conv_id):
+        offset = _state(conv_id)["offsets"].get(row_index)
+        if offset is None:
+            if os.path.exists(_rows_path(conv_id)):
+                return None
+            legacy = (_get_json(f"conv_{conv_id}.json") or {}).get("rows", [])
+            row = next((r for r in legacy if int(r.get("row_index", -1)) == row_index), None)
+        else:
+            with open(_rows_path(conv_id), "rb") as f:
+                f.seek(offset)
+                row = json.loads(f.readline())
+        if row is None:
+            return None
+        return {**row, **_edits(conv_id).get(row_index, {})}
+
+
+def patch_conversion_rows(conv_id: str, changes: dict[int, dict[str, Any]]) -> list[dict[str, Any]]:
+    """Record corrections for committed rows as one append to the edits log.
+
+    Unknown row indexes are skipped; returns the updated rows.
+    """
+    ensure_dirs()
+    with _conv_lock(conv_id):
+        if not os.path.exists(_rows_path(conv_id)):
+            # Legacy document with inline rows: move them to the log first
+            rec = _get_json(f"conv_{conv_id}.json") or {}
+            if rec.get("rows"):
+                _write_rows(conv_id, rec.pop("rows"))
+                _put_json(f"conv_{conv_id}.json", rec)
+        known = _state(conv_id)["offsets"]
+        version = rows_version(conv_id)
+        before = [row for row in (get_conversion_row(conv_id, idx) for idx in changes if idx in known and changes[idx]) if row]
+        now = time.time()
+        lines = [
+            json.dumps({"row_index": idx, "changes": patch, "edited_at": now}, ensure_ascii=False)
+            for idx, patch in changes.items()
+            if idx in known and patch
+        ]
+        if lines:
+            with open(_edits_path(conv_id), "ab") as f:
+                start = f.tell()
+                data = ("\n".join(lines) + "\n").encode("utf-8")
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                version_after = _version_after(version, 1, os.fstat(f.fileno()).st_ino, start, start + len(data))
+        updated = [row for row in (get_conversion_row(conv_id, idx) for idx in changes if idx in known) if row]
+        if lines:
+            after = [row for row in updated if changes.get(int(row.get("row_index", -1)))]
+            _carbon_delta("rows_changed", conv_id, version, version_after, before, after)
+        return updated
+
+
+def tail_conversion_edits(conv_id: str, cursor: dict[str, int] | None = None) -> tuple[list[dict[str, Any]], dict[str, int]]:
+    """Corrections recorded since `cursor`, and the cursor to continue from."""
+    cursor = cursor or {"ino": 0, "offset": 0}
+    lines, ino, offset, _ = _read_new_lines(_edits_path(conv_id), cursor["ino"], cursor["offset"])
+    edits = []
+    for _, line in lines:
+        try:
+            edits.append(json.loads(line))
+        except ValueError:
+            continue
+    return edits, {"ino": ino, "offset": offset}
+
+
+def _legacy_rows(conv_id: str) -> list[dict[str, Any]]:
+    """Inline rows of a legacy document, numbered with the seqs _write_rows would give them."""
+    rows = (_get_json(f"conv_{conv_id}.json") or {}).get("rows", [])
+    numbered, seq = [], 0
+    for r in rows:
+        seq = max(seq + 1, int(r.get("seq", 0)))
+        numbered.append({**r, "seq": seq})
+    return numbered
+
+
+def get_conversion_rows(conv_id: str) -> list[dict[str, Any]]:
+    with _conv_lock(conv_id):
+        if os.path.exists(_rows_path(conv_id)):
+            return _with_edits(conv_id, _read_rows_log(conv_id))
+        return _legacy_rows(conv_id)
+
+
+def _line_seq(line: bytes) -> int | None:
+    try:
+        return int(json.loads(line).get("seq", 0))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _offset_after(f, size: int, after: int) -> int:
+    """Byte offset of the first log line with seq > after.
+
+    Seqs increase along the log (appends and rewrites keep the order), so the
+    file is bisected on line boundaries instead of being read from the start.
+    """
+    # Lines starting before lo have seq <= after, lines starting at hi or later seq > after
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        if mid > lo:
+            f.readline()
+        pos = f.tell()
+        if pos >= hi:
+            break
+        line = f.readline()
+        seq = _line_seq(line)
+        if seq is None or seq > after:
+            hi = pos
+        else:
+            lo = pos + len(line)
+    f.seek(lo)
+    while lo < size:
+        line = f.readline()
+        seq = _line_seq(line)
+        if not line.endswith(b"\n") or (seq is not None and seq > after):
+            break
+        lo += len(line)
+    return lo
+
+
+def rows_cursor_after(conv_id: str, after: int) -> dict[str, int] | None:
+    """Cursor for tail_conversion_rows positioned after the row with seq `after`."""
+    path = _rows_path(conv_id)
+    with _conv_lock(conv_id):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with open(path, "rb") as f:
+            return {"ino": st.st_ino, "offset": _offset_after(f, st.st_size, after)}
+
+
+def get_conversion_rows_after(conv_id: str, after: int = 0, limit: int = 1000) -> tuple[list[dict[str, Any]], bool]:
+    """Up to `limit` rows committed after seq `after`, and whether more follow."""
+    path = _rows_path(conv_id)
+    with _conv_lock(conv_id):
+        if not os.path.exists(path):
+            rows = [r for r in _legacy_rows(conv_id) if r["seq"] > after]
+            return rows[:limit], len(rows) > limit
+        rows: list[dict[str, Any]] = []
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(_offset_after(f, size, after))
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if len(rows) == limit:
+                    return _with_edits(conv_id, rows), True
+                rows.append(row)
+        return _with_edits(conv_id, rows), False
+
+
+def tail_conversion_rows(conv_id: str, cursor: dict[str, int] | None = None) -> tuple[list[dict[str, Any]], dict[str, int]]:
+    """Rows appended to the log since `cursor`, and the cursor to continue from.
+
+    Only complete lines are returned. When the log has been rewritten (row
+    edits) it is read again from the start; callers filter on `seq`.
+    """
+    cursor = cursor or {"ino": 0, "offset": 0}
+    lines, ino, offset, _ = _read_new_lines(_rows_path(conv_id), cursor["ino"], cursor["offset"])
+    rows: list[dict[str, Any]] = []
+    for _, line in lines:
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            continue
+    return _with_edits(conv_id, rows), {"ino": ino, "offset": offset}
+
+
+def conversion_stamp(conv_id: str) -> tuple[int, int] | None:
+    """Changes whenever the conversion document (status, progress) is rewritten."""
+    try:
+        st = os.stat(_db_path(f"conv_{conv_id}.json"))
+    except OSError:
+        return None
+    # Every write replaces the file, so the inode changes even within the mtime resolution
+    return st.st_ino, st.st_mtime_ns
+
+
+def rows_version(conv_id: str) -> str:
+    """Changes whenever rows are appended, rewritten or corrected."""
+    parts = []
+    for path in (_rows_path(conv_id), _edits_path(conv_id)):
+        try:
+            st = os.stat(path)
+        except OSError:
+            parts.append("0")
+            continue
+        parts.append(f"{st.st_ino}-{st.st_size}")
+    return ":".join(parts)
+
+
+def committed_row_indices(conv_id: str) -> set[int]:
+    """Row indexes already classified and committed for a conversion."""
+    with _conv_lock(conv_id):
+        return set(_state(conv_id)["indices"])
+
+
+def get_row_checkpoint(conv_id: str) -> dict[str, Any]:
+    """Committed row count and last committed row index, from the rows log."""
+    with _conv_lock(conv_id):
+        indices = _state(conv_id)["indices"]
+        return {
+            "committed_rows": len(indices),
+            "last_row_index": max(indices) if indices else None,
+        }
+
+
+def get_conversion_meta(conv_id: str) -> dict[str, Any] | None:
+    """Conversion document without its rows."""
+    rec = _get_json(f"conv_{conv_id}.json")
+    if rec is not None:
+        rec.pop("rows", None)
+    return rec
+
+
 def get_conversion(conv_id: str) -> dict[str, Any] | None:
-    return _get_json(f"conv_{conv_id}.json")
+    rec = _get_json(f"conv_{conv_id}.json")
+    if rec is None:
+        return None
+    rec["rows"] = get_conversion_rows(conv_id)
+    return rec
+
+
+def list_conversion_ids() -> list[str]:
+    db_dir = os.path.join(settings.storage_dir, "db")
+    if not os.path.exists(db_dir):
+        return []
+    # conv_<id>.json only, not the per-conversion side files (conv_<id>.<kind>.json)
+    return [
+        name[len("conv_"):-len(".json")]
+        for name in os.listdir(db_dir)
+        if name.startswith("conv_") and name.endswith(".json") and "." not in name[len("conv_"):-len(".json")]
+    ]
 
 
 def _db_path(name: str) -> str:
@@ -80,8 +551,16 @@ def _put_json(name: str, obj: dict[str, Any]):
         ensure_dirs()  # Make sure directories exist
         path = _db_path(name)
         print(f"💾 Writing JSON to: {path}")
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(obj, f, ensure_ascii=False, indent=2)
+        # Write then rename so an interrupted write never leaves a truncated document
+        # Temporary name unique across threads and processes (API and workers share db/)
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(obj, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
         print(f"✅ Successfully wrote JSON: {name}")
     except Exception as e:
         print(f"❌ Error writing JSON {name}: {e}")
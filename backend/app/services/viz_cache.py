@@ -0,0 +1,101 @@
+"""
+Cache disque des visualisations carbone
+
+Chaque graphique (figure Plotly et métadonnées) est sérialisé une fois en JSON
+et conservé dans viz_cache/ sous la clé (conversion, version, type de
+graphique, paramètres). La version combine celles du journal des lignes de la
+conversion, des facteurs d'émission et du dictionnaire NACRE : une correction
+ou un nouveau CSV donnent une nouvelle clé. Les routes renvoient le JSON tel
+quel, sans refaire le calcul (modèles, clustering) ni la sérialisation.
+
+Au-delà de settings.viz_cache_max_entries fichiers, les moins récemment servis
+sont supprimés (la date de modification sert d'horloge LRU).
+"""
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, Optional
+
+from plotly.utils import PlotlyJSONEncoder
+
+from ..config import settings
+from .conversion_categories import data_version
+from .nacre_categorization import get_categorizer
+
+
+def _cache_dir() -> str:
+    return os.path.join(settings.storage_dir, "viz_cache")
+
+
+def chart_version(conv_id: Optional[str]) -> str:
+    """Version des données d'un graphique : lignes de la conversion, facteurs et dictionnaire NACRE"""
+    if conv_id:
+        return data_version(conv_id)
+    categorizer = get_categorizer()
+    categorizer.refresh_data()
+    return str(categorizer.csv_mtime)
+
+
+def _path(conv_id: Optional[str], version: str, chart: str, params: Dict[str, Any]) -> str:
+    key = json.dumps([conv_id, version, chart, params], sort_keys=True, default=str)
+    return os.path.join(_cache_dir(), f"{chart}_{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json")
+
+
+def _evict() -> None:
+    """Supprime les graphiques les moins récemment servis au-delà de la limite"""
+    entries = []
+    with os.scandir(_cache_dir()) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue
+    excess = len(entries) - settings.viz_cache_max_entries
+    if excess <= 0:
+        return
+    for _, path in sorted(entries)[:excess]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cached_chart(
+    conv_id: Optional[str],
+    chart: str,
+    params: Optional[Dict[str, Any]],
+    compute: Callable[[], Dict[str, Any]],
+) -> bytes:
+    """
+    JSON du graphique `chart`, depuis le cache ou calculé par compute()
+
+    ValueError si compute() renvoie une erreur ({"error": ...}) ; les erreurs
+    ne sont pas mises en cache.
+    """
+    path = _path(conv_id, chart_version(conv_id), chart, params or {})
+    try:
+        with open(path, "rb") as f:
+            body = f.read()
+        os.utime(path)
+        return body
+    except OSError:
+        pass
+
+    result = compute()
+    if "error" in result:
+        raise ValueError(result["error"])
+    body = json.dumps(result, cls=PlotlyJSONEncoder, ensure_ascii=False).encode("utf-8")
+    os.makedirs(_cache_dir(), exist_ok=True)
+    # Répertoire partagé par l'API et les workers : nom temporaire unique entre processus
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=_cache_dir())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    _evict()
+    return body
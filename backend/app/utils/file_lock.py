@@ -0,0 +1,40 @@
+"""
+Inter-process lock on a lock file, portable (no fcntl/msvcrt).
+
+The lock is held while `<path>` exists: it is created with O_EXCL and removed
+on release. A lock older than `stale_after` seconds is assumed to belong to a
+crashed process and is broken.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def file_lock(path: str, timeout: float = 30.0, stale_after: float = 60.0, poll: float = 0.02) -> Iterator[None]:
+    """Hold `path` exclusively across processes; TimeoutError after `timeout` seconds."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale_after:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError(f"Lock busy: {path}")
+            time.sleep(poll)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,76 @@
+"""
+nacre-worker : exécute les conversions de la file de travaux hors du processus API
+
+Usage (depuis le dossier backend) :
+    python -m app.worker                 # un processus worker
+    python -m app.worker --processes 4   # quatre processus, quatre conversions en parallèle
+
+L'API lance aussi des workers intégrés (threads) sauf si EMBEDDED_WORKER=false.
+"""
+import argparse
+import multiprocessing
+import signal
+import threading
+from typing import List
+
+from .config import settings
+from .services.job_queue import JobWorker
+from .utils.logging_config import setup_logging
+
+
+def _handler(job):
+    # Import tardif : le moteur de conversion charge le dictionnaire et les services IA
+    from .routes.conversion import run_conversion_job
+    return run_conversion_job(job)
+
+
+def run_worker(worker_id: str = None):
+    setup_logging()
+    worker = JobWorker(_handler, worker_id=worker_id)
+    print(f"👷 nacre-worker {worker.worker_id} en attente de conversions")
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        # Le travail en cours sera remis en file et repris depuis son checkpoint
+        pass
+
+
+def start_embedded_workers(count: int = None) -> threading.Event:
+    """Démarre des workers dans le processus API ; renvoie l'événement d'arrêt"""
+    stop = threading.Event()
+    for i in range(count or settings.embedded_worker_threads):
+        worker = JobWorker(_handler)
+        threading.Thread(
+            target=worker.run_forever, args=(stop,), name=f"NACREWorker-{i}", daemon=True
+        ).start()
+    return stop
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog="nacre-worker", description="Worker de conversions NACRE")
+    parser.add_argument("--processes", type=int, default=1, help="Nombre de processus worker")
+    args = parser.parse_args(argv)
+
+    if args.processes <= 1:
+        run_worker()
+        return
+    procs = [multiprocessing.Process(target=run_worker, name=f"nacre-worker-{i}") for i in range(args.processes)]
+    for p in procs:
+        p.start()
+
+    def _terminate(signum, frame):
+        # Ne pas laisser de workers orphelins si le processus parent est arrêté
+        for p in procs:
+            p.terminate()
+
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.join(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+@echo off
+REM NACRE Platform - Conversion worker (nacre-worker)
+REM Runs queued conversions outside the API process.
+REM Set EMBEDDED_WORKER=false in .env so the API only enqueues jobs.
+SETLOCAL ENABLEDELAYEDEXPANSION
+
+IF "%WORKER_PROCESSES%"=="" SET WORKER_PROCESSES=2
+
+REM Move to backend directory (where this script lives)
+pushd %~dp0
+
+REM Activate virtualenv if present (optional)
+IF EXIST "..\venv\Scripts\activate.bat" (
+  call "..\venv\Scripts\activate.bat"
+)
+
+echo Starting %WORKER_PROCESSES% conversion worker process(es)
+echo Press Ctrl+C to stop the workers (running jobs resume from their checkpoint)
+python -m app.worker --processes %WORKER_PROCESSES%
+
+popd
+ENDLOCAL
@@ -574,24 +574,13 @@ function CarbonCalculator({ conversion, columns, onClose }) {
     setError('')
     
     try {
-      // Récupérer les données de conversion
-      const rowsRes = await fetch(`/conversions/${conversion.conversion_id}/rows?limit=10000`)
-      const rowsData = await rowsRes.json()
-      
-      // Préparer les données pour le calcul CO2
-      const data = rowsData.rows.map(row => ({
-        code_nacre: row.nacre_code,
-        libelle: row.original_label,
-        [montantColumn]: row.original_data?.[montantColumn] || row[montantColumn] || 0
-      }))
-
-      // Appel à l'IA CO2
-      const response = await fetch('/co2/analyze', {
+      // Calcul côté serveur : lignes de la conversion jointes au fichier d'origine
+      const response = await fetch(`/co2/co2/conversions/${conversion.conversion_id}/footprint`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          data: data,
-          montant_column: montantColumn
+          montant_column: montantColumn,
+          report: true
         })
       })
 
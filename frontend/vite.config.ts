@@ -11,6 +11,7 @@ export default defineConfig({
       '/exports': 'http://127.0.0.1:8123',
       '/health': 'http://127.0.0.1:8123',
       '/sophie': 'http://127.0.0.1:8123',
+      '/co2': 'http://127.0.0.1:8123',
     },
   },
 })